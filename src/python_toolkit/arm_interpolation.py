@@ -0,0 +1,327 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import threading
+
+import numpy as np
+
+import arm_position
+import arm_position_helpers as armpos
+import build_pipeline
+import metric_registry
+import pose_database
+import pose_store
+from database_cache import DatabaseCache
+
+# metrics built with every database, interpolated from the lattice
+interpolated_metrics = ['consumed_endurance', 'rula']
+# values of a metric scale with (total arm length) ** exponent when the arm is scaled: consumed endurance is a torque
+# (the adjusted mass and the lever both grow with the arm), rula only depends on the joint angles
+metric_scaling = {'consumed_endurance': 2, 'rula': 0}
+
+
+def lattice_weights(axis, value):
+    """ [(index, weight)] of the linear interpolation of value between the points of a sorted axis, None outside """
+    if value < axis[0] or value > axis[-1]:
+        return None
+    upper = min(int(np.searchsorted(axis, value, side='right')), len(axis) - 1)
+    lower = max(upper - 1, 0)
+    if axis[upper] == value or lower == upper:
+        return [(upper, 1.0)]
+    t = (value - axis[lower]) / (axis[upper] - axis[lower])
+    return [(index, weight) for index, weight in ((lower, 1 - t), (upper, t)) if weight > 0]
+
+
+def sample_field(store, points, spacing, values):
+    """
+    Trilinear interpolation at (N, 3) points of the per voxel values of a store (level 0 voxels with a best pose, see
+    PoseStore.nearest_index), unreachable voxels are left out and the weights of the others renormalized. Returns the
+    interpolated values (nan where no voxel is near enough) and the index (in the store) of the nearest voxel.
+    """
+    tree, voxel_index = store.nearest_index('consumed_endurance')
+    result = np.full(len(points), np.nan)
+    nearest = np.full(len(points), -1, dtype=np.int64)
+    if len(voxel_index) == 0:
+        return result, nearest
+
+    # the 8 voxels of the grid cell around a point are within spacing * sqrt(3)
+    distances, neighbours = tree.query(points, k=8, distance_upper_bound=spacing * np.sqrt(3))
+    found = neighbours < tree.n
+    neighbours = np.where(found, neighbours, 0)
+    centers = np.asarray(store.centers)[voxel_index[neighbours]]
+    weights = np.prod(np.clip(1 - np.abs(centers - points[:, None, :]) / spacing, 0, None), axis=2) * found
+    neighbour_values = values[voxel_index[neighbours]]
+    weights[np.isnan(neighbour_values)] = 0
+    total = weights.sum(axis=1)
+
+    inside = total > 0
+    result[inside] = (np.nansum(weights * np.nan_to_num(neighbour_values), axis=1)[inside] / total[inside])
+    nearest[inside] = voxel_index[neighbours[inside, np.argmax(weights[inside], axis=1)]]
+    return result, nearest
+
+
+class ArmLattice:
+    """
+    Databases built for a lattice of arm dimensions (every pair of arm_proper_lengths and forearm_hand_lengths, with
+    the same spacing), in the directory of a DatabaseCache. Users whose dimensions are inside the lattice are served an
+    interpolated database, written in a fraction of the time of a build: the metric values of the best pose (by the
+    first of the interpolated_metrics) of every voxel are interpolated (bilinearly in the arm dimensions) from the
+    surrounding lattice databases, each scaled to the total arm length of the user (positions and metric values, see
+    metric_scaling). Interpolated databases hold one pose per voxel, the best pose of the nearest lattice database
+    scaled to the user. compact lattice databases are built with the
+    compact pose layout (see pose_database.create_tables), interpolated databases always use the standard one.
+    """
+
+    def __init__(self, database_cache, arm_proper_lengths, forearm_hand_lengths, spacing, compact=False):
+        self.database_cache = database_cache
+        self.compact = bool(compact)
+        self.arm_proper_lengths = np.unique(np.asarray(arm_proper_lengths, dtype=float))
+        self.forearm_hand_lengths = np.unique(np.asarray(forearm_hand_lengths, dtype=float))
+        self.spacing = float(spacing)
+        self.lock = threading.Lock()
+        self.stores = {}
+        # one interpolated database is written at a time
+        self.writing = threading.Lock()
+
+    def profiles(self):
+        """ (arm_proper_length, forearm_hand_length, spacing) of the lattice databases """
+        return [(arm_proper_length, forearm_hand_length, self.spacing) for arm_proper_length, forearm_hand_length in
+                itertools.product(self.arm_proper_lengths.tolist(), self.forearm_hand_lengths.tolist())]
+
+    def databases(self):
+        return [self.database_cache.path(*profile, compact=self.compact) for profile in self.profiles()]
+
+    def corners(self, arm_proper_length, forearm_hand_length):
+        """ [(arm_proper_length, forearm_hand_length, weight)] of the lattice points around the dimensions, None if the
+        dimensions are outside of the lattice """
+        proper_weights = lattice_weights(self.arm_proper_lengths, arm_proper_length)
+        forearm_weights = lattice_weights(self.forearm_hand_lengths, forearm_hand_length)
+        if proper_weights is None or forearm_weights is None:
+            return None
+        return [(self.arm_proper_lengths[i].item(), self.forearm_hand_lengths[j].item(), proper_weight * forearm_weight)
+                for (i, proper_weight), (j, forearm_weight) in itertools.product(proper_weights, forearm_weights)]
+
+    def covers(self, arm_proper_length, forearm_hand_length, spacing, levels=0):
+        """ True if the dimensions can be interpolated: inside the lattice, same spacing, surrounding databases built """
+        corners = self.corners(arm_proper_length, forearm_hand_length)
+        return (corners is not None and float(spacing) == self.spacing and int(levels) == 0 and
+                all(self.database_cache.is_complete(self.corner_path(corner[0], corner[1]),
+                                                    self.database_cache.parameters(corner[0], corner[1], self.spacing,
+                                                                                   compact=self.compact))
+                    for corner in corners))
+
+    def corner_path(self, arm_proper_length, forearm_hand_length):
+        """ path of the lattice database of a lattice point """
+        return self.database_cache.path(arm_proper_length, forearm_hand_length, self.spacing, compact=self.compact)
+
+    def path(self, arm_proper_length, forearm_hand_length):
+        """ path of the interpolated database, it depends on the lattice it is interpolated from """
+        parameters = {
+            'arm_proper_length': float(arm_proper_length),
+            'forearm_hand_length': float(forearm_hand_length),
+            'spacing': self.spacing,
+            'lattice': [self.arm_proper_lengths.tolist(), self.forearm_hand_lengths.tolist()],
+            'compact': self.compact,
+            'build_version': arm_position.build_version
+        }
+        key = hashlib.sha1(json.dumps(parameters, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.database_cache.directory, 'xrgonomics_interpolated_{}.db'.format(key))
+
+    def get_store(self, database):
+        """ PoseStore of a lattice database, loaded on first use """
+        with self.lock:
+            store = self.stores.get(database)
+            if store is None:
+                conn = pose_database.create_connection(database, read_only=True)
+                try:
+                    store = self.stores[database] = pose_store.PoseStore(conn)
+                finally:
+                    conn.close()
+            return store
+
+    @staticmethod
+    def get_pose_angles(database, pose_ids):
+        """ (N, 4) elv_angle, shoulder_elv, shoulder_rot and elbow_flexion of poses of a database (nan for id -1) """
+        conn = pose_database.create_connection(database, read_only=True)
+        try:
+            rows = pose_database.get_pose_columns(conn, ['arm_pose_id', 'elv_angle', 'shoulder_elv', 'shoulder_rot',
+                                                         'elbow_flexion'])
+        finally:
+            conn.close()
+        index = np.clip(np.searchsorted(rows[:, 0], pose_ids), 0, max(len(rows) - 1, 0))
+        angles = np.full((len(pose_ids), 4), np.nan)
+        found = (pose_ids >= 0) & (len(rows) > 0)
+        angles[found] = rows[index[found], 1:5]
+        return angles
+
+    def interpolate(self, arm_proper_length, forearm_hand_length):
+        """ path of the interpolated database of the dimensions, written unless it was already """
+        database = self.path(arm_proper_length, forearm_hand_length)
+        with self.writing:
+            if not self.database_cache.is_complete(database):
+                conn = pose_database.create_connection(database)
+                try:
+                    with pose_database.ingestion_mode(conn):
+                        self.build_database(conn, arm_proper_length, forearm_hand_length)
+                finally:
+                    conn.close()
+        self.database_cache.touch(database)
+        return database
+
+    def build_database(self, conn, arm_proper_length, forearm_hand_length):
+        """
+        Writes the interpolated database of the dimensions (see ArmLattice). The spread of every metric is stored in the
+        'interpolation_spread' metadata: for each voxel, the largest difference between the interpolated value and the
+        (scaled) values of the lattice points it is interpolated from. It estimates the interpolation error but does not
+        bound it, compare measures the error against an exact build.
+        """
+        corners = self.corners(arm_proper_length, forearm_hand_length)
+        if corners is None:
+            raise ValueError('Arm dimensions {}, {} are outside of the lattice'.format(arm_proper_length,
+                                                                                      forearm_hand_length))
+        total_length = arm_proper_length + forearm_hand_length
+        origins = armpos.compute_interaction_space(self.spacing,
+                                                   armpos.interaction_space_limits(arm_proper_length,
+                                                                                   forearm_hand_length),
+                                                   total_length)
+        voxels = build_pipeline.voxel_rows(origins, self.spacing)
+        centers = voxels[:, 6:9]
+
+        # every lattice database contributes one pose per voxel, its best pose by the ranking metric, and all the
+        # metrics are interpolated from these poses. The stored pose is the one of the nearest lattice database, so the
+        # row of a voxel describes a single pose instead of mixing the best poses of every metric
+        ranking_metric = interpolated_metrics[0]
+        nearest_corner = max(range(len(corners)), key=lambda i: corners[i][2])
+        corner_values = {metric: [] for metric in interpolated_metrics}
+        weights = []
+        for i, (corner_proper_length, corner_forearm_length, weight) in enumerate(corners):
+            corner_database = self.corner_path(corner_proper_length, corner_forearm_length)
+            store = self.get_store(corner_database)
+            scale = (corner_proper_length + corner_forearm_length) / total_length
+            count, best = store.best[ranking_metric]
+            for metric in interpolated_metrics:
+                values = np.where(best >= 0, np.asarray(store.metrics[metric])[np.maximum(best, 0)], np.nan)
+                sampled, nearest = sample_field(store, centers * scale, self.spacing * scale, values)
+                corner_values[metric].append(sampled / scale ** metric_scaling[metric])
+                if metric == ranking_metric:
+                    nearest_voxels = nearest
+            weights.append(np.where(np.isnan(corner_values[ranking_metric][-1]), 0, weight))
+            if i == nearest_corner:
+                pose_index = np.where(nearest_voxels >= 0, best[np.maximum(nearest_voxels, 0)], -1)
+                pose_ids = np.where(pose_index >= 0, np.asarray(store.pose_ids)[np.maximum(pose_index, 0)], -1)
+                elbows = np.asarray(store.elbows)[np.maximum(pose_index, 0)] / scale
+                angles = self.get_pose_angles(corner_database, pose_ids)
+
+        weights = np.array(weights)
+        total = weights.sum(axis=0)
+        reachable = (total > 0) & (pose_ids >= 0)
+        interpolated = {}
+        spreads = {}
+        for metric in interpolated_metrics:
+            values = np.array(corner_values[metric])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                interpolated[metric] = np.nansum(weights * np.nan_to_num(values), axis=0) / total
+            deviation = np.where(weights > 0, np.abs(np.nan_to_num(values) - interpolated[metric]), 0)
+            spread = deviation.max(axis=0)[reachable]
+            spreads[metric] = {'max': float(spread.max()) if len(spread) > 0 else 0.0,
+                               'mean': float(spread.mean()) if len(spread) > 0 else 0.0,
+                               'p95': float(np.percentile(spread, 95)) if len(spread) > 0 else 0.0}
+
+        pose_database.drop_tables(conn)
+        pose_database.create_tables(conn)
+        voxel_ids = np.arange(1, len(voxels) + 1)
+        pose_database.insert_voxels_with_ids(conn, [[voxel_id] + voxel + [0, 0] for voxel_id, voxel in
+                                                    zip(voxel_ids.tolist(), voxels.tolist())])
+        rows = zip(np.arange(1, np.count_nonzero(reachable) + 1).tolist(), voxel_ids[reachable].tolist(),
+                   *elbows[reachable].T.tolist(), *angles[reachable].T.tolist(),
+                   interpolated['consumed_endurance'][reachable].tolist(), interpolated['rula'][reachable].tolist())
+        pose_database.insert_scored_arm_poses(conn, rows)
+        pose_database.create_indexes(conn)
+        pose_database.cache_voxels_limits(conn)
+        pose_database.refresh_voxel_best_pose(conn)
+
+        pose_database.set_metadata(conn, 'arm_proper_length', arm_proper_length)
+        pose_database.set_metadata(conn, 'forearm_hand_length', forearm_hand_length)
+        pose_database.set_metadata(conn, 'spacing', self.spacing)
+        pose_database.set_metadata(conn, 'levels', 0)
+        pose_database.set_metadata(conn, 'interpolated', json.dumps([corner[:2] for corner in corners]))
+        pose_database.set_metadata(conn, 'interpolation_spread', json.dumps(spreads))
+        metric_registry.set_metric_versions(conn, interpolated_metrics)
+        pose_database.set_metadata(conn, 'build_version', arm_position.build_version)
+        pose_database.set_metadata(conn, 'complete', 1)
+        conn.commit()
+        return spreads
+
+
+def build_lattice(lattice, workers=1):
+    """ builds the lattice databases that are missing """
+    for arm_proper_length, forearm_hand_length, spacing in lattice.profiles():
+        database = lattice.corner_path(arm_proper_length, forearm_hand_length)
+        if not lattice.database_cache.is_complete(database, lattice.database_cache.parameters(
+                arm_proper_length, forearm_hand_length, spacing, compact=lattice.compact)):
+            toolkit = arm_position.XRgonomics(database, arm_proper_length, forearm_hand_length, spacing,
+                                              workers=workers, compact=lattice.compact)
+            toolkit.conn.close()
+
+
+def compare(interpolated, exact):
+    """ {metric: {'max', 'mean'}} of the absolute differences between the best values of the voxels of two databases
+    of the same dimensions, and the voxels reachable in only one of them """
+    stores = []
+    for database in (interpolated, exact):
+        conn = pose_database.create_connection(database, read_only=True)
+        try:
+            stores.append(pose_store.PoseStore(conn))
+        finally:
+            conn.close()
+    result = {}
+    for metric in interpolated_metrics:
+        values = []
+        for store in stores:
+            count, best = store.best[metric]
+            values.append(np.where(best >= 0, store.metrics[metric][np.maximum(best, 0)], np.nan))
+        both = ~np.isnan(values[0]) & ~np.isnan(values[1])
+        difference = np.abs(values[0] - values[1])[both]
+        result[metric] = {'max': float(difference.max()) if len(difference) > 0 else 0.0,
+                          'mean': float(difference.mean()) if len(difference) > 0 else 0.0}
+    result['mismatched_voxels'] = int(np.count_nonzero(np.isnan(values[0]) != np.isnan(values[1])))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lattice of arm dimension databases, interpolated databases')
+    parser.add_argument('--database-dir', default='databases')
+    parser.add_argument('--arm-proper-lengths', type=float, nargs='+', required=True)
+    parser.add_argument('--forearm-hand-lengths', type=float, nargs='+', required=True)
+    parser.add_argument('--spacing', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=1, help='processes of the database builds')
+    parser.add_argument('--compact', action='store_true', help='builds the lattice with the compact pose layout')
+    parser.add_argument('--interpolate', type=float, nargs=2, metavar=('ARM_PROPER_LENGTH', 'FOREARM_HAND_LENGTH'),
+                        help='writes the interpolated database of these dimensions')
+    parser.add_argument('--validate', action='store_true',
+                        help='also builds the exact database of the interpolated dimensions and reports the error')
+    args = parser.parse_args()
+
+    # the lattice must never be evicted, so the cache has no limits
+    lattice = ArmLattice(DatabaseCache(args.database_dir, None), args.arm_proper_lengths, args.forearm_hand_lengths,
+                         args.spacing, args.compact)
+    build_lattice(lattice, args.workers)
+    if args.interpolate is not None:
+        database = lattice.interpolate(*args.interpolate)
+        conn = pose_database.create_connection(database, read_only=True)
+        try:
+            print('Interpolated {}, spread {}'.format(database,
+                                                      pose_database.get_metadata(conn, 'interpolation_spread')))
+        finally:
+            conn.close()
+        if args.validate:
+            exact = lattice.database_cache.path(args.interpolate[0], args.interpolate[1], args.spacing)
+            arm_position.XRgonomics(exact, args.interpolate[0], args.interpolate[1], args.spacing,
+                                    workers=args.workers).conn.close()
+            print('Error against {}: {}'.format(exact, json.dumps(compare(database, exact))))
+
+
+if __name__ == '__main__':
+    main()
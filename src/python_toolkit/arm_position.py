@@ -1,25 +1,91 @@
 import arm_position_helpers as armpos
 import linalg_helpers as linalg
 import pose_database
+import metric_registry
+import pose_store
+import build_pipeline
+import instrumentation
 import numpy as np
 # import opensim as osim
 # import biomechanics
 from scipy.spatial import ConvexHull
 import time
 
+# must be increased whenever the schema or the algorithms used to build a database change, so that databases built by
+# previous versions are not reused
+# 2 -- refinement levels, and one voxel grid aligned on the floored interaction space limits (see
+# arm_position_helpers.interaction_space_axes). The rows of version 1 after the first one started at the unfloored
+# limits, which gives other voxels for arm lengths that are not integers
+build_version = 2
+
+# metrics the queries rank poses by, the only names accepted in the metric column of the SQL queries
+query_metrics = ('muscle_activation',) + tuple(metric_registry.registry)
+
 
 class XRgonomics:
-    def __init__(self, database='poses.db', arm_proper_length=33, forearm_hand_length=46, spacing=10):
+    def __init__(self, database='poses.db', arm_proper_length=33, forearm_hand_length=46, spacing=10, engine='sql',
+                 read_only=False, workers=1, levels=0, refine_threshold=2.0, refine_polygons=(), progress=None,
+                 partial_results=None, store=None, swivel_step=np.pi / 8, swivel_refinement=0, compact=False):
+        """
+        engine -- 'sql' answers queries with sqlite, 'memory' loads the database into a pose_store.PoseStore at startup
+        and answers read queries with numpy, 'snapshot' does the same with a memory-mapped snapshot of the database (see
+        pose_store.PoseStore.save). Snapshots are written when missing, unless read_only
+        read_only -- open an existing database in read-only mode, it is never built
+        Custom databases are only built if they were not completely built before with the same build_version and build
+        parameters (arm dimensions, spacing, levels, refinement, swivel angles and layout, see
+        build_pipeline.build_parameters), a database built with other parameters is rebuilt. Interrupted builds resume
+        from their last checkpoint
+        workers -- number of processes used to build a custom database (None uses all the cpus)
+        levels, refine_threshold, refine_polygons -- adaptive refinement of a custom database, see
+        build_pipeline.build_database. Queries take the level of detail to answer with (0 is the base grid)
+        progress, partial_results -- callbacks of the build, see build_pipeline.build_database
+        store -- pose_store.PoseStore of the database shared with other instances (e.g. by the server workers), used
+        instead of loading one
+        swivel_step, swivel_refinement -- swivel angle resolution (radians) of the poses of a custom database and
+        golden-section refinement of the best one of each voxel, see build_pipeline.build_database
+        compact -- store the poses of a custom database in the compact layout (see pose_database.create_tables), which
+        is several times smaller. Queries are answered the same way with both layouts
+        """
         since = time.time()
+        self.database = database
         self.arm_proper_length = arm_proper_length
         self.forearm_hand_length = forearm_hand_length
-        self.conn = pose_database.create_connection(database)
-        if database != 'poses.db':
-            pose_database.create_tables(self.conn)
-            self.initialize_pose_db(arm_proper_length, forearm_hand_length, spacing)
-            self.compute_all_arm_pos()
-            self.compute_consumed_endurance()
-            self.compute_rula()
+        self.engine = engine
+        self.read_only = read_only
+        self.conn = pose_database.create_connection(database, read_only)
+        built = False
+        parameters = build_pipeline.build_parameters(arm_proper_length, forearm_hand_length, spacing, levels,
+                                                     refine_threshold, refine_polygons, build_version, swivel_step,
+                                                     swivel_refinement, compact)
+        if database != 'poses.db' and not read_only and not pose_database.is_build_complete(self.conn, build_version,
+                                                                                             parameters):
+            if pose_database.is_build_complete(self.conn, build_version):
+                print('{} was built with other parameters, rebuilding it'.format(database))
+            # on-disk journal, checkpoints of the build must survive a killed process
+            with pose_database.ingestion_mode(self.conn, journal_mode='TRUNCATE'):
+                # resumes an interrupted build, or drops the leftovers of an outdated build
+                build_pipeline.build_database(self.conn, arm_proper_length, forearm_hand_length, spacing, workers,
+                                              progress=progress, levels=levels, refine_threshold=refine_threshold,
+                                              refine_polygons=refine_polygons, partial_results=partial_results,
+                                              build_version=build_version, swivel_step=swivel_step,
+                                              swivel_refinement=swivel_refinement, compact=compact)
+                pose_database.set_metadata(self.conn, 'arm_proper_length', arm_proper_length)
+                pose_database.set_metadata(self.conn, 'forearm_hand_length', forearm_hand_length)
+                pose_database.set_metadata(self.conn, 'spacing', spacing)
+                pose_database.set_metadata(self.conn, 'levels', levels)
+                pose_database.set_metadata(self.conn, 'swivel_step', swivel_step)
+                pose_database.set_metadata(self.conn, 'swivel_refinement', swivel_refinement)
+                metric_registry.set_metric_versions(self.conn, ['consumed_endurance', 'rula'])
+                pose_database.set_metadata(self.conn, 'build_version', build_version)
+                pose_database.set_metadata(self.conn, 'complete', 1)
+            built = True
+        if not read_only and not pose_database.has_indexes(self.conn):
+            # databases built before the indexes, read-only instances never write and query them without the indexes
+            pose_database.create_indexes(self.conn)
+            self.conn.commit()
+        # databases built before refinement levels only have the base grid
+        self.has_levels = pose_database.has_voxel_levels(self.conn)
+        self.store = store if store is not None else self.open_store(refresh=built)
         self.last_interaction_space = []
         self.is_version = 0
         self.is_updated = 0
@@ -27,19 +93,44 @@ class XRgonomics:
 
     def initialize_pose_db(self, arm_proper_length, forearm_hand_length, spacing):
         pose_database.create_tables(self.conn)
+        pose_database.create_indexes(self.conn)
+        self.has_levels = pose_database.has_voxel_levels(self.conn)
 
-        arm_total_length = arm_proper_length + forearm_hand_length
         voxels = armpos.compute_interaction_space(spacing,
-                                                  [(-15, arm_total_length), (-arm_total_length, arm_total_length),
-                                                   (-arm_proper_length / 2 - forearm_hand_length, arm_total_length)],
-                                                  arm_total_length)
-        for voxel in voxels:
-            pose_database.insert_voxel(self.conn, (voxel[0], voxel[0] + spacing,
-                                       voxel[1], voxel[1] + spacing,
-                                       voxel[2], voxel[2] + spacing,
-                                       voxel[0] + spacing / 2, voxel[1] + spacing / 2,
-                                       voxel[2] + spacing / 2))
+                                                  armpos.interaction_space_limits(arm_proper_length,
+                                                                                  forearm_hand_length),
+                                                  arm_proper_length + forearm_hand_length)
+        pose_database.insert_voxels(self.conn, ((voxel[0], voxel[0] + spacing,
+                                                 voxel[1], voxel[1] + spacing,
+                                                 voxel[2], voxel[2] + spacing,
+                                                 voxel[0] + spacing / 2, voxel[1] + spacing / 2,
+                                                 voxel[2] + spacing / 2) for voxel in voxels))
+        self.conn.commit()
+        self.metrics_updated()
+
+    def metrics_updated(self, metrics=pose_database.best_pose_metrics):
+        """ Must be called after the poses or their metrics change, so that derived tables and in-memory copies are
+        refreshed """
+        pose_database.refresh_voxel_best_pose(self.conn, [metric for metric in metrics
+                                                          if metric in pose_database.best_pose_metrics])
         self.conn.commit()
+        self.store = self.open_store(refresh=True)
+
+    def open_store(self, refresh=False):
+        """ PoseStore of the engine (None for 'sql'). refresh must be set when the database changed, snapshots of the
+        previous content are then rewritten (or removed, if the engine does not use them) """
+        if self.engine == 'snapshot':
+            snapshot = pose_store.snapshot_path(self.database)
+            if (refresh or not pose_store.is_snapshot(snapshot)) and not self.read_only:
+                pose_store.export_snapshot(self.conn, self.database)
+            if pose_store.is_snapshot(snapshot):
+                return pose_store.PoseStore.load(snapshot)
+            # read-only database without snapshot, loaded in memory
+            return pose_store.PoseStore(self.conn)
+
+        if refresh and not self.read_only:
+            pose_store.remove_snapshot(self.database)
+        return pose_store.PoseStore(self.conn) if self.engine == 'memory' else None
 
     def get_all_voxels(self):
         anchors = pose_database.get_all_voxels(self.conn)
@@ -51,9 +142,91 @@ class XRgonomics:
             })
         return result
 
-    def get_voxels_constrained(self, metric, constraints):
+    def get_voxels_constrained(self, metric, constraints, level=0, weights=None):
         if metric == 'last_interaction_space':
             return self.get_last_interaction_space()
+        check_metric(metric)
+        columns = self.get_voxels_constrained_columns(metric, constraints, level, weights)
+
+        result = []
+        for voxel_id, position, num_poses, pose_id, comfort in zip(columns['id'].tolist(), columns['position'].tolist(),
+                                                                   columns['num_poses'].tolist(),
+                                                                   columns['pose_id'].tolist(),
+                                                                   columns['comfort'].tolist()):
+            result.append({
+                'id': voxel_id,
+                'position': position,
+                'num_poses': num_poses,
+                'pose_id': pose_id,
+                'comfort': comfort
+            })
+        return result
+
+    def get_voxels_constrained_columns(self, metric, constraints, level=0, weights=None):
+        """
+        Same result as get_voxels_constrained, as numpy columns (sorted by comfort) instead of a list of dicts
+        weights -- weights of the weighted_metrics metric (see comfort_metrics.weight_normalized_metrics), computed in
+        memory instead of read from the database
+        """
+        check_metric(metric)
+        if weights is not None or self.store is not None:
+            since = instrumentation.start()
+            store = self.get_store() if weights is not None else self.store
+            voxels = store.get_voxels_constrained(metric, constraints, level, weights)
+            instrumentation.stop('memory', since)
+        else:
+            voxels = self.query_voxels_constrained(metric, constraints, level)
+
+        voxels_sorted = normalize_comfort_metric(voxels, 6, metric).reshape(-1, 9)
+        return {
+            'id': voxels_sorted[:, 0].astype(np.int64),
+            'position': voxels_sorted[:, 1:4],
+            'num_poses': voxels_sorted[:, 4].astype(np.int64),
+            'pose_id': voxels_sorted[:, 5].astype(np.int64),
+            'comfort': voxels_sorted[:, 8]
+        }
+
+    def get_store(self):
+        """ PoseStore answering the in-memory only queries (custom weights, nearest voxels), the 'sql' engine loads one
+        on first use """
+        if self.store is None:
+            self.store = pose_store.PoseStore(self.conn)
+        return self.store
+
+    def get_voxels_nearest(self, metric, point, radius=None, k=None, level=0):
+        """
+        Reachable voxels near a point, sorted by comfort (most comfortable first), in the get_voxels_constrained format
+        plus the distance between the voxel center and the point. With radius, the voxels whose center is within radius
+        of the point (at most k of them, if k is set). Without radius, the k voxels nearest to the point.
+        Answered with a KD-tree over the voxel centers (see pose_store.PoseStore.nearest_index), built on first use.
+        """
+        check_metric(metric)
+        since = instrumentation.start()
+        voxels = self.get_store().get_voxels_nearest(metric, point, radius, k, level)
+        instrumentation.stop('memory', since)
+
+        voxels_sorted = normalize_comfort_metric(voxels, 6, metric).reshape(-1, 10)
+        if radius is not None and k is not None:
+            voxels_sorted = voxels_sorted[:k]
+        result = []
+        for voxel in voxels_sorted.tolist():
+            result.append({
+                'id': int(voxel[0]),
+                'position': voxel[1:4],
+                'num_poses': int(voxel[4]),
+                'pose_id': int(voxel[5]),
+                'comfort': voxel[9],
+                'distance': voxel[8]
+            })
+        return result
+
+    def query_voxels_constrained(self, metric, constraints, level=0):
+        check_metric(metric)
+        # muscle_activation ranks the poses by muscle_activation_reserve
+        best_pose_metric = 'muscle_activation_reserve' if metric == 'muscle_activation' else metric
+        if pose_database.has_voxel_best_pose(self.conn, best_pose_metric):
+            return self.query_voxels_best_pose(metric, constraints, level)
+
         if metric == 'muscle_activation':
             query = metric + ', MIN(arm_poses.muscle_activation_reserve)'
         else:
@@ -63,78 +236,73 @@ class XRgonomics:
                  FROM voxels INNER JOIN arm_poses ON arm_poses.voxel_id = voxels.id '''.format(query)
 
         params = []
-        if len(constraints) > 0:
-            const_sql, const_params = get_sql_constraint(*constraints[0].values())
-            sql += 'WHERE ' + const_sql
+        for i, (const_sql, const_params) in enumerate(self.get_sql_constraints(constraints, level)):
+            sql += ('WHERE ' if i == 0 else 'AND ') + const_sql
             params += const_params
 
-            for constraint in constraints[1:]:
-                const_sql, const_params = get_sql_constraint(*constraint.values())
-                sql += 'AND ' + const_sql
-                params += const_params
-
         sql += '''AND {} IS NOT NULL {}
                   GROUP BY voxels.id'''.format(metric, 'AND reserve IS NOT NULL' if metric == 'muscle_activation' else '')
 
-        cursor = pose_database.custom_query(self.conn, sql, params)
-        voxels = cursor.fetchall()
+        return pose_database.query_rows(self.conn, sql, params)
 
-        result = []
-        voxels_sorted = normalize_comfort_metric(voxels, 6, metric)
-        for voxel in voxels_sorted.tolist():
-            result.append({
-                'id': int(voxel[0]),
-                'position': [voxel[1], voxel[2], voxel[3]],
-                'num_poses': int(voxel[4]),
-                'pose_id': int(voxel[5]),
-                'comfort': voxel[8]
-            })
-        return result
-
-    def compute_muscle_activation_reserve_function(self):
-        cursor = self.conn.cursor()
+    def query_voxels_best_pose(self, metric, constraints, level=0):
+        """ Same rows as query_voxels_constrained, read from the materialized voxel_best_pose table """
+        check_metric(metric)
+        if metric == 'muscle_activation':
+            query = 'voxel_best_pose.muscle_activation, voxel_best_pose.value'
+            best_pose_metric = 'muscle_activation_reserve'
+        else:
+            query = 'voxel_best_pose.value, voxel_best_pose.reserve'
+            best_pose_metric = metric
+
+        # CROSS JOIN keeps voxels as the outer loop, constraints are solved by the r*-tree
+        sql = '''SELECT voxels.id, voxels.x, voxels.y, voxels.z, voxel_best_pose.num_poses,
+                        voxel_best_pose.arm_pose_id, {}
+                 FROM voxels CROSS JOIN voxel_best_pose
+                   ON voxel_best_pose.metric = ? AND voxel_best_pose.voxel_id = voxels.id '''.format(query)
+        params = [best_pose_metric]
+        for i, (const_sql, const_params) in enumerate(self.get_sql_constraints(constraints, level)):
+            sql += ('WHERE ' if i == 0 else 'AND ') + const_sql
+            params += const_params
+        sql += 'ORDER BY voxels.id'
 
-        # we want to give priority to poses with the lowest reserve values. Hence, we use the max reserve value of all
-        # voxels, where their reserve value is the minimum between all the poses.
-        # voxels that have reserve values among a threshold receive the worst comfort rating (1).
-        poses = pose_database.get_all_poses_muscle_activation(self.conn)
+        return pose_database.query_rows(self.conn, sql, params)
 
-        reserve_threshold = 250
-        for pose in poses:
-            muscle_activation_reserve = pose[1] + pose[2] / reserve_threshold
-            sql = '''UPDATE arm_poses
-                     SET muscle_activation_reserve = ?
-                     WHERE arm_pose_id = ?'''
-            cursor.execute(sql, (muscle_activation_reserve, pose[0]))
+    def get_sql_constraints(self, constraints, level=0):
+        """ (sql, params) of the constraints and of the level of detail, to be combined with AND """
+        sql_constraints = [get_sql_constraint(*constraint.values()) for constraint in constraints]
+        if self.has_levels:
+            sql_constraints.append(pose_database.get_sql_level(level))
+        return sql_constraints
 
+    def update_metrics(self, metrics=()):
+        """
+        Recomputes the metrics given as argument, the metrics whose version changed (see metric_registry) and the dirty
+        poses. Metrics that depend on them (e.g. weighted_metrics) are refreshed in the same pass, only changed poses
+        are written.
+        """
+        changed = metric_registry.recompute_metrics(self.conn, self.arm_proper_length, self.forearm_hand_length,
+                                                    metrics)
         self.conn.commit()
+        if len(changed) > 0:
+            self.metrics_updated(changed)
+        return changed
 
-    def compute_weigthed_metrics(self):
-        cursor = self.conn.cursor()
-
-        poses = pose_database.get_all_poses_all_metrics(self.conn)
-
-        for arm_id, consumed_endurance, rula, muscle_activation in poses:
-
-            consumed_endurance -= 0.018610636123524517
-            consumed_endurance /= 9.599405943409115
-            consumed_endurance_w = 1/3 * consumed_endurance
-            rula -= 3
-            rula /= 9
-            rula_w = 1/3 * rula
-            if muscle_activation is None:
-                muscle_activation = 1
-            muscle_activation_w = 1/3 * min(1, muscle_activation)
-            sql = '''UPDATE arm_poses
-                     SET weighted_metrics = ?
-                     WHERE arm_pose_id = ?'''
-            cursor.execute(sql, (consumed_endurance_w + rula_w + muscle_activation_w, arm_id))
+    def compute_muscle_activation_reserve_function(self):
+        self.update_metrics(['muscle_activation_reserve'])
 
-        self.conn.commit()
+    def compute_weigthed_metrics(self):
+        self.update_metrics(['weighted_metrics'])
 
-    def get_voxel_poses(self, x, y, z, metric):
-        voxel_id = pose_database.get_voxel_point(self.conn, x, y, z)[0]
-        poses = pose_database.get_poses_in_voxel(self.conn, voxel_id, metric).fetchall()
+    def get_voxel_poses(self, x, y, z, metric, level=0):
+        check_metric(metric)
+        since = instrumentation.start()
+        if self.store is not None:
+            poses = self.store.get_poses_in_voxel(self.store.get_voxel_point(x, y, z, level), metric)
+        else:
+            voxel_id = pose_database.get_voxel_point(self.conn, x, y, z, level if self.has_levels else None)[0]
+            poses = pose_database.get_poses_in_voxel(self.conn, voxel_id, metric)
+        instrumentation.stop('memory' if self.store is not None else 'sql', since)
 
         result = []
         poses_sorted = normalize_comfort_metric(poses, 4, metric)
@@ -161,7 +329,10 @@ class XRgonomics:
         return result
 
     def get_interaction_space_limits(self):
-        limits = pose_database.get_voxels_limits(self.conn)
+        if self.store is not None:
+            limits = self.store.get_voxels_limits()
+        else:
+            limits = pose_database.get_voxels_limits(self.conn)
         limits_dict = {
             'min_x': limits[0],
             'max_x': limits[1],
@@ -175,16 +346,20 @@ class XRgonomics:
     def compute_all_arm_pos(self):
         # model = osim.Model('../../assets/MoBL_ARMS_module6_7_CMC_updated_unlocked.osim')
         # model.initSystem()
-        for voxel in self.get_all_voxels():
-            # get point in the anchor center
-            poses = armpos.compute_anchor_arm_poses(np.array(voxel['position']), self.arm_proper_length,
-                                                    self.forearm_hand_length)
-            if len(poses) > 0:
-                for pose in poses:
-                    pose_database.insert_arm_pose(self.conn, (voxel['id'], pose['elbow_x'], pose['elbow_y'],
-                                                              pose['elbow_z'], pose['elv_angle'], pose['shoulder_elv'],
-                                                              pose['shoulder_rot'], pose['elbow_flexion']))
+        voxels = pose_database.get_all_voxels(self.conn)
+        if len(voxels) == 0:
+            return
+        voxels = np.array(voxels)
+        # solve the poses of all voxels (anchor centers) at once
+        poses = armpos.compute_anchor_arm_poses_batch(voxels[:, 1:4], self.arm_proper_length,
+                                                      self.forearm_hand_length)
+        voxel_ids = voxels[poses['voxel_index'], 0].astype(int).tolist()
+        pose_database.insert_arm_poses(self.conn, zip(voxel_ids, poses['elbow_x'].tolist(), poses['elbow_y'].tolist(),
+                                                      poses['elbow_z'].tolist(), poses['elv_angle'].tolist(),
+                                                      poses['shoulder_elv'].tolist(), poses['shoulder_rot'].tolist(),
+                                                      poses['elbow_flexion'].tolist()))
         self.conn.commit()
+        self.metrics_updated()
 
     # Need opensim python bindings
     # def compute_muscle_activations(self):
@@ -224,109 +399,57 @@ class XRgonomics:
     #         conn.commit()
 
     def compute_consumed_endurance(self):
-        poses = pose_database.get_all_poses_voxels(self.conn)
-        # print(poses[0])
-
-        # Frievalds arm data for 50th percentile male:
-        # upper arm: length - 33cm; mass - 2.1; distance cg - 13.2
-        # forearm: length - 26.9cm; mass - 1.2; distance cg - 11.7
-        # hand: length - 19.1cm; mass - 0.4; distance cg - 7.0
-        for pose in poses:
-            # print(pose)
-            # retrieve pose data and convert to meters
-            end_effector = np.array(pose[1:4]) / 100
-            elbow = np.array(pose[4:7]) / 100
-
-            # ehv stands for elbow hand vector
-            ehv_unit = linalg.normalize(end_effector - elbow)
-            elbow_unit = linalg.normalize(elbow)
-            # Due to the fact that we lock the hand coordinate (always at 0 degrees), the CoM of the elbow - hand vector
-            # will always be at 17.25cm from the elbow for 50th percent male
-            # 11.7 + 0.25 * 22.2 = 17.25
-            # 17.25 / 46 = 0.375
-            # check appendix B of Consumed Endurance paper for more info
-            d = elbow + ehv_unit * self.forearm_hand_length * 0.01 * 0.375
-            a = elbow_unit * self.arm_proper_length * 0.01 * 0.4
-            ad = d - a
-            com = a + 0.43 * ad
-
-            # mass should be adjusted if arm dimensions change
-            # 3.7kg for 50th percentile male, currently a simple heuristic based on arm size.
-            adjusted_mass = (self.forearm_hand_length + self.arm_proper_length) / 79 * 3.7
-            torque_shoulder = np.cross(com, adjusted_mass * np.array([0, 9.8, 0]))
-            torque_shoulder_mag = linalg.magnitude(torque_shoulder)
-
-            strength = torque_shoulder_mag / 101.6 * 100
-            pose_database.set_pose_consumed_endurance(self.conn, pose[0], strength)
-            self.conn.commit()
+        self.update_metrics(['consumed_endurance'])
 
     def compute_rula(self):
-        poses = pose_database.get_all_poses_voxels(self.conn)
-
-        # pose = poses[0]
-        for pose in poses:
-            # arm pose is already computed for osim
-            end_effector = pose[1:4]
-            # elbow_pos = pose[4:7]
-            elv_angle = pose[7]
-            shoulder_elv = pose[8]
-            elbow_flexion = pose[9]
-
-            rula_score = 0
-
-            # upper arm flexion / extension
-            if shoulder_elv < 20:
-                rula_score += 1
-            elif shoulder_elv < 45:
-                rula_score += 2
-            elif shoulder_elv < 90:
-                rula_score += 3
-            else:
-                rula_score += 4
-
-            # add 1 if upper arm is abducted
-            # we consider arm abducted if elv_angle is < 45 and > -45, and shoulder_elv > 30
-            if -60 > elv_angle < 60 and shoulder_elv > 30:
-                rula_score += 1
-
-            # lower arm flexion
-            if 60 < elbow_flexion < 100:
-                rula_score += 1
-            else:
-                rula_score += 2
-
-            # if lower arm is working across midline or out to the side add 1
-            # according to MoBL model, shoulder is 17cm from thorax on z axis (osim coord system), we use that value:
-            if end_effector[2] + 17 < 0 or end_effector[2] > 0:
-                rula_score += 1
-
-            # wrist is always 1, due to fixed neutral position
-            rula_score += 1
-
-            pose_database.set_pose_rula(self.conn, pose[0], rula_score)
-            self.conn.commit()
+        self.update_metrics(['rula'])
 
-    def optimal_position_in_polygon(self, polygon):
+    def optimal_position_in_polygon(self, polygon, level=0, weights=None):
         metric = 'weighted_metrics'
-        sql = '''SELECT voxels.id, voxels.x, voxels.y, voxels.z, arm_poses.arm_pose_id, MIN({}), arm_poses.reserve
-                 FROM voxels LEFT OUTER JOIN arm_poses ON arm_poses.voxel_id = voxels.id
-                 GROUP BY voxels.id'''.format(metric)
-
-        cursor = pose_database.custom_query(self.conn, sql, [])
-        voxels = cursor.fetchall()
-
-        polygon = np.array(polygon)
-        hull = ConvexHull(polygon.reshape([8, 3]))
-        in_spec = []
-        for voxel in voxels:
-            if voxel[5] is None:
-                continue
-            pos = (voxel[1], voxel[2], voxel[3])
-            if self.point_in_polygon(hull, pos):
-                in_spec.append([voxel[1], voxel[2], voxel[3], voxel[5]])
+        check_metric(metric)
+        polygon = np.array(polygon).reshape([8, 3])
+        hull = ConvexHull(polygon)
+        if weights is not None:
+            # voxels with a center in the hull overlap its bounding box, no prefilter is needed in memory
+            voxels = self.get_store().get_voxels_constrained(metric, [], level, weights)[:, [1, 2, 3, 6]]
+            return self.optimal_position_in_hull(hull, voxels)
+
+        # r*-tree prefilter, only voxels that overlap the bounding box of the polygon
+        bbox_sql = 'min_x <= ? AND max_x >= ? AND min_y <= ? AND max_y >= ? AND min_z <= ? AND max_z >= ?'
+        bbox_min = polygon.min(axis=0).tolist()
+        bbox_max = polygon.max(axis=0).tolist()
+        params = [bbox_max[0], bbox_min[0], bbox_max[1], bbox_min[1], bbox_max[2], bbox_min[2]]
+        if self.has_levels:
+            level_sql, level_params = pose_database.get_sql_level(level)
+            bbox_sql += ' AND ' + level_sql
+            params += level_params
+        if pose_database.has_voxel_best_pose(self.conn, metric):
+            sql = '''SELECT voxels.id, voxels.x, voxels.y, voxels.z, voxel_best_pose.arm_pose_id, voxel_best_pose.value,
+                            voxel_best_pose.reserve
+                     FROM voxels CROSS JOIN voxel_best_pose
+                       ON voxel_best_pose.metric = ? AND voxel_best_pose.voxel_id = voxels.id
+                     WHERE {}
+                     ORDER BY voxels.id'''.format(bbox_sql)
+            params = [metric] + params
+        else:
+            sql = '''SELECT voxels.id, voxels.x, voxels.y, voxels.z, arm_poses.arm_pose_id, MIN({}), arm_poses.reserve
+                     FROM voxels LEFT OUTER JOIN arm_poses ON arm_poses.voxel_id = voxels.id
+                     WHERE {}
+                     GROUP BY voxels.id'''.format(metric, bbox_sql)
+
+        rows = pose_database.query_rows(self.conn, sql, params)
+        voxels = [[voxel[1], voxel[2], voxel[3], voxel[5]] for voxel in rows if voxel[5] is not None]
+        return self.optimal_position_in_hull(hull, voxels)
+
+    def optimal_position_in_hull(self, hull, voxels):
+        """ voxel (x, y, z, metric) with the lowest metric among the voxels with a center in the hull """
+        if len(voxels) > 0:
+            voxels = np.array(voxels)
+            in_spec = voxels[linalg.points_in_convex_hull(hull, voxels[:, 0:3])]
+        else:
+            in_spec = []
 
         if len(in_spec) > 0:
-            in_spec = np.array(in_spec)
             in_spec = in_spec[in_spec[:, 3].argsort()]
             self.last_interaction_space = in_spec
             self.is_version += 1
@@ -346,10 +469,13 @@ class XRgonomics:
         `hull` -- a QHull ConvexHull object
         `pnt` -- point array of shape (3,)
         """
-        new_hull = ConvexHull(np.concatenate((polygon.points, [point])))
-        if np.array_equal(new_hull.vertices, polygon.vertices):
-            return True
-        return False
+        return bool(linalg.points_in_convex_hull(polygon, point)[0])
+
+
+def check_metric(metric):
+    """ raises ValueError if metric is not one of query_metrics, before it is formatted into SQL """
+    if metric not in query_metrics:
+        raise ValueError('Unknown metric {!r}, expected one of {}'.format(metric, ', '.join(query_metrics)))
 
 
 def get_sql_constraint(axis, constraint, value):
@@ -366,6 +492,7 @@ def get_sql_constraint(axis, constraint, value):
 
 
 def normalize_comfort_metric(array, comfort_index, metric):
+    since = instrumentation.start()
     array_sorted = np.array([])
     if len(array) > 0:
         array = np.array(array)
@@ -398,9 +525,5 @@ def normalize_comfort_metric(array, comfort_index, metric):
             array_new[:, -1] = array_new[:, -1] * 5 + array_new[:, comfort_index + 1]
         array_sorted = array_new[array_new[:, -1].argsort()]
 
+    instrumentation.stop('normalize', since)
     return array_sorted
-
-
-
-
-
@@ -8,6 +8,11 @@ import exceptions
 
 base_pos = np.array([[0, 0, 0]])
 
+# Values retrieved from the model
+elv_angle_axis = np.array([0.0048, 0.99908918, 0.04240001])
+# Potential source of issues, x-z coordinates are swapped
+shoulder_elv_axis = np.array([-0.99826136, 0.0023, 0.05889802, 1])
+
 
 def compute_elbow_plane(end_effector, arm_proper_length, forearm_hand_length, shoulder=np.array([0, 0, 0])):
     """
@@ -45,35 +50,59 @@ def compute_elbow_plane(end_effector, arm_proper_length, forearm_hand_length, sh
     return u, v, center, radius
 
 
+def interaction_space_limits(arm_proper_length, forearm_hand_length):
+    """ [(-x, x), (-y, y), (-z, z)] limits of the interaction space for compute_interaction_space """
+    arm_total_length = arm_proper_length + forearm_hand_length
+    return [(-15, arm_total_length), (-arm_total_length, arm_total_length),
+            (-arm_proper_length / 2 - forearm_hand_length, arm_total_length)]
+
+
+def interaction_space_axes(spacing, limits):
+    """ Grid coordinates of each axis for compute_interaction_space, starting at the floored lower limit """
+    return [math.floor(low) + spacing * np.arange(math.ceil((high - math.floor(low)) / spacing))
+            for low, high in limits]
+
+
+def iter_interaction_space(spacing, limits, arm_total_length, slab_size=1):
+    """
+    Generator version of compute_interaction_space. Yields (M, 3) arrays of reachable positions, one per slab of
+    slab_size z values, so memory stays bounded for very fine grids. Positions are ordered by z, then y, then x.
+    """
+    xs, ys, zs = interaction_space_axes(spacing, limits)
+    spacing_mag = np.linalg.norm([spacing / 2, spacing / 2, spacing / 2])
+    for start in range(0, len(zs), slab_size):
+        z, y, x = np.meshgrid(zs[start:start + slab_size], ys, xs, indexing='ij')
+        coords = np.column_stack((x.ravel(), y.ravel(), z.ravel()))
+        # validate if is in reach of the user and on the right side of the body
+        reachable = ((coords[:, 0] > 0) | (coords[:, 2] > 0)) & (
+                np.linalg.norm(coords, axis=1) + spacing_mag <= arm_total_length)
+        yield coords[reachable]
+
+
 def compute_interaction_space(spacing, limits, arm_total_length):
     """
     Computes all the positions that are reachable by the arm, apart from each other according to the spacing parameter inside the
     limits in 3D space provided as a list of tuples ([(-x, x), (-y, y), (-z, z)]). For now, consider the coordinate system origin to be
     the right shoulder joint and the x axis is parallel to the line between both shoulders, going positive to the right of the shoulder.
+    Returns an (N, 3) array, see iter_interaction_space to compute it in slabs.
 
     OpenSim uses the standard engineering coordinate system of X forward (Red), Y up (Green), Z right (Blue)
     OpenSim also uses meters, but the example .trc files are in mm (perhaps they just refer to the unit?)
     Right is +z in OpenSim coordinate system
     """
-    current_coords = [math.floor(limits[0][0]), math.floor(limits[1][0]), math.floor(limits[2][0])]
-    interaction_space = []
-    spacing_mag = linalg_helpers.magnitude([spacing / 2, spacing / 2, spacing / 2])
-    while current_coords[2] < limits[2][1]:
-        while current_coords[1] < limits[1][1]:
-            while current_coords[0] < limits[0][1]:
-                # validate if is in reach of the user
-                # validate other conditions
-                if (current_coords[0] > 0 or current_coords[2] > 0) and (
-                        linalg_helpers.magnitude(current_coords) + spacing_mag <= arm_total_length):
-                    interaction_space.append([current_coords[0], current_coords[1], current_coords[2]])
-                current_coords[0] += spacing
+    xs, ys, zs = interaction_space_axes(spacing, limits)
+    # a single slab holds the whole grid
+    slabs = iter_interaction_space(spacing, limits, arm_total_length, slab_size=max(len(zs), 1))
+    return next(slabs, np.empty((0, 3)))
 
-            current_coords[0] = limits[0][0]
-            current_coords[1] += spacing
 
-        current_coords[1] = limits[1][0]
-        current_coords[2] += spacing
-    return interaction_space
+def refine_voxel_origins(origins, spacing):
+    """
+    Origins of the 8 voxels (with spacing / 2) that subdivide each voxel of an (N, 3) array of voxel origins. Returns an
+    (8N, 3) array, the children of each voxel are consecutive and ordered by z, then y, then x.
+    """
+    offsets = np.array([[x, y, z] for z in (0, 1) for y in (0, 1) for x in (0, 1)]) * (spacing / 2)
+    return (np.asarray(origins, dtype=float).reshape(-1, 1, 3) + offsets).reshape(-1, 3)
 
 
 def compute_valid_elbow_positions(end_effector, elbow, elbow_prime, step=5, hand='r'):
@@ -102,11 +131,6 @@ def compute_valid_elbow_positions(end_effector, elbow, elbow_prime, step=5, hand
 
 
 def compute_base_shoulder_rot(elv_angle, shoulder_elv):
-    # Values retrieved from the model
-    elv_angle_axis = np.array([0.0048, 0.99908918, 0.04240001])
-    # Potential source of issues, x-z coordinates are swapped
-    shoulder_elv_axis = np.array([-0.99826136, 0.0023, 0.05889802, 1])
-
     humerus_base_coord = np.identity(4)
 
     # elv_angle is negative, due to OpenSim coordinate system
@@ -131,6 +155,275 @@ def compute_base_shoulder_rot(elv_angle, shoulder_elv):
     return humerus1_base_coord
 
 
+def compute_base_shoulder_rot_batch(elv_angles, shoulder_elvs):
+    """
+    Vectorized compute_base_shoulder_rot. Only the (N, 3, 3) rotation part is returned, since the translation of the
+    homogeneous transform is always zero.
+    """
+    elv_transforms = linalg_helpers.euler_rodrigues_rotation_batch(np.tile(elv_angle_axis, (len(elv_angles), 1)),
+                                                                   elv_angles)
+    # rotation axis of shoulder_elv in the parent coord system (updated with elv_angle)
+    shoulder_angle_axes = elv_transforms @ shoulder_elv_axis[0:3]
+    return linalg_helpers.euler_rodrigues_rotation_batch(shoulder_angle_axes, shoulder_elvs)
+
+
+def compute_elbow_planes(end_effectors, arm_proper_length, forearm_hand_length):
+    """
+    Vectorized compute_elbow_plane for an (N, 3) array of end effectors. Returns u, v, center, radius and a boolean mask
+    with the end effectors that are reachable with a 2-segment arm. Entries outside the mask are meaningless.
+    """
+    end_effectors = np.asarray(end_effectors, dtype=float)
+    a = arm_proper_length
+    b = forearm_hand_length
+    c = np.linalg.norm(end_effectors, axis=1)
+
+    # same conditions as compute_elbow_plane and linalg_helpers.law_of_cosines_angle
+    valid = ~((b > a + c) | (a > b + c) | (c > a + b))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = np.where(c[:, None] == 0, end_effectors, end_effectors / c[:, None])
+
+        y = np.array([0, 1, 0])
+        u = -y + n[:, 1:2] * n
+        u_mag = np.linalg.norm(u, axis=1)
+        u = np.where(u_mag[:, None] == 0, u, u / u_mag[:, None])
+        v = np.cross(n, u)
+
+        cos_beta = np.clip((a ** 2 + c ** 2 - b ** 2) / (2 * a * c), -1, 1)
+        sin_beta = np.sin(np.arccos(cos_beta))
+
+    center = cos_beta[:, None] * arm_proper_length * n
+    radius = sin_beta * arm_proper_length
+
+    return u, v, center, radius, valid
+
+
+def swivel_angles(rotation_step=-math.pi / 8, limit=-math.pi * 3 / 4):
+    # accumulated the same way as in compute_anchor_arm_poses, so both paths sample the exact same angles
+    thetas = []
+    theta = 0
+    while theta > limit:
+        thetas.append(theta)
+        theta += rotation_step
+    return np.array(thetas)
+
+
+def elbow_positions(u, v, center, radius, thetas):
+    """ Elbow positions on the elbow circles (see compute_elbow_planes) at the swivel angles, shapes are broadcast """
+    thetas = np.asarray(thetas, dtype=float)
+    return radius[..., None] * (np.cos(thetas)[..., None] * u + np.sin(thetas)[..., None] * v) + center
+
+
+def within_elv_angle_limit(u, v, center, radius, thetas):
+    """
+    Mask of the swivel angles whose elbow is within the elv_angle joint limit (atan2(elbow_x, elbow_z) <= 130 degrees),
+    shapes are broadcast as in elbow_positions. elbow_x and elbow_z are sinusoids of the swivel angle, so the limit is
+    checked on the elbow circle without solving the poses: the elbow is beyond the limit if elbow_x >= 0 and it is past
+    the 130 degrees half-plane of the x-z plane.
+    """
+    thetas = np.asarray(thetas, dtype=float)
+    cos_theta = np.cos(thetas)
+    sin_theta = np.sin(thetas)
+    # elbow_x and the signed distance to the 130 degrees half-plane
+    x = radius * (cos_theta * u[..., 0] + sin_theta * v[..., 0]) + center[..., 0]
+    z = radius * (cos_theta * u[..., 2] + sin_theta * v[..., 2]) + center[..., 2]
+    beyond = x * math.cos(math.radians(130)) - z * math.sin(math.radians(130))
+    return ~((x >= 0) & (beyond > 0))
+
+
+def sinusoid_roots(a, b, c, lower):
+    """ (N, 2) roots of a cos(theta) + b sin(theta) + c in [lower, lower + 2pi), nan if there are none """
+    amplitude = np.hypot(a, b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.arccos(-c / amplitude)
+    roots = np.arctan2(b, a)[:, None] + np.stack((offset, -offset), axis=1)
+    return lower[:, None] + np.mod(roots - lower[:, None], 2 * math.pi)
+
+
+def feasible_swivel_segments(u, v, center, radius, lower, upper):
+    """
+    Splits [lower, upper] of each of the N elbow circles in the segments between the swivel angles where the elv_angle
+    joint limit is crossed, that is where elbow_x or the distance to the 130 degrees half-plane (see
+    within_elv_angle_limit) change sign. Returns the (N, 6) sorted bounds of the segments and the (N, 5) mask of the
+    segments within the limit. Empty segments are within the limit.
+    """
+    lower = np.asarray(lower, dtype=float)
+    upper = np.asarray(upper, dtype=float)
+    cos_limit = math.cos(math.radians(130))
+    sin_limit = math.sin(math.radians(130))
+    x = radius[:, None] * np.stack((u[:, 0], v[:, 0]), axis=1)
+    z = radius[:, None] * np.stack((u[:, 2], v[:, 2]), axis=1)
+    roots = np.hstack((sinusoid_roots(x[:, 0], x[:, 1], center[:, 0], lower),
+                       sinusoid_roots(x[:, 0] * cos_limit - z[:, 0] * sin_limit,
+                                      x[:, 1] * cos_limit - z[:, 1] * sin_limit,
+                                      center[:, 0] * cos_limit - center[:, 2] * sin_limit, lower)))
+    # roots beyond upper (and missing ones) become empty segments
+    roots = np.where(roots < upper[:, None], roots, upper[:, None])
+    bounds = np.sort(np.hstack((lower[:, None], roots, upper[:, None])), axis=1)
+
+    midpoints = (bounds[:, :-1] + bounds[:, 1:]) / 2
+    feasible = within_elv_angle_limit(u[:, None], v[:, None], center[:, None], radius[:, None], midpoints)
+    feasible |= bounds[:, 1:] == bounds[:, :-1]
+    return bounds, feasible
+
+
+def feasible_swivel_interval(u, v, center, radius, thetas, lower, upper):
+    """
+    Largest interval within [lower, upper] around each of the N swivel angles (which must be within the joint limits)
+    whose swivel angles are all within the elv_angle joint limit: the feasible_swivel_segments next to the segment of
+    the swivel angle are merged while they are within the limit.
+    """
+    bounds, feasible = feasible_swivel_segments(u, v, center, radius, lower, upper)
+    segments = feasible.shape[1]
+    segment = np.clip((bounds[:, 1:-1] <= thetas[:, None]).sum(axis=1), 0, segments - 1)
+    rows = np.arange(len(thetas))
+    first = segment.copy()
+    last = segment.copy()
+    for _ in range(segments - 1):
+        first = np.where((first > 0) & feasible[rows, np.maximum(first - 1, 0)], first - 1, first)
+        last = np.where((last < segments - 1) & feasible[rows, np.minimum(last + 1, segments - 1)], last + 1, last)
+    return bounds[rows, first], bounds[rows, last + 1]
+
+
+def solve_arm_poses(end_effectors, elbows, arm_proper_length, forearm_hand_length):
+    """ Joint angles (osim, in degrees) of N poses, given their (N, 3) end effector and elbow positions """
+    elv_angles = np.arctan2(elbows[:, 0], elbows[:, 2])
+
+    # both values are normalized
+    cos_elv = np.cos(elv_angles)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s2 = np.where(np.abs(cos_elv) <= 1e-5,
+                      elbows[:, 0] / (np.sin(elv_angles) * arm_proper_length),
+                      elbows[:, 2] / (cos_elv * arm_proper_length))
+    shoulder_elvs = np.arctan2(s2, -elbows[:, 1] / arm_proper_length)
+
+    c_mag = np.linalg.norm(end_effectors, axis=1)
+    cos_gamma = np.clip((arm_proper_length ** 2 + forearm_hand_length ** 2 - c_mag ** 2) /
+                        (2 * arm_proper_length * forearm_hand_length), -1, 1)
+    elbow_flexions_osim = 180 - np.degrees(np.arccos(cos_gamma))
+
+    # humerus transform is a rotation, the inverse is its transpose
+    humerus_rotations = compute_base_shoulder_rot_batch(elv_angles, shoulder_elvs)
+    points = np.einsum('nji,nj->ni', humerus_rotations, end_effectors - elbows)
+    shoulder_rots = -np.degrees(np.arctan2(points[:, 2], points[:, 0]))
+
+    return {'elbow_x': elbows[:, 0], 'elbow_y': elbows[:, 1], 'elbow_z': elbows[:, 2],
+            'elv_angle': np.degrees(elv_angles), 'shoulder_elv': np.degrees(shoulder_elvs),
+            'shoulder_rot': shoulder_rots, 'elbow_flexion': elbow_flexions_osim}
+
+
+def solve_swivel_arm_poses(end_effectors, swivel_angles, arm_proper_length, forearm_hand_length):
+    """ Poses (solve_arm_poses format) of N end effectors at one swivel angle each, e.g. the poses of a compact database
+    (see pose_database.get_pose_columns) """
+    end_effectors = np.asarray(end_effectors, dtype=float).reshape(-1, 3)
+    u, v, c, r, _ = compute_elbow_planes(end_effectors, arm_proper_length, forearm_hand_length)
+    elbows = elbow_positions(u, v, c, r, swivel_angles)
+    return solve_arm_poses(end_effectors, elbows, arm_proper_length, forearm_hand_length)
+
+
+def compute_anchor_arm_poses_batch(end_effectors, arm_proper_length, forearm_hand_length,
+                                   rotation_step=-math.pi / 8, limit=-math.pi * 3 / 4):
+    """
+    Batched version of compute_anchor_arm_poses for an (N, 3) array of end effectors. Returns a dict of 1D arrays, one
+    entry per valid pose, ordered by end effector and then by swivel angle (same order as calling
+    compute_anchor_arm_poses for each end effector). 'voxel_index' holds the row of the end effector of each pose.
+    Unreachable end effectors and swivel angles beyond the joint limits are rejected before any pose is solved.
+    """
+    end_effectors = np.asarray(end_effectors, dtype=float).reshape(-1, 3)
+    u, v, c, r, valid = compute_elbow_planes(end_effectors, arm_proper_length, forearm_hand_length)
+    thetas = swivel_angles(rotation_step, limit)
+
+    reachable = np.flatnonzero(valid)
+    keep = within_elv_angle_limit(u[reachable, None], v[reachable, None], c[reachable, None], r[reachable, None],
+                                  thetas[None, :])
+    row, theta_index = np.nonzero(keep)
+    voxel_index = reachable[row]
+
+    elbows = elbow_positions(u[voxel_index], v[voxel_index], c[voxel_index], r[voxel_index], thetas[theta_index])
+    poses = solve_arm_poses(end_effectors[voxel_index], elbows, arm_proper_length, forearm_hand_length)
+    poses.update(voxel_index=voxel_index, swivel_angle=thetas[theta_index])
+    return poses
+
+
+def swivel_angle_costs(end_effectors, planes, thetas, cost):
+    """ cost(end_effectors, elbows) at one swivel angle per end effector, inf beyond the joint limits """
+    u, v, c, r, valid = planes
+    values = cost(end_effectors, elbow_positions(u, v, c, r, thetas))
+    return np.where(valid & within_elv_angle_limit(u, v, c, r, thetas), values, np.inf)
+
+
+def minimize_swivel_angles(end_effectors, arm_proper_length, forearm_hand_length, lower, upper, cost, iterations=20):
+    """
+    Golden-section search of the swivel angle in [lower, upper] that minimizes cost(end_effectors, elbows) for each of
+    the (N, 3) end effectors, all of them at once. Angles beyond the joint limits cost inf. The interval shrinks by
+    0.618 every iteration (one cost evaluation per end effector). Returns the swivel angles and their cost, the cost is
+    inf if no angle within the joint limits was found.
+    """
+    end_effectors = np.asarray(end_effectors, dtype=float).reshape(-1, 3)
+    planes = compute_elbow_planes(end_effectors, arm_proper_length, forearm_hand_length)
+
+    def evaluate(thetas):
+        return swivel_angle_costs(end_effectors, planes, thetas, cost)
+
+    ratio = (math.sqrt(5) - 1) / 2
+    a = np.asarray(lower, dtype=float)
+    b = np.asarray(upper, dtype=float)
+    x1 = b - ratio * (b - a)
+    x2 = a + ratio * (b - a)
+    f1 = evaluate(x1)
+    f2 = evaluate(x2)
+    for _ in range(iterations):
+        # the minimum is in [a, x2] if f1 <= f2, in [x1, b] otherwise
+        left = f1 <= f2
+        a = np.where(left, a, x1)
+        b = np.where(left, x2, b)
+        x = np.where(left, b - ratio * (b - a), a + ratio * (b - a))
+        f = evaluate(x)
+        x1, f1, x2, f2 = (np.where(left, x, x2), np.where(left, f, f2),
+                          np.where(left, x1, x), np.where(left, f1, f))
+
+    thetas = (a + b) / 2
+    return thetas, evaluate(thetas)
+
+
+def refine_anchor_arm_poses(end_effectors, swivel_angles_best, costs_best, arm_proper_length, forearm_hand_length,
+                            cost, rotation_step=-math.pi / 8, limit=-math.pi * 3 / 4, iterations=20):
+    """
+    Refinement of the best sampled swivel angle of each of the (N, 3) end effectors: the minimum of cost is searched
+    (see minimize_swivel_angles) between the neighbouring samples, as far as the joint limits allow, and in every
+    segment of the swivel range within the joint limits (see feasible_swivel_segments), since segments narrower than
+    rotation_step can be missed by the samples. The bounds of the segments (e.g. the end of the swivel range, which is
+    never sampled) are candidates too. Returns the poses that are better than the sampled ones, in the
+    compute_anchor_arm_poses_batch format, with an additional 'cost'.
+    """
+    end_effectors = np.asarray(end_effectors, dtype=float).reshape(-1, 3)
+    planes = compute_elbow_planes(end_effectors, arm_proper_length, forearm_hand_length)
+    u, v, c, r, _ = planes
+    step = abs(rotation_step)
+    intervals = [feasible_swivel_interval(u, v, c, r, swivel_angles_best, np.maximum(swivel_angles_best - step, limit),
+                                          np.minimum(swivel_angles_best + step, 0))]
+    bounds, feasible = feasible_swivel_segments(u, v, c, r, np.full(len(end_effectors), limit),
+                                                np.zeros(len(end_effectors)))
+    intervals += [(bounds[:, i], bounds[:, i + 1]) for i in range(feasible.shape[1]) if feasible[:, i].any()]
+
+    candidates = [minimize_swivel_angles(end_effectors, arm_proper_length, forearm_hand_length, lower, upper, cost,
+                                         iterations) for lower, upper in intervals]
+    candidates += [(bound, swivel_angle_costs(end_effectors, planes, bound, cost)) for bound in bounds.T]
+
+    thetas = np.zeros(len(end_effectors))
+    costs = np.full(len(end_effectors), np.inf)
+    for candidate_thetas, candidate_costs in candidates:
+        better = candidate_costs < costs
+        thetas[better] = candidate_thetas[better]
+        costs[better] = candidate_costs[better]
+
+    voxel_index = np.flatnonzero(costs < costs_best)
+    elbows = elbow_positions(u[voxel_index], v[voxel_index], c[voxel_index], r[voxel_index], thetas[voxel_index])
+    poses = solve_arm_poses(end_effectors[voxel_index], elbows, arm_proper_length, forearm_hand_length)
+    poses.update(voxel_index=voxel_index, swivel_angle=thetas[voxel_index], cost=costs[voxel_index])
+    return poses
+
+
 def compute_anchor_arm_poses(end_effector, arm_proper_length, forearm_hand_length,
                              rotation_step=-math.pi / 8, limit=-math.pi * 3 / 4, model=None):
     arm_poses = []
@@ -167,7 +460,8 @@ def compute_anchor_arm_poses(end_effector, arm_proper_length, forearm_hand_lengt
                                                             linalg_helpers.magnitude(end_effector), radians=False)
         elbow_flexion_osim = 180 - elbow_flexion
 
-        humerus_transform = np.linalg.inv(compute_base_shoulder_rot(elv_angle, shoulder_elv))
+        # pure rotation (no translation), the inverse is the transpose
+        humerus_transform = compute_base_shoulder_rot(elv_angle, shoulder_elv).T
         forearm_vector = end_effector - elbow_pos
         point = humerus_transform @ np.array([forearm_vector[0], forearm_vector[1], forearm_vector[2], 1])
         shoulder_rot = -math.degrees(math.atan2(point[2], point[0]))
@@ -0,0 +1,284 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import arm_position
+import arm_position_helpers as armpos
+import build_pipeline
+import pose_database
+
+# metrics queried by the toolkit benchmark, weighted_metrics is computed before the queries
+query_metrics = ['consumed_endurance', 'rula', 'weighted_metrics']
+
+
+def measure(function, repeat=5):
+    """ runs function repeat times, returns the timings in seconds """
+    timings = []
+    for _ in range(repeat):
+        since = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - since)
+    return summarize(timings)
+
+
+def summarize(timings):
+    timings = np.asarray(timings, dtype=float)
+    return {
+        'runs': len(timings),
+        'min': float(timings.min()),
+        'median': float(np.median(timings)),
+        'mean': float(timings.mean()),
+        'p99': float(np.percentile(timings, 99)),
+        'max': float(timings.max())
+    }
+
+
+def environment():
+    """ identifies the code and the machine the results come from """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'build_version': arm_position.build_version,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+
+def polygon_around(center, size):
+    """ 8 corners of a cube around center, in the format of optimal_position_in_polygon """
+    return [[center[0] + x, center[1] + y, center[2] + z] for x in (-size, size) for y in (-size, size)
+            for z in (-size, size)]
+
+
+def benchmark_toolkit(directory, arm_proper_length, forearm_hand_length, spacing, engine='sql', workers=1, repeat=5,
+                      samples=20, seed=0):
+    """ timings of the build steps and of the queries of one database """
+    rng = np.random.default_rng(seed)
+    results = {}
+    limits = armpos.interaction_space_limits(arm_proper_length, forearm_hand_length)
+    arm_total_length = arm_proper_length + forearm_hand_length
+    results['compute_interaction_space'] = measure(
+        lambda: armpos.compute_interaction_space(spacing, limits, arm_total_length), repeat)
+
+    centers = armpos.compute_interaction_space(spacing, limits, arm_total_length) + spacing / 2
+    sample = centers[rng.choice(len(centers), min(samples, len(centers)), replace=False)]
+    results['compute_anchor_arm_poses'] = measure(
+        lambda: [armpos.compute_anchor_arm_poses(center, arm_proper_length, forearm_hand_length) for center in sample],
+        repeat)
+    results['compute_anchor_arm_poses']['voxels'] = len(sample)
+    results['compute_anchor_arm_poses_batch'] = measure(
+        lambda: armpos.compute_anchor_arm_poses_batch(centers, arm_proper_length, forearm_hand_length), repeat)
+    results['compute_anchor_arm_poses_batch']['voxels'] = len(centers)
+    results['compute_chunk.swivel_refinement'] = measure(
+        lambda: build_pipeline.compute_chunk(centers, arm_proper_length, forearm_hand_length, swivel_refinement=12),
+        repeat)
+    results['compute_chunk.swivel_refinement']['voxels'] = len(centers)
+
+    database = os.path.join(directory, 'benchmark_{}_{}_{}.db'.format(arm_proper_length, forearm_hand_length, spacing))
+    since = time.perf_counter()
+    toolkit = arm_position.XRgonomics(database, arm_proper_length, forearm_hand_length, spacing, engine=engine,
+                                      workers=workers)
+    results['build_database'] = summarize([time.perf_counter() - since])
+    results['build_database'].update(voxels=pose_database.count_voxels(toolkit.conn),
+                                     poses=pose_database.count_poses(toolkit.conn))
+    results['compute_weigthed_metrics'] = measure(toolkit.compute_weigthed_metrics, 1)
+
+    for metric in query_metrics:
+        results['get_voxels_constrained.' + metric] = measure(
+            lambda: toolkit.get_voxels_constrained(metric, []), repeat)
+    results['get_voxels_constrained.constrained'] = measure(
+        lambda: toolkit.get_voxels_constrained('consumed_endurance', [{'axis': 1, 'constraint': '>=', 'value': 0},
+                                                                      {'axis': 2, 'constraint': '<=', 'value': 30}]),
+        repeat)
+    results['get_voxels_constrained.custom_weights'] = measure(
+        lambda: toolkit.get_voxels_constrained('weighted_metrics', [], weights={'consumed_endurance': 0.7,
+                                                                                'rula': 0.3}), repeat)
+
+    voxels = np.array(pose_database.get_all_voxels(toolkit.conn), dtype=float).reshape(-1, 4)
+    points = voxels[rng.choice(len(voxels), min(samples, len(voxels)), replace=False), 1:4].tolist()
+    results['get_voxel_poses'] = measure(
+        lambda: [toolkit.get_voxel_poses(*point, 'consumed_endurance') for point in points], repeat)
+    results['get_voxel_poses']['queries'] = len(points)
+    results['optimal_position_in_polygon'] = measure(
+        lambda: [toolkit.optimal_position_in_polygon(polygon_around(point, spacing)) for point in points], repeat)
+    results['optimal_position_in_polygon']['queries'] = len(points)
+
+    # legacy staged build, on the same database (queries are over)
+    pose_database.drop_tables(toolkit.conn)
+    toolkit.initialize_pose_db(arm_proper_length, forearm_hand_length, spacing)
+    results['compute_all_arm_pos'] = measure(toolkit.compute_all_arm_pos, 1)
+    results['compute_consumed_endurance'] = measure(toolkit.compute_consumed_endurance, 1)
+    results['compute_rula'] = measure(toolkit.compute_rula, 1)
+    toolkit.conn.close()
+    return results
+
+
+def run_toolkit(args):
+    runs = []
+    with tempfile.TemporaryDirectory() as directory:
+        for arm_proper_length, forearm_hand_length in args.arms:
+            for spacing in args.spacings:
+                for engine in args.engines:
+                    print('Benchmarking arm {}/{}, spacing {}, engine {}'.format(arm_proper_length, forearm_hand_length,
+                                                                              spacing, engine))
+                    results = benchmark_toolkit(directory, arm_proper_length, forearm_hand_length, spacing, engine,
+                                                args.workers, args.repeat, args.samples, args.seed)
+                    runs.append({'arm_proper_length': arm_proper_length, 'forearm_hand_length': forearm_hand_length,
+                                 'spacing': spacing, 'engine': engine, 'results': results})
+                    # each configuration builds its own database
+                    os.remove(os.path.join(directory, 'benchmark_{}_{}_{}.db'.format(arm_proper_length,
+                                                                                   forearm_hand_length, spacing)))
+    return {'benchmark': 'toolkit', 'environment': environment(), 'runs': runs}
+
+
+def server_requests(address, timeout):
+    """ requests of the load generator: 'C' for each metric, 'L' and 'P' at positions returned by the server """
+    import zmq
+
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.RCVTIMEO, timeout)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(address)
+    socket.send_multipart([b'C', json.dumps({'metric': 'consumed_endurance', 'constraints': []}).encode('utf-8')])
+    voxels = json.loads(socket.recv())
+    socket.close()
+
+    requests = [[b'C', json.dumps({'metric': metric, 'constraints': []}).encode('utf-8')] for metric in query_metrics]
+    requests.append([b'C', json.dumps({'metric': 'weighted_metrics', 'constraints': [],
+                                       'weights': {'consumed_endurance': 0.7, 'rula': 0.3}}).encode('utf-8')])
+    requests.append([b'L'])
+    for voxel in voxels[:10]:
+        requests.append([b'P', json.dumps({'x': voxel['position'][0], 'y': voxel['position'][1],
+                                           'z': voxel['position'][2],
+                                           'metric': 'consumed_endurance'}).encode('utf-8')])
+    return requests
+
+
+def run_server(args):
+    """ closed loop load generator: every client sends its next request as soon as it gets the previous reply """
+    import zmq
+
+    requests = server_requests(args.address, args.timeout)
+    latencies = {}
+    errors = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def client(index):
+        socket = zmq.Context.instance().socket(zmq.REQ)
+        socket.setsockopt(zmq.RCVTIMEO, args.timeout)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(args.address)
+        rng = np.random.default_rng(args.seed + index)
+        own = {}
+        try:
+            while time.perf_counter() < deadline:
+                request = requests[rng.integers(len(requests))]
+                since = time.perf_counter()
+                socket.send_multipart(request)
+                socket.recv_multipart()
+                own.setdefault(request[0].decode('utf-8'), []).append(time.perf_counter() - since)
+        except zmq.Again:
+            with lock:
+                errors.append('client {} timed out'.format(index))
+        finally:
+            socket.close()
+            with lock:
+                for operation, timings in own.items():
+                    latencies.setdefault(operation, []).extend(timings)
+
+    since = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(index,)) for index in range(args.clients)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - since
+
+    all_latencies = [latency for timings in latencies.values() for latency in timings]
+    results = {'all': summarize(all_latencies)} if all_latencies else {}
+    results.update({operation: summarize(timings) for operation, timings in latencies.items()})
+    for summary in results.values():
+        summary['p50'] = summary['median']
+    return {'benchmark': 'server', 'environment': environment(), 'address': args.address, 'clients': args.clients,
+            'duration': elapsed, 'requests': len(all_latencies), 'throughput': len(all_latencies) / elapsed,
+            'errors': errors, 'results': results}
+
+
+def flatten(report):
+    """ {(configuration, benchmark): median seconds} of a report """
+    if report['benchmark'] == 'server':
+        return {('server', name): result['median'] for name, result in report['results'].items()}
+    return {('{arm_proper_length}/{forearm_hand_length} spacing {spacing} {engine}'.format(**run), name):
+            result['median'] for run in report['runs'] for name, result in run['results'].items()}
+
+
+def run_compare(args):
+    with open(args.baseline) as baseline, open(args.current) as current:
+        baseline, current = flatten(json.load(baseline)), flatten(json.load(current))
+    for key in sorted(set(baseline) & set(current)):
+        ratio = current[key] / baseline[key] if baseline[key] > 0 else float('inf')
+        flag = ' <- slower' if ratio > 1 + args.threshold else ''
+        print('{:<40} {:<45} {:>10.4f}s {:>10.4f}s {:>7.2f}x{}'.format(key[0], key[1], baseline[key], current[key],
+                                                                      ratio, flag))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='XRgonomics benchmarks, results are written as JSON')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    toolkit = subparsers.add_parser('toolkit', help='build steps and queries of XRgonomics')
+    toolkit.add_argument('--spacings', type=float, nargs='+', default=[10, 5])
+    toolkit.add_argument('--arms', nargs='+', default=['33,46', '30,40'],
+                         help='arm_proper_length,forearm_hand_length pairs')
+    toolkit.add_argument('--engines', nargs='+', choices=['sql', 'memory', 'snapshot'], default=['sql', 'memory'])
+    toolkit.add_argument('--workers', type=int, default=1, help='processes of the database builds')
+    toolkit.add_argument('--repeat', type=int, default=5)
+    toolkit.add_argument('--samples', type=int, default=20, help='number of voxels of the per voxel benchmarks')
+    toolkit.add_argument('--seed', type=int, default=0)
+    toolkit.add_argument('--output', default='benchmark_toolkit.json')
+
+    server = subparsers.add_parser('server', help='ZeroMQ load generator against a running server.py')
+    server.add_argument('--address', default='tcp://localhost:5555')
+    server.add_argument('--clients', type=int, default=4)
+    server.add_argument('--duration', type=float, default=10, help='seconds')
+    server.add_argument('--timeout', type=int, default=10000, help='reply timeout in milliseconds')
+    server.add_argument('--seed', type=int, default=0)
+    server.add_argument('--output', default='benchmark_server.json')
+
+    compare = subparsers.add_parser('compare', help='compares the median timings of two result files')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.1, help='relative slowdown that is flagged')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        run_compare(args)
+        return
+    if args.command == 'toolkit':
+        args.arms = [tuple(float(length) for length in arm.split(',')) for arm in args.arms]
+        report = run_toolkit(args)
+    else:
+        report = run_server(args)
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import arm_position_helpers as armpos
+import comfort_metrics
+import pose_database
+
+
+def voxel_rows(origins, spacing):
+    """ (N, 9) voxel rows in the insert_voxel format (bounds and center) for an (N, 3) array of voxel origins """
+    origins = np.asarray(origins).reshape(-1, 3)
+    rows = np.empty((len(origins), 9), dtype=np.result_type(origins, spacing, 0.5))
+    rows[:, 0:6:2] = origins
+    rows[:, 1:6:2] = origins + spacing
+    rows[:, 6:9] = origins + spacing / 2
+    return rows
+
+
+def compute_chunk(centers, arm_proper_length, forearm_hand_length, swivel_step=math.pi / 8, swivel_refinement=0):
+    """
+    Runs in the worker processes: solves the arm poses of a chunk of voxel centers and scores them. Returns the
+    voxel_index (row in the chunk) of every pose, the pose columns in the insert_scored_arm_poses order, without ids,
+    and the swivel angles of the poses.
+    The elbow circle is sampled every swivel_step radians. If swivel_refinement is set, the swivel angle with the lowest
+    consumed endurance of each voxel is refined by that many golden-section iterations, and the refined pose is added
+    if it is better than the sampled ones.
+    """
+    poses = armpos.compute_anchor_arm_poses_batch(centers, arm_proper_length, forearm_hand_length,
+                                                  rotation_step=-swivel_step)
+    end_effectors = centers[poses['voxel_index']]
+    elbows = np.column_stack((poses['elbow_x'], poses['elbow_y'], poses['elbow_z']))
+    consumed_endurance = comfort_metrics.consumed_endurance(end_effectors, elbows, arm_proper_length,
+                                                            forearm_hand_length)
+
+    if swivel_refinement > 0:
+        # lowest consumed endurance of every voxel (the first pose of ties, poses are ordered by voxel), voxels
+        # without sampled poses are refined too, their swivel range may be narrower than swivel_step
+        best_consumed_endurance = np.full(len(centers), np.inf)
+        best_swivel_angles = np.zeros(len(centers))
+        order = np.lexsort((consumed_endurance, poses['voxel_index']))
+        voxel_index, first = np.unique(poses['voxel_index'][order], return_index=True)
+        best_consumed_endurance[voxel_index] = consumed_endurance[order[first]]
+        best_swivel_angles[voxel_index] = poses['swivel_angle'][order[first]]
+        refined = armpos.refine_anchor_arm_poses(
+            centers, best_swivel_angles, best_consumed_endurance, arm_proper_length, forearm_hand_length,
+            lambda effectors, elbows: comfort_metrics.consumed_endurance(effectors, elbows, arm_proper_length,
+                                                                         forearm_hand_length),
+            rotation_step=-swivel_step, iterations=swivel_refinement)
+        consumed_endurance = np.concatenate((consumed_endurance, refined.pop('cost')))
+        # refined poses take their place in the swivel angle order of their voxel
+        order = np.lexsort((-np.concatenate((poses['swivel_angle'], refined['swivel_angle'])),
+                            np.concatenate((poses['voxel_index'], refined['voxel_index']))))
+        poses = {key: np.concatenate((poses[key], refined[key]))[order] for key in poses}
+        consumed_endurance = consumed_endurance[order]
+        end_effectors = centers[poses['voxel_index']]
+
+    rula = comfort_metrics.rula(end_effectors, poses['elv_angle'], poses['shoulder_elv'], poses['elbow_flexion'])
+    columns = [poses['elbow_x'], poses['elbow_y'], poses['elbow_z'], poses['elv_angle'], poses['shoulder_elv'],
+               poses['shoulder_rot'], poses['elbow_flexion'], consumed_endurance, rula]
+    return poses['voxel_index'], columns, poses['swivel_angle']
+
+
+def comfort_gradient(origins, spacing, values):
+    """
+    Largest absolute difference between the value of each voxel and the values of its 6 face neighbours (voxels of the
+    same grid, with the same spacing). Missing neighbours and nan values are ignored, voxels without any are 0.
+    """
+    origins = np.asarray(origins, dtype=float).reshape(-1, 3)
+    gradient = np.zeros(len(origins))
+    if len(origins) == 0:
+        return gradient
+
+    grid = np.rint((origins - origins.min(axis=0)) / spacing).astype(np.int64)
+    # one extra cell per axis, so the neighbours outside the grid never alias an existing voxel
+    shape = grid.max(axis=0) + 2
+    keys = grid[:, 0] + shape[0] * (grid[:, 1] + shape[1] * grid[:, 2])
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    for step in (1, -1, shape[0], -shape[0], shape[0] * shape[1], -shape[0] * shape[1]):
+        position = np.clip(np.searchsorted(sorted_keys, keys + step), 0, len(keys) - 1)
+        neighbour = order[position]
+        found = sorted_keys[position] == keys + step
+        with np.errstate(invalid='ignore'):
+            difference = np.abs(values - values[neighbour])
+        found &= ~np.isnan(difference)
+        gradient[found] = np.maximum(gradient[found], difference[found])
+    return gradient
+
+
+def overlaps_polygons(voxels, polygons):
+    """ Mask of the voxel rows (insert_voxel format) that overlap the bounding box of any of the polygons """
+    mask = np.zeros(len(voxels), dtype=bool)
+    for polygon in polygons:
+        polygon = np.asarray(polygon, dtype=float).reshape(-1, 3)
+        bbox_min = polygon.min(axis=0)
+        bbox_max = polygon.max(axis=0)
+        mask |= np.all((voxels[:, 0:6:2] <= bbox_max) & (voxels[:, 1:6:2] >= bbox_min), axis=1)
+    return mask
+
+
+def build_parameters(arm_proper_length, forearm_hand_length, spacing, levels=0, refine_threshold=2.0,
+                     refine_polygons=(), build_version=None, swivel_step=math.pi / 8, swivel_refinement=0,
+                     compact=False):
+    """ parameters of build_database that change the database, stored as JSON in its 'build_parameters' metadata """
+    polygons = [np.asarray(polygon, dtype=float).tolist() for polygon in refine_polygons]
+    return {'arm_proper_length': arm_proper_length, 'forearm_hand_length': forearm_hand_length, 'spacing': spacing,
+            'levels': levels, 'refine_threshold': refine_threshold, 'refine_polygons': polygons,
+            'build_version': build_version, 'swivel_step': swivel_step, 'swivel_refinement': swivel_refinement,
+            'compact': compact}
+
+
+def load_checkpoint(conn, parameters):
+    """ checkpoint of an interrupted build with the same parameters, None if the build has to start over """
+    checkpoint = pose_database.get_metadata(conn, 'build_checkpoint')
+    if checkpoint is None or pose_database.get_metadata(conn, 'build_parameters') != parameters:
+        return None
+    return json.loads(checkpoint)
+
+
+def save_checkpoint(conn, level, voxels_done):
+    """ records the progress of the build and commits everything written so far """
+    pose_database.set_metadata(conn, 'build_checkpoint', json.dumps({'level': level, 'voxels_done': voxels_done}))
+    conn.commit()
+
+
+def build_database(conn, arm_proper_length, forearm_hand_length, spacing, workers=1, chunk_size=2048,
+                   progress=None, levels=0, refine_threshold=2.0, refine_polygons=(), partial_results=None,
+                   build_version=None, swivel_step=math.pi / 8, swivel_refinement=0, compact=False):
+    """
+    Builds the voxels and arm_poses tables (with consumed endurance and rula) of a database. The voxel grid is split in
+    chunks of chunk_size voxels that are solved and scored by a pool of worker processes, results are written in chunk
+    order by this process. Voxel and pose ids are assigned here, so the database does not depend on the number of
+    workers. progress is called with (voxels done, total voxels) after every chunk, the total grows as refinement
+    levels are added. partial_results is called with (voxel ids, voxel centers, number of poses, best consumed
+    endurance) of every chunk, so clients can show the reachable space before the build is over.
+    levels -- number of refinement levels. Voxels of a level are subdivided in 8 voxels of the next level (with half the
+    spacing) if the best consumed endurance of their neighbours differs by refine_threshold or more, or if they overlap
+    the bounding box of one of the refine_polygons
+    swivel_step, swivel_refinement -- resolution of the swivel angles of the poses and golden-section iterations of
+    the best swivel angle of each voxel, see compute_chunk. A coarse swivel_step with refinement stores fewer poses with
+    better optima than a fine swivel_step
+    compact -- store the poses in the compact layout of pose_database.create_tables, their swivel angle instead of the
+    elbow position and joint angles, with the arm dimensions in the metadata
+    A checkpoint is committed after every chunk. If the database holds the checkpoint of an interrupted build with the
+    same parameters (and build_version) the build resumes from it, otherwise existing tables are dropped. The result is
+    the same as an uninterrupted build. Builds should not use an in-memory journal, or interrupted builds can leave a
+    corrupted database.
+    """
+    parameters = json.dumps(build_parameters(arm_proper_length, forearm_hand_length, spacing, levels, refine_threshold,
+                                             refine_polygons, build_version, swivel_step, swivel_refinement, compact),
+                            sort_keys=True)
+    checkpoint = load_checkpoint(conn, parameters)
+    if checkpoint is None:
+        pose_database.drop_tables(conn)
+        pose_database.create_tables(conn, compact)
+        pose_database.set_metadata(conn, 'build_parameters', parameters)
+        # the derived columns of compact databases are solved with the arm dimensions
+        pose_database.set_metadata(conn, 'arm_proper_length', arm_proper_length)
+        pose_database.set_metadata(conn, 'forearm_hand_length', forearm_hand_length)
+        checkpoint = {'level': 0, 'voxels_done': 0}
+        save_checkpoint(conn, 0, 0)
+
+    origins = armpos.compute_interaction_space(spacing,
+                                               armpos.interaction_space_limits(arm_proper_length, forearm_hand_length),
+                                               arm_proper_length + forearm_hand_length)
+    # voxels of the levels finished before the checkpoint
+    done = pose_database.count_voxels(conn)
+
+    workers = min(workers if workers is not None else os.cpu_count(), -(-len(origins) // chunk_size))
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for level in range(checkpoint['level'], levels + 1):
+            level_spacing = spacing / 2 ** level
+            if level > 0:
+                # voxels of a level are only written once the level is finished, with their refined flag
+                centers = np.array(pose_database.get_refined_voxel_centers(conn, level - 1), dtype=float).reshape(-1, 3)
+                origins = armpos.refine_voxel_origins(centers - level_spacing, level_spacing * 2)
+            voxels = voxel_rows(origins, level_spacing)
+            first_voxel_id = pose_database.get_max_voxel_id(conn) + 1
+            voxel_ids = np.arange(first_voxel_id, first_voxel_id + len(voxels))
+            next_pose_id = pose_database.get_max_arm_pose_id(conn) + 1
+            total = done + len(voxels)
+
+            voxels_done = checkpoint['voxels_done'] if level == checkpoint['level'] else 0
+            best_consumed_endurance = np.full(len(voxels), np.nan)
+            if voxels_done > 0:
+                best = np.array(pose_database.get_min_consumed_endurance_per_voxel(conn, first_voxel_id),
+                                dtype=float).reshape(-1, 2)
+                best_consumed_endurance[best[:, 0].astype(np.int64) - first_voxel_id] = best[:, 1]
+
+            chunks = [slice(start, start + chunk_size) for start in range(voxels_done, len(voxels), chunk_size)]
+            if executor is not None:
+                results = executor.map(compute_chunk, [voxels[chunk, 6:9] for chunk in chunks],
+                                       [arm_proper_length] * len(chunks), [forearm_hand_length] * len(chunks),
+                                       [swivel_step] * len(chunks), [swivel_refinement] * len(chunks))
+            else:
+                results = (compute_chunk(voxels[chunk, 6:9], arm_proper_length, forearm_hand_length, swivel_step,
+                                         swivel_refinement) for chunk in chunks)
+
+            # results arrive in chunk order, whatever the number of workers
+            for chunk, (voxel_index, columns, swivel_angles) in zip(chunks, results):
+                pose_ids = np.arange(next_pose_id, next_pose_id + len(voxel_index))
+                next_pose_id += len(voxel_index)
+                if compact:
+                    rows = zip(pose_ids.tolist(), voxel_ids[chunk][voxel_index].tolist(),
+                               pose_database.quantize_swivel_angles(swivel_angles).tolist(), columns[7].tolist(),
+                               columns[8].tolist())
+                    pose_database.insert_swivel_arm_poses(conn, rows)
+                else:
+                    rows = zip(pose_ids.tolist(), voxel_ids[chunk][voxel_index].tolist(),
+                               *[column.tolist() for column in columns])
+                    pose_database.insert_scored_arm_poses(conn, rows)
+                # fmin ignores the nan of voxels that have no pose yet
+                np.fmin.at(best_consumed_endurance, chunk.start + voxel_index, columns[7])
+                chunk_stop = min(chunk.stop, len(voxels))
+                save_checkpoint(conn, level, chunk_stop)
+                if partial_results is not None:
+                    partial_results(voxel_ids[chunk], voxels[chunk, 6:9],
+                                    np.bincount(voxel_index, minlength=chunk_stop - chunk.start),
+                                    best_consumed_endurance[chunk])
+                if progress is not None:
+                    progress(done + chunk_stop, total)
+            done += len(voxels)
+
+            refined = np.zeros(len(voxels), dtype=bool)
+            if level < levels:
+                refined = comfort_gradient(origins, level_spacing, best_consumed_endurance) >= refine_threshold
+                refined |= overlaps_polygons(voxels, refine_polygons)
+
+            pose_database.insert_voxels_with_ids(conn, [[voxel_id] + voxel + [level, int(is_refined)]
+                                                        for voxel_id, voxel, is_refined in
+                                                        zip(voxel_ids.tolist(), voxels.tolist(), refined.tolist())])
+            save_checkpoint(conn, level + 1, 0)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    pose_database.create_indexes(conn)
+    pose_database.cache_voxels_limits(conn)
+    pose_database.refresh_voxel_best_pose(conn)
+    pose_database.delete_metadata(conn, 'build_checkpoint')
@@ -0,0 +1,122 @@
+import numpy as np
+
+# normalization constants of the metrics (range of the default arm dimensions database)
+consumed_endurance_min = 0.018610636123524517
+consumed_endurance_max = 9.599405943409115
+rula_min = 3
+rula_range = 9
+
+
+def normalize_rows(v):
+    """ Row-wise linalg_helpers.normalize, zero vectors are kept as they are """
+    m = np.linalg.norm(v, axis=1)[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(m == 0, v, v / m)
+
+
+def consumed_endurance(end_effectors, elbows, arm_proper_length, forearm_hand_length):
+    """
+    Consumed endurance (shoulder torque as a percentage of the max strength) of N poses, given the (N, 3) end effector
+    and elbow positions in cm, relative to the shoulder.
+    """
+    # Frievalds arm data for 50th percentile male:
+    # upper arm: length - 33cm; mass - 2.1; distance cg - 13.2
+    # forearm: length - 26.9cm; mass - 1.2; distance cg - 11.7
+    # hand: length - 19.1cm; mass - 0.4; distance cg - 7.0
+
+    # convert to meters
+    end_effectors = np.asarray(end_effectors, dtype=float) / 100
+    elbows = np.asarray(elbows, dtype=float) / 100
+
+    # ehv stands for elbow hand vector
+    ehv_unit = normalize_rows(end_effectors - elbows)
+    elbow_unit = normalize_rows(elbows)
+    # Due to the fact that we lock the hand coordinate (always at 0 degrees), the CoM of the elbow - hand vector
+    # will always be at 17.25cm from the elbow for 50th percent male
+    # 11.7 + 0.25 * 22.2 = 17.25
+    # 17.25 / 46 = 0.375
+    # check appendix B of Consumed Endurance paper for more info
+    d = elbows + ehv_unit * forearm_hand_length * 0.01 * 0.375
+    a = elbow_unit * arm_proper_length * 0.01 * 0.4
+    ad = d - a
+    com = a + 0.43 * ad
+
+    # mass should be adjusted if arm dimensions change
+    # 3.7kg for 50th percentile male, currently a simple heuristic based on arm size.
+    adjusted_mass = (forearm_hand_length + arm_proper_length) / 79 * 3.7
+    torque_shoulder = np.cross(com, adjusted_mass * np.array([0, 9.8, 0]))
+    torque_shoulder_mag = np.linalg.norm(torque_shoulder, axis=1)
+
+    return torque_shoulder_mag / 101.6 * 100
+
+
+def rula(end_effectors, elv_angles, shoulder_elvs, elbow_flexions):
+    """ RULA score of N poses, the arm pose is already computed for osim (angles in degrees) """
+    end_effectors = np.asarray(end_effectors, dtype=float)
+    elv_angles = np.asarray(elv_angles, dtype=float)
+    shoulder_elvs = np.asarray(shoulder_elvs, dtype=float)
+    elbow_flexions = np.asarray(elbow_flexions, dtype=float)
+
+    # upper arm flexion / extension: < 20 -> 1, < 45 -> 2, < 90 -> 3, otherwise 4
+    rula_scores = np.digitize(shoulder_elvs, [20, 45, 90]) + 1
+
+    # add 1 if upper arm is abducted
+    # we consider arm abducted if elv_angle is < 45 and > -45, and shoulder_elv > 30
+    rula_scores += (-60 > elv_angles) & (elv_angles < 60) & (shoulder_elvs > 30)
+
+    # lower arm flexion
+    rula_scores += np.where((60 < elbow_flexions) & (elbow_flexions < 100), 1, 2)
+
+    # if lower arm is working across midline or out to the side add 1
+    # according to MoBL model, shoulder is 17cm from thorax on z axis (osim coord system), we use that value:
+    rula_scores += (end_effectors[:, 2] + 17 < 0) | (end_effectors[:, 2] > 0)
+
+    # wrist is always 1, due to fixed neutral position
+    rula_scores += 1
+
+    return rula_scores
+
+
+def muscle_activation_reserve(muscle_activations, reserves, reserve_threshold=250):
+    # we want to give priority to poses with the lowest reserve values. Hence, we use the max reserve value of all
+    # voxels, where their reserve value is the minimum between all the poses.
+    # voxels that have reserve values among a threshold receive the worst comfort rating (1).
+    return np.asarray(muscle_activations, dtype=float) + np.asarray(reserves, dtype=float) / reserve_threshold
+
+
+# weights of the weighted_metrics column
+default_weights = {'consumed_endurance': 1/3, 'rula': 1/3, 'muscle_activation_reserve': 1/3}
+
+
+def normalized_metrics(consumed_endurances, rulas, muscle_activation_reserves):
+    """ Normalized metrics combined by weighted_metrics. Missing (nan) muscle activation reserves count as 1 """
+    consumed_endurances = np.asarray(consumed_endurances, dtype=float)
+    rulas = np.asarray(rulas, dtype=float)
+    muscle_activation_reserves = np.asarray(muscle_activation_reserves, dtype=float)
+
+    return {
+        'consumed_endurance': (consumed_endurances - consumed_endurance_min) / consumed_endurance_max,
+        'rula': (rulas - rula_min) / rula_range,
+        'muscle_activation_reserve': np.minimum(1, np.nan_to_num(muscle_activation_reserves, nan=1))
+    }
+
+
+def weight_normalized_metrics(normalized, weights=None):
+    """ Weighted sum of normalized_metrics. weights maps metric names to weights, metrics that weigh 0 (or are missing)
+    are ignored, even where they are nan """
+    weights = default_weights if weights is None else weights
+    unknown = set(weights) - set(normalized)
+    if unknown:
+        raise ValueError('Unknown weighted metrics {}'.format(sorted(unknown)))
+
+    result = np.zeros(len(next(iter(normalized.values()))))
+    for name, values in normalized.items():
+        if weights.get(name, 0) != 0:
+            result = result + weights[name] * values
+    return result
+
+
+def weighted_metrics(consumed_endurances, rulas, muscle_activation_reserves, weights=None):
+    """ Weighted sum of the normalized metrics, equally weighted by default """
+    return weight_normalized_metrics(normalized_metrics(consumed_endurances, rulas, muscle_activation_reserves),
+                                     weights)
@@ -0,0 +1,101 @@
+import glob
+import hashlib
+import json
+import os
+
+import arm_position
+import build_pipeline
+import pose_database
+import pose_store
+
+
+class DatabaseCache:
+    """
+    Directory of built databases, addressed by the hash of their build parameters (build_pipeline.build_parameters of
+    the arm dimensions, spacing, refinement levels, pose layout and arm_position.build_version). A database is only
+    reused if it was completely built with the same parameters. The pose layout (see pose_database.create_tables) is
+    part of the key: compact and standard databases of the same profile are separate files. The least recently used
+    databases are removed when the directory holds more than max_databases files or more than max_bytes.
+    """
+
+    def __init__(self, directory='databases', max_databases=20, max_bytes=None):
+        self.directory = directory
+        self.max_databases = max_databases
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def parameters(arm_proper_length, forearm_hand_length, spacing, levels=0, compact=False):
+        """ build parameters of the database of a profile, as stored by arm_position.XRgonomics """
+        return build_pipeline.build_parameters(float(arm_proper_length), float(forearm_hand_length), float(spacing),
+                                               int(levels), build_version=arm_position.build_version,
+                                               compact=bool(compact))
+
+    @staticmethod
+    def key(arm_proper_length, forearm_hand_length, spacing, levels=0, compact=False):
+        parameters = DatabaseCache.parameters(arm_proper_length, forearm_hand_length, spacing, levels, compact)
+        return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    def path(self, arm_proper_length, forearm_hand_length, spacing, levels=0, compact=False):
+        return os.path.join(self.directory, 'xrgonomics_{}.db'.format(
+            self.key(arm_proper_length, forearm_hand_length, spacing, levels, compact)))
+
+    @staticmethod
+    def is_complete(path, parameters=None):
+        """ True if the database was completely built, with parameters if they are given (interpolated databases have
+        no build parameters) """
+        if not os.path.exists(path):
+            return False
+        conn = pose_database.create_connection(path, read_only=True)
+        try:
+            return pose_database.is_build_complete(conn, arm_position.build_version, parameters)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def touch(path):
+        """ marks a database as recently used """
+        if os.path.exists(path):
+            os.utime(path)
+
+    @staticmethod
+    def size(path):
+        """ bytes of a database and of its snapshot """
+        snapshot = pose_store.snapshot_path(path)
+        return os.path.getsize(path) + sum(os.path.getsize(os.path.join(snapshot, name))
+                                           for name in (os.listdir(snapshot) if os.path.isdir(snapshot) else []))
+
+    def migrate_indexes(self, databases=()):
+        """ creates the missing indexes (see pose_database.migrate_indexes) of the databases of the directory and of the
+        other databases given, returns the migrated databases """
+        migrated = []
+        for path in sorted(glob.glob(os.path.join(self.directory, 'xrgonomics_*.db'))) + list(databases):
+            if not os.path.exists(path):
+                continue
+            conn = pose_database.create_connection(path, read_only=True)
+            try:
+                indexed = pose_database.has_indexes(conn)
+            finally:
+                conn.close()
+            if not indexed and pose_database.migrate_indexes(path):
+                migrated.append(path)
+        return migrated
+
+    def evict(self, keep=()):
+        """ removes the least recently used databases above the limits, databases in keep are never removed """
+        keep = {os.path.abspath(path) for path in keep}
+        databases = sorted(glob.glob(os.path.join(self.directory, 'xrgonomics_*.db')), key=os.path.getmtime)
+        total_bytes = sum(self.size(path) for path in databases)
+        removed = []
+        for path in databases:
+            too_many = self.max_databases is not None and len(databases) - len(removed) > self.max_databases
+            too_large = self.max_bytes is not None and total_bytes > self.max_bytes
+            if not too_many and not too_large:
+                break
+            if os.path.abspath(path) in keep:
+                continue
+            total_bytes -= self.size(path)
+            os.remove(path)
+            pose_store.remove_snapshot(path)
+            removed.append(path)
+        return removed
@@ -0,0 +1,142 @@
+import bisect
+import threading
+import time
+
+# upper bounds (seconds) of the histogram buckets, from 10us to ~10s, the last bucket holds everything above
+bucket_bounds = [0.00001 * 2 ** i for i in range(21)]
+
+
+class Histogram:
+    """ Timings of one phase of one operation, percentiles are estimated from the upper bound of the buckets """
+
+    def __init__(self):
+        self.counts = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(bucket_bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0
+        rank = q / 100 * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bucket_bounds[i] if i < len(bucket_bounds) else self.max
+        return self.max
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count > 0 else 0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'buckets': {'{:g}'.format(bound): count for bound, count in zip(bucket_bounds + ['inf'], self.counts)
+                        if count > 0}
+        }
+
+
+class Stats:
+    """
+    Thread-safe timing histograms and counters, by operation (e.g. the server opcode) and phase (e.g. 'parse', 'sql',
+    'normalize', 'encode'). The operation is set per thread, so nested code (e.g. pose_database.query_rows) records its
+    timings under the request being answered. Disabled by default, so that start returns None and stop returns
+    immediately: the instrumented code only pays for a function call.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.histograms = {}
+        self.counters = {}
+        self.since = time.time()
+
+    def set_operation(self, operation):
+        self.local.operation = operation
+
+    def get_operation(self):
+        return getattr(self.local, 'operation', None)
+
+    def record(self, phase, seconds):
+        key = (self.get_operation(), phase)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.add(seconds)
+
+    def increment(self, counter, amount=1):
+        key = (self.get_operation(), counter)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+            self.since = time.time()
+
+    def snapshot(self):
+        """ {operation: {'timings': {phase: histogram stats}, 'counters': {counter: value}}}, operations recorded
+        outside of a request are listed under 'none' """
+        with self.lock:
+            result = {}
+            for (operation, phase), histogram in self.histograms.items():
+                result.setdefault(operation or 'none', {'timings': {}, 'counters': {}})['timings'][phase] = \
+                    histogram.stats()
+            for (operation, counter), value in self.counters.items():
+                result.setdefault(operation or 'none', {'timings': {}, 'counters': {}})['counters'][counter] = value
+            return {'enabled': self.enabled, 'since': self.since, 'operations': result}
+
+    def summary(self):
+        """ one line with the count, p50 and p99 of the total time of every operation """
+        with self.lock:
+            totals = sorted((operation, histogram) for (operation, phase), histogram in self.histograms.items()
+                            if phase == 'total' and operation is not None)
+            return ' '.join('{}: n={} p50={:.2f}ms p99={:.2f}ms'.format(operation, histogram.count,
+                                                                      histogram.percentile(50) * 1000,
+                                                                      histogram.percentile(99) * 1000)
+                            for operation, histogram in totals)
+
+
+stats = Stats()
+
+
+def start():
+    """ start time of a timed phase, None if the instrumentation is disabled """
+    return time.perf_counter() if stats.enabled else None
+
+
+def stop(phase, since):
+    """ records the time elapsed since start() under the current operation """
+    if since is not None:
+        stats.record(phase, time.perf_counter() - since)
+
+
+def increment(counter, amount=1):
+    if stats.enabled:
+        stats.increment(counter, amount)
+
+
+def log_periodically(interval, log=print):
+    """ logs stats.summary every interval seconds, from a daemon thread """
+    def run():
+        while True:
+            time.sleep(interval)
+            summary = stats.summary()
+            if summary:
+                log('Request timings: {}'.format(summary))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
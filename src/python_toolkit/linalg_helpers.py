@@ -120,6 +120,44 @@ def euler_rodrigues_rotation(axis, theta, vector=None):
         return rotation_matrix @ vector
 
 
+def euler_rodrigues_rotation_batch(axes, thetas):
+    """
+    Vectorized euler_rodrigues_rotation, returns an (N, 3, 3) array with one rotation matrix per axis (N, 3) / angle (N,)
+    pair. Axes do not need to be unit vectors.
+    """
+    axes = np.asarray(axes, dtype=float)
+    thetas = np.asarray(thetas, dtype=float)
+    axes = axes / np.sqrt(np.einsum('ij,ij->i', axes, axes))[:, None]
+    a = np.cos(thetas / 2.0)
+    b, c, d = (-axes * np.sin(thetas / 2.0)[:, None]).T
+    aa, bb, cc, dd = a * a, b * b, c * c, d * d
+    bc, ad, ac, ab, bd, cd = b * c, a * d, a * c, a * b, b * d, c * d
+
+    rotation_matrices = np.empty((axes.shape[0], 3, 3))
+    rotation_matrices[:, 0, 0] = aa + bb - cc - dd
+    rotation_matrices[:, 0, 1] = 2 * (bc + ad)
+    rotation_matrices[:, 0, 2] = 2 * (bd - ac)
+    rotation_matrices[:, 1, 0] = 2 * (bc - ad)
+    rotation_matrices[:, 1, 1] = aa + cc - bb - dd
+    rotation_matrices[:, 1, 2] = 2 * (cd + ab)
+    rotation_matrices[:, 2, 0] = 2 * (bd + ac)
+    rotation_matrices[:, 2, 1] = 2 * (cd - ab)
+    rotation_matrices[:, 2, 2] = aa + dd - bb - cc
+    return rotation_matrices
+
+
+def points_in_convex_hull(hull, points, tolerance=1e-9):
+    """
+    Checks which points are inside (or on the boundary of) a convex hull, using the half-space equations of its facets.
+    `hull` -- a QHull ConvexHull object
+    `points` -- array of shape (N, dim)
+    Returns a boolean array of shape (N,)
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, hull.points.shape[1])
+    # a point is inside if it is below the hyperplane of every facet (normal . point + offset <= 0)
+    return np.all(points @ hull.equations[:, :-1].T + hull.equations[:, -1] <= tolerance, axis=1)
+
+
 def look_at_rotation_matrix(eye, center, up):
     # up=np.array([0, 1, 0])
     dir_unit_vector = normalize(center - eye)
@@ -0,0 +1,122 @@
+import numpy as np
+
+import comfort_metrics
+import pose_database
+
+
+class Metric:
+    """
+    A comfort metric stored in an arm_poses column. inputs are the columns (of arm_poses, or voxels for the end
+    effector) the metric is computed from, compute receives them as a dict of 1D arrays (NULL values are nan) plus the
+    arm dimensions and returns one value per pose. The version must be increased whenever the formula changes, so that the
+    values stored by previous versions are recomputed.
+    """
+
+    def __init__(self, name, version, inputs, compute):
+        self.name = name
+        self.version = version
+        self.inputs = inputs
+        self.compute = compute
+
+
+def _consumed_endurance(columns, arm_proper_length, forearm_hand_length):
+    return comfort_metrics.consumed_endurance(end_effectors(columns), elbows(columns), arm_proper_length,
+                                              forearm_hand_length)
+
+
+def _rula(columns, arm_proper_length, forearm_hand_length):
+    return comfort_metrics.rula(end_effectors(columns), columns['elv_angle'], columns['shoulder_elv'],
+                                columns['elbow_flexion'])
+
+
+def _muscle_activation_reserve(columns, arm_proper_length, forearm_hand_length):
+    return comfort_metrics.muscle_activation_reserve(columns['muscle_activation'], columns['reserve'])
+
+
+def _weighted_metrics(columns, arm_proper_length, forearm_hand_length):
+    return comfort_metrics.weighted_metrics(columns['consumed_endurance'], columns['rula'],
+                                            columns['muscle_activation_reserve'])
+
+
+def end_effectors(columns):
+    return np.column_stack((columns['x'], columns['y'], columns['z']))
+
+
+def elbows(columns):
+    return np.column_stack((columns['elbow_x'], columns['elbow_y'], columns['elbow_z']))
+
+
+# in dependency order, a metric can only use the metrics registered before it as inputs
+registry = {metric.name: metric for metric in [
+    Metric('consumed_endurance', 1, ['x', 'y', 'z', 'elbow_x', 'elbow_y', 'elbow_z'], _consumed_endurance),
+    Metric('rula', 1, ['x', 'y', 'z', 'elv_angle', 'shoulder_elv', 'elbow_flexion'], _rula),
+    Metric('muscle_activation_reserve', 1, ['muscle_activation', 'reserve'], _muscle_activation_reserve),
+    Metric('weighted_metrics', 1, ['consumed_endurance', 'rula', 'muscle_activation_reserve'], _weighted_metrics)
+]}
+
+
+def get_metric_version(conn, metric):
+    """ version of the metric values stored in the database, None if the metric was never computed """
+    version = pose_database.get_metadata(conn, 'metric_version.' + metric)
+    return None if version is None else int(version)
+
+
+def set_metric_versions(conn, metrics):
+    """ records that the stored values of the metrics were computed with their current version """
+    for metric in metrics:
+        pose_database.set_metadata(conn, 'metric_version.' + metric, registry[metric].version)
+
+
+def mark_dirty(conn, columns, pose_ids):
+    """ marks the poses dirty for every computed metric that uses one of the columns, e.g. after new muscle
+    activations are stored """
+    for metric in registry.values():
+        if set(columns) & set(metric.inputs) and get_metric_version(conn, metric.name) is not None:
+            pose_database.mark_poses_dirty(conn, metric.name, pose_ids)
+
+
+def stale_metrics(conn):
+    """ computed metrics whose stored values come from a previous version of their formula """
+    return [name for name, metric in registry.items() if get_metric_version(conn, name) not in (None, metric.version)]
+
+
+def query_metric_inputs(conn, metric):
+    """ (pose ids, dict of input columns, stored values) of all the poses, ordered by arm_pose_id """
+    # None (NULL) is converted to nan
+    rows = pose_database.get_pose_columns(conn, ['arm_pose_id'] + metric.inputs + [metric.name])
+    return (rows[:, 0].astype(np.int64), {column: rows[:, 1 + i] for i, column in enumerate(metric.inputs)},
+            rows[:, -1])
+
+
+def recompute_metrics(conn, arm_proper_length, forearm_hand_length, metrics=()):
+    """
+    Recomputes the poses that are out of date, in dependency order: all the poses of the metrics given as argument and
+    of the stale metrics, the dirty poses and the poses whose inputs were changed by this pass. Metrics that were never
+    computed (and are not given as argument) are skipped. Only the poses whose value changed are written, with one bulk
+    update per metric. Returns the names of the metrics that changed. The caller is responsible for committing.
+    """
+    stale = set(metrics) | set(stale_metrics(conn))
+    changed_pose_ids = {}
+    for name, metric in registry.items():
+        if name not in stale and get_metric_version(conn, name) is None:
+            continue
+
+        dirty = np.array(pose_database.get_dirty_poses(conn, name), dtype=np.int64)
+        for column in metric.inputs:
+            dirty = np.union1d(dirty, changed_pose_ids.get(column, np.array([], dtype=np.int64)))
+        if name not in stale and len(dirty) == 0:
+            continue
+
+        pose_ids, columns, stored = query_metric_inputs(conn, metric)
+        selected = np.ones(len(pose_ids), dtype=bool) if name in stale else np.isin(pose_ids, dirty)
+        inputs = {column: column_values[selected] for column, column_values in columns.items()}
+        values = np.asarray(metric.compute(inputs, arm_proper_length, forearm_hand_length), dtype=float)
+        # nan is stored as NULL, so nan == nan is not a change
+        updated = ~((values == stored[selected]) | (np.isnan(values) & np.isnan(stored[selected])))
+        if np.any(updated):
+            pose_database.set_poses_metric(conn, name, pose_ids[selected][updated], values[updated])
+            changed_pose_ids[name] = pose_ids[selected][updated]
+
+        pose_database.clear_dirty_poses(conn, name)
+        set_metric_versions(conn, [name])
+    return list(changed_pose_ids)
@@ -1,68 +1,237 @@
+import json
+import os
 import sqlite3
+from contextlib import contextmanager
+from urllib.request import pathname2url
 
+import numpy as np
 
-def create_connection(db_file):
+import arm_position_helpers as armpos
+import instrumentation
+
+# metrics with a materialized best pose per voxel
+best_pose_metrics = ('consumed_endurance', 'rula', 'muscle_activation_reserve', 'weighted_metrics')
+# arm_poses columns that compact databases do not store, they are solved from the voxel center and the swivel angle
+derived_pose_columns = ('elbow_x', 'elbow_y', 'elbow_z', 'elv_angle', 'shoulder_elv', 'shoulder_rot', 'elbow_flexion')
+# voxel center columns, joined by get_pose_columns
+voxel_center_columns = ('x', 'y', 'z')
+# swivel angles of compact databases are stored as integers, in millionths of a radian
+swivel_angle_scale = 10 ** 6
+
+
+def create_connection(db_file, read_only=False):
     """ create a database connection to the SQLite database
         specified by db_file
     :param db_file: database file
+    :param read_only: open the database in read-only mode, the file must exist
     :return: Connection object or None
     """
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        if read_only:
+            conn = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(os.path.abspath(db_file))), uri=True)
+        else:
+            conn = sqlite3.connect(db_file)
     except sqlite3.Error as e:
         print(e)
 
     return conn
 
 
-def create_tables(conn):
+def create_tables(conn, compact=False):
+    """ compact -- store the arm poses in the compact layout: their swivel angle (fixed-point, see swivel_angle_scale)
+    instead of the derived_pose_columns, which readers get through get_pose_columns """
     cursor = conn.cursor()
 
-    # rtree_i32 for integers, rtree if higher precision is necessary
+    # rtree (32 bit floats), refined voxels can have fractional boundaries. Integer boundaries are stored exactly
     # a voxel has its boundaries, for querying purposes, and center
-    cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS voxels USING rtree_i32
+    # level is the refinement level (0 for the base grid), refined is 1 if the voxel was subdivided in 8 voxels of the
+    # next level (see build_pipeline.build_database)
+    cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS voxels USING rtree
                      (id,              -- Integer primary key
                       min_x, max_x,      -- Minimum and maximum X coordinate
                       min_y, max_y,      -- Minimum and maximum Y coordinate
                       min_z, max_z,       -- Minimum and maximum Z coordinate
                       +x REAL NOT NULL,
                       +y REAL NOT NULL,
-                      +z REAL NOT NULL
+                      +z REAL NOT NULL,
+                      +level INTEGER NOT NULL,
+                      +refined INTEGER NOT NULL
         );''')
 
     # for each voxel we have multiple poses
     # constraints - perhaps elbow and end effector could be a cube?
-    cursor.execute('''CREATE TABLE IF NOT EXISTS arm_poses
-                 (arm_pose_id INTEGER PRIMARY KEY,
+    # pose ids are assigned in voxel order, so both layouts are clustered by voxel
+    if compact:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS arm_poses
+                     (arm_pose_id INTEGER PRIMARY KEY,
+                      voxel_id INTEGER NOT NULL,
+                      swivel_angle INTEGER NOT NULL,
+                      muscle_activation REAL,
+                      reserve REAL,
+                      consumed_endurance REAL,
+                      rula INTEGER,
+                      borg10 INTEGER,
+                      muscle_activation_reserve REAL,
+                      weighted_metrics REAL,
+                      FOREIGN KEY (voxel_id) REFERENCES voxels (id))''')
+    else:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS arm_poses
+                     (arm_pose_id INTEGER PRIMARY KEY,
+                      voxel_id INTEGER NOT NULL,
+                      elbow_x REAL NOT NULL,
+                      elbow_y REAL NOT NULL,
+                      elbow_z REAL NOT NULL,
+                      elv_angle REAL NOT NULL,
+                      shoulder_elv REAL NOT NULL,
+                      shoulder_rot REAL NOT NULL,
+                      elbow_flexion REAL NOT NULL,
+                      muscle_activation REAL,
+                      reserve REAL,
+                      consumed_endurance REAL,
+                      rula INTEGER,
+                      borg10 INTEGER,
+                      muscle_activation_reserve REAL,
+                      weighted_metrics REAL,
+                      FOREIGN KEY (voxel_id) REFERENCES voxels (id))''')
+
+    create_voxel_best_pose_table(conn)
+    create_metadata_table(conn)
+    create_dirty_poses_table(conn)
+
+
+def create_indexes(conn):
+    """
+    Index of the poses of each voxel, used by the per voxel lookups, the joins with voxels and the GROUP BY voxel_id
+    of refresh_voxel_best_pose. arm_pose_id (the rowid) is part of the index, so it covers the queries that only need
+    the ids. Builds create it once the poses are inserted, databases built before it are migrated by migrate_indexes.
+    The query plans that rely on it are checked by tests/test_query_plans.py.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''CREATE INDEX IF NOT EXISTS arm_poses_voxel_id ON arm_poses (voxel_id)''')
+
+
+def has_indexes(conn):
+    """ True if the database has the indexes of create_indexes, or has no arm_poses table to index yet """
+    cursor = conn.cursor()
+    cursor.execute('''SELECT name FROM sqlite_master WHERE name IN ('arm_poses', 'arm_poses_voxel_id')''')
+    names = [row[0] for row in cursor.fetchall()]
+    return 'arm_poses' not in names or 'arm_poses_voxel_id' in names
+
+
+def migrate_indexes(db_file):
+    """ creates the indexes of create_indexes in a database built before them, with its own short writable connection.
+    Databases that are only opened read-only (e.g. by the server workers) are migrated once, at server startup (see
+    DatabaseCache.migrate_indexes). Returns False if the database could not be written (read-only file, locked by a
+    writer), queries then run without the indexes """
+    conn = sqlite3.connect(db_file)
+    try:
+        create_indexes(conn)
+        conn.commit()
+        return True
+    except sqlite3.OperationalError as e:
+        print('Indexes of {} not created: {}'.format(db_file, e))
+        return False
+    finally:
+        conn.close()
+
+
+def create_metadata_table(conn):
+    cursor = conn.cursor()
+
+    # key / value information about the database (build version, completeness marker, ...)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS metadata
+                 (key TEXT PRIMARY KEY,
+                  value TEXT)''')
+
+
+def create_dirty_poses_table(conn):
+    cursor = conn.cursor()
+
+    # poses whose metric has to be recomputed because its inputs changed (see metric_registry.recompute_metrics)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS dirty_poses
+                 (metric TEXT NOT NULL,
+                  arm_pose_id INTEGER NOT NULL,
+                  PRIMARY KEY (metric, arm_pose_id)) WITHOUT ROWID''')
+
+
+def create_voxel_best_pose_table(conn):
+    cursor = conn.cursor()
+
+    # materialized per voxel best pose for each metric (see refresh_voxel_best_pose)
+    # value is the metric value of the best pose, reserve and muscle_activation are copied from the best pose
+    cursor.execute('''CREATE TABLE IF NOT EXISTS voxel_best_pose
+                 (metric TEXT NOT NULL,
                   voxel_id INTEGER NOT NULL,
-                  elbow_x REAL NOT NULL,
-                  elbow_y REAL NOT NULL,
-                  elbow_z REAL NOT NULL,
-                  elv_angle REAL NOT NULL,
-                  shoulder_elv REAL NOT NULL,
-                  shoulder_rot REAL NOT NULL,
-                  elbow_flexion REAL NOT NULL,
-                  muscle_activation REAL,
+                  arm_pose_id INTEGER NOT NULL,
+                  num_poses INTEGER NOT NULL,
+                  value REAL NOT NULL,
                   reserve REAL,
-                  consumed_endurance REAL,
-                  rula INTEGER,
-                  borg10 INTEGER,
-                  muscle_activation_reserve REAL,
-                  weighted_metrics REAL,
-                  FOREIGN KEY (voxel_id) REFERENCES voxels (id))''')
+                  muscle_activation REAL,
+                  PRIMARY KEY (metric, voxel_id),
+                  FOREIGN KEY (voxel_id) REFERENCES voxels (id),
+                  FOREIGN KEY (arm_pose_id) REFERENCES arm_poses (arm_pose_id)) WITHOUT ROWID''')
 
 
 def insert_voxel(conn, voxel):
+    """ inserts a voxel of the base grid. The cached voxels limits are left as they are, callers inserting voxels one at
+    a time call invalidate_voxels_limits once """
+    columns, values = _base_level_columns(conn)
     cursor = conn.cursor()
     sql = '''INSERT INTO voxels(min_x, max_x, min_y, max_y, min_z, max_z,
-                                 x, y, z) 
-             VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+                                 x, y, z{})
+             VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?{})'''.format(columns, values)
 
     cursor.execute(sql, voxel)
     return cursor.lastrowid
 
 
+def insert_voxels(conn, voxels):
+    """ bulk version of insert_voxel, voxels is an iterable of rows (or a 2D array) in the insert_voxel format """
+    invalidate_voxels_limits(conn)
+    columns, values = _base_level_columns(conn)
+    cursor = conn.cursor()
+    sql = '''INSERT INTO voxels(min_x, max_x, min_y, max_y, min_z, max_z,
+                                 x, y, z{})
+             VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?{})'''.format(columns, values)
+    cursor.executemany(sql, _to_python(voxels))
+    return cursor.rowcount
+
+
+def insert_voxels_with_ids(conn, voxels):
+    """ same as insert_voxels, with an explicit id as the first column and the level and refined columns at the end of
+    every row (dropped for databases built before refinement levels) """
+    invalidate_voxels_limits(conn)
+    cursor = conn.cursor()
+    if has_voxel_levels(conn):
+        sql = '''INSERT INTO voxels(id, min_x, max_x, min_y, max_y, min_z, max_z,
+                                     x, y, z, level, refined)
+                 VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+        cursor.executemany(sql, _to_python(voxels))
+    else:
+        sql = '''INSERT INTO voxels(id, min_x, max_x, min_y, max_y, min_z, max_z,
+                                     x, y, z)
+                 VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+        cursor.executemany(sql, (row[:-2] for row in _to_python(voxels)))
+    return cursor.rowcount
+
+
+def _base_level_columns(conn):
+    """ level and refined columns, and their values for the base grid, of the voxel inserts. Databases built before
+    refinement levels have neither """
+    return (', level, refined', ', 0, 0') if has_voxel_levels(conn) else ('', '')
+
+
+def invalidate_voxels_limits(conn):
+    """ removes the voxels limits cached by cache_voxels_limits, once the voxels changed """
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''DELETE FROM metadata WHERE key = ?''', ('voxels_limits',))
+    except sqlite3.OperationalError:
+        # no metadata table, nothing was cached
+        pass
+
+
 def insert_arm_pose(conn, arm_pose):
     cursor = conn.cursor()
     sql = '''INSERT INTO arm_poses(voxel_id, elbow_x, elbow_y, elbow_z,
@@ -72,6 +241,43 @@ def insert_arm_pose(conn, arm_pose):
     return cursor.lastrowid
 
 
+def insert_arm_poses(conn, arm_poses):
+    """ bulk version of insert_arm_pose, arm_poses is an iterable of rows (or a 2D array) in the insert_arm_pose format """
+    cursor = conn.cursor()
+    sql = '''INSERT INTO arm_poses(voxel_id, elbow_x, elbow_y, elbow_z,
+                                   elv_angle, shoulder_elv, shoulder_rot, elbow_flexion)
+             VALUES(?, ?, ?, ?, ?, ?, ?, ?)'''
+    cursor.executemany(sql, _to_python(arm_poses))
+    return cursor.rowcount
+
+
+def insert_scored_arm_poses(conn, arm_poses):
+    """ bulk insert of arm poses with their ids and metrics, rows are (arm_pose_id, voxel_id, elbow_x, elbow_y,
+    elbow_z, elv_angle, shoulder_elv, shoulder_rot, elbow_flexion, consumed_endurance, rula) """
+    cursor = conn.cursor()
+    sql = '''INSERT INTO arm_poses(arm_pose_id, voxel_id, elbow_x, elbow_y, elbow_z,
+                                   elv_angle, shoulder_elv, shoulder_rot, elbow_flexion,
+                                   consumed_endurance, rula)
+             VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+    cursor.executemany(sql, _to_python(arm_poses))
+    return cursor.rowcount
+
+
+def insert_swivel_arm_poses(conn, arm_poses):
+    """ bulk insert of arm poses of a compact database with their ids and metrics, rows are (arm_pose_id, voxel_id,
+    swivel_angle, consumed_endurance, rula), swivel angles in the fixed-point format of quantize_swivel_angles """
+    cursor = conn.cursor()
+    sql = '''INSERT INTO arm_poses(arm_pose_id, voxel_id, swivel_angle, consumed_endurance, rula)
+             VALUES(?, ?, ?, ?, ?)'''
+    cursor.executemany(sql, _to_python(arm_poses))
+    return cursor.rowcount
+
+
+def quantize_swivel_angles(swivel_angles):
+    """ fixed-point swivel angles (radians) of compact databases """
+    return np.rint(np.asarray(swivel_angles, dtype=float) * swivel_angle_scale).astype(np.int64)
+
+
 def set_pose_activation_reserve(conn, pose_id, activation, reserve):
     cursor = conn.cursor()
     sql = '''UPDATE arm_poses
@@ -100,12 +306,215 @@ def set_pose_rula(conn, pose_id, rula):
     return cursor.lastrowid
 
 
+def set_poses_consumed_endurance(conn, pose_ids, consumed_endurances):
+    return _set_poses_column(conn, 'consumed_endurance', pose_ids, consumed_endurances)
+
+
+def set_poses_rula(conn, pose_ids, rulas):
+    return _set_poses_column(conn, 'rula', pose_ids, rulas)
+
+
+def set_poses_muscle_activation_reserve(conn, pose_ids, muscle_activation_reserves):
+    return _set_poses_column(conn, 'muscle_activation_reserve', pose_ids, muscle_activation_reserves)
+
+
+def set_poses_weighted_metrics(conn, pose_ids, weighted_metrics):
+    return _set_poses_column(conn, 'weighted_metrics', pose_ids, weighted_metrics)
+
+
+def set_poses_metric(conn, metric, pose_ids, values):
+    """ bulk update of a metric column (see metric_registry) """
+    return _set_poses_column(conn, metric, pose_ids, values)
+
+
+def _set_poses_column(conn, column, pose_ids, values):
+    cursor = conn.cursor()
+    sql = '''UPDATE arm_poses
+             SET {} = ?
+             WHERE arm_pose_id = ?'''.format(column)
+    cursor.executemany(sql, zip(_to_python(values), _to_python(pose_ids)))
+    return cursor.rowcount
+
+
+def _to_python(values):
+    # numpy arrays are converted to python types, sqlite does not bind numpy scalars
+    return values.tolist() if hasattr(values, 'tolist') else values
+
+
+@contextmanager
+def ingestion_mode(conn, journal_mode='MEMORY', synchronous='OFF', cache_size=-262144):
+    """ tunes the connection for bulk writes (database builds). The block is committed on exit, or rolled back if it
+    raises. Durability is traded for speed: a crash during the build leaves an incomplete database that has to be rebuilt.
+    A process killed in the middle of a transaction can corrupt the database with the MEMORY journal, builds that
+    commit checkpoints to resume from should use an on-disk journal (e.g. TRUNCATE).
+    cache_size follows the sqlite convention, negative values are in KiB.
+    Previous pragma values are restored when the block exits.
+    """
+    previous = {pragma: conn.execute('PRAGMA {}'.format(pragma)).fetchone()[0]
+                for pragma in ('journal_mode', 'synchronous', 'cache_size')}
+    conn.commit()
+    conn.execute('PRAGMA journal_mode = {}'.format(journal_mode))
+    conn.execute('PRAGMA synchronous = {}'.format(synchronous))
+    conn.execute('PRAGMA cache_size = {}'.format(cache_size))
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        for pragma, value in previous.items():
+            conn.execute('PRAGMA {} = {}'.format(pragma, value))
+
+
+def refresh_voxel_best_pose(conn, metrics=best_pose_metrics):
+    """ recomputes the voxel_best_pose rows of the given metrics. Ties are resolved by the lowest arm_pose_id """
+    create_voxel_best_pose_table(conn)
+    cursor = conn.cursor()
+    for metric in metrics:
+        cursor.execute('''DELETE FROM voxel_best_pose WHERE metric = ?''', (metric,))
+        # bare columns are taken from the row with the MIN value
+        sql = '''INSERT INTO voxel_best_pose(metric, voxel_id, arm_pose_id, num_poses, value, reserve, muscle_activation)
+                 SELECT ?, voxel_id, arm_pose_id, COUNT(*), MIN({metric}), reserve, muscle_activation
+                 FROM arm_poses
+                 WHERE {metric} IS NOT NULL
+                 GROUP BY voxel_id'''.format(metric=metric)
+        cursor.execute(sql, (metric,))
+
+
+def has_voxel_best_pose(conn, metric):
+    """ True if the voxel_best_pose table exists and was filled for the metric """
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''SELECT 1 FROM voxel_best_pose WHERE metric = ? LIMIT 1''', (metric,))
+    except sqlite3.OperationalError:
+        return False
+    return cursor.fetchone() is not None
+
+
+def has_voxel_levels(conn):
+    """ True if the voxels table has the level and refined columns (databases built before refinement levels do not) """
+    cursor = conn.cursor()
+    cursor.execute('''PRAGMA table_info(voxels)''')
+    return 'level' in [column[1] for column in cursor.fetchall()]
+
+
+def has_compact_poses(conn):
+    """ True if the arm poses are stored in the compact layout (see create_tables) """
+    cursor = conn.cursor()
+    cursor.execute('''PRAGMA table_info(arm_poses)''')
+    return 'swivel_angle' in [column[1] for column in cursor.fetchall()]
+
+
+def get_sql_level(level):
+    """ voxels of a level of detail: the voxels of that level plus the coarser voxels that were not refined down to it,
+    so every position is covered by exactly one voxel """
+    return 'level <= ? AND (level = ? OR refined = 0) ', [level, level]
+
+
+def mark_poses_dirty(conn, metric, pose_ids):
+    create_dirty_poses_table(conn)
+    cursor = conn.cursor()
+    sql = '''INSERT OR IGNORE INTO dirty_poses(metric, arm_pose_id)
+             VALUES(?, ?)'''
+    cursor.executemany(sql, ((metric, pose_id) for pose_id in _to_python(pose_ids)))
+    return cursor.rowcount
+
+
+def get_dirty_poses(conn, metric):
+    """ ids of the poses marked dirty for the metric, empty if the database has no dirty_poses table """
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''SELECT arm_pose_id FROM dirty_poses WHERE metric = ?''', (metric,))
+    except sqlite3.OperationalError:
+        return []
+    return [row[0] for row in cursor.fetchall()]
+
+
+def clear_dirty_poses(conn, metric):
+    create_dirty_poses_table(conn)
+    cursor = conn.cursor()
+    cursor.execute('''DELETE FROM dirty_poses WHERE metric = ?''', (metric,))
+
+
+def set_metadata(conn, key, value):
+    create_metadata_table(conn)
+    cursor = conn.cursor()
+    sql = '''INSERT OR REPLACE INTO metadata(key, value)
+             VALUES(?, ?)'''
+    cursor.execute(sql, (key, str(value)))
+
+
+def delete_metadata(conn, key):
+    create_metadata_table(conn)
+    cursor = conn.cursor()
+    cursor.execute('''DELETE FROM metadata WHERE key = ?''', (key,))
+
+
+def get_metadata(conn, key):
+    """ value stored for key, None if there is none (or the database has no metadata table) """
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''SELECT value FROM metadata WHERE key = ?''', (key,))
+    except sqlite3.OperationalError:
+        return None
+    row = cursor.fetchone()
+    return None if row is None else row[0]
+
+
+def is_build_complete(conn, build_version, parameters=None):
+    """ True if the database was completely built with the given build version and, if set, the given build parameters
+    (see build_pipeline.build_parameters). Parameters are compared as values, 33 and 33.0 are the same length """
+    if get_metadata(conn, 'complete') != '1' or get_metadata(conn, 'build_version') != str(build_version):
+        return False
+    if parameters is None:
+        return True
+    built = get_metadata(conn, 'build_parameters')
+    return built is not None and json.loads(built) == json.loads(json.dumps(parameters))
+
+
 def custom_query(conn, sql, params):
     cursor = conn.cursor()
     cursor.execute(sql, params)
     return cursor
 
 
+def query_rows(conn, sql, params):
+    """ all the rows of custom_query, the execution (including the fetch) is timed as the 'sql' phase of the current
+    request, see instrumentation """
+    since = instrumentation.start()
+    rows = custom_query(conn, sql, params).fetchall()
+    instrumentation.stop('sql', since)
+    return rows
+
+
+def get_pose_columns(conn, columns, where='', params=(), order_by='arm_poses.arm_pose_id'):
+    """
+    (N, len(columns)) array with columns of the arm poses (NULL values are nan), for both layouts. columns are arm_poses
+    columns or voxel_center_columns. The derived_pose_columns of compact databases are solved from the voxel center,
+    the swivel angle and the arm dimensions in the metadata. where (including the WHERE keyword) and order_by are SQL
+    on the qualified columns of arm_poses and voxels.
+    """
+    derived = [column for column in columns if column in derived_pose_columns] if has_compact_poses(conn) else []
+    selected = [column for column in columns if column not in derived]
+    if derived:
+        selected += list(voxel_center_columns) + ['swivel_angle']
+    joined = any(column in voxel_center_columns for column in selected) or 'voxels.' in where + order_by
+    sql = '''SELECT {} FROM arm_poses {} {}
+             ORDER BY {}'''.format(', '.join(('voxels.' if column in voxel_center_columns else 'arm_poses.') + column
+                                               for column in selected),
+                                     'LEFT JOIN voxels ON voxels.id = arm_poses.voxel_id' if joined else '', where,
+                                     order_by)
+    rows = np.array(custom_query(conn, sql, params).fetchall(), dtype=float).reshape(-1, len(selected))
+    values = {column: rows[:, i] for i, column in enumerate(selected)}
+    if derived:
+        poses = armpos.solve_swivel_arm_poses(rows[:, -4:-1], values['swivel_angle'] / swivel_angle_scale,
+                                              float(get_metadata(conn, 'arm_proper_length')),
+                                              float(get_metadata(conn, 'forearm_hand_length')))
+        values.update((column, poses[column]) for column in derived)
+    return np.column_stack([values[column] for column in columns]).reshape(-1, len(columns))
+
+
 def count_voxels(conn):
     cursor = conn.cursor()
     sql = '''SELECT COUNT() FROM voxels'''
@@ -113,13 +522,54 @@ def count_voxels(conn):
     return cursor.fetchone()[0]
 
 
-def get_voxel_point(conn, x, y, z):
+def get_max_voxel_id(conn):
+    """ largest voxel id, 0 if there are no voxels """
+    cursor = conn.cursor()
+    cursor.execute('''SELECT IFNULL(MAX(id), 0) FROM voxels''')
+    return cursor.fetchone()[0]
+
+
+def get_max_arm_pose_id(conn):
+    """ largest arm pose id, 0 if there are no poses """
+    cursor = conn.cursor()
+    cursor.execute('''SELECT IFNULL(MAX(arm_pose_id), 0) FROM arm_poses''')
+    return cursor.fetchone()[0]
+
+
+def get_refined_voxel_centers(conn, level):
+    """ (x, y, z) centers of the refined voxels of a level, ordered by id """
+    cursor = conn.cursor()
+    sql = '''SELECT x, y, z FROM voxels
+             WHERE level = ? AND refined = 1
+             ORDER BY id'''
+    cursor.execute(sql, (level,))
+    return cursor.fetchall()
+
+
+def get_min_consumed_endurance_per_voxel(conn, min_voxel_id):
+    """ (voxel_id, MIN(consumed_endurance)) of the voxels with poses and an id of at least min_voxel_id """
+    cursor = conn.cursor()
+    sql = '''SELECT voxel_id, MIN(consumed_endurance) FROM arm_poses
+             WHERE voxel_id >= ?
+             GROUP BY voxel_id'''
+    cursor.execute(sql, (min_voxel_id,))
+    return cursor.fetchall()
+
+
+def get_voxel_point(conn, x, y, z, level=None):
+    """ voxel that contains the point. With refinement levels, level selects the level of detail (see
+    get_sql_level) """
     cursor = conn.cursor()
     sql = '''SELECT * FROM voxels
               WHERE min_x <= ? AND max_x > ?
                 AND min_y <= ? AND max_y > ?
                 AND min_z <= ? AND max_z > ?'''
-    cursor.execute(sql, (x, x, y, y, z, z))
+    params = [x, x, y, y, z, z]
+    if level is not None:
+        level_sql, level_params = get_sql_level(level)
+        sql += ' AND ' + level_sql
+        params += level_params
+    cursor.execute(sql, params)
     # when looking for a particular pos, there will be at most
     return cursor.fetchone()
 
@@ -164,45 +614,32 @@ def get_all_poses_all_metrics(conn):
 
 
 def get_all_poses_voxels(conn):
-    cursor = conn.cursor()
-    sql = '''SELECT arm_poses.arm_pose_id, voxels.x, voxels.y, voxels.z, arm_poses.elbow_x, arm_poses.elbow_y, 
-             arm_poses.elbow_z, arm_poses.elv_angle, arm_poses.shoulder_elv, arm_poses.elbow_flexion
-             FROM arm_poses INNER JOIN voxels ON arm_poses.voxel_id = voxels.id
-             '''
-    cursor.execute(sql)
-    return cursor.fetchall()
+    return get_pose_columns(conn, ['arm_pose_id', 'x', 'y', 'z', 'elbow_x', 'elbow_y', 'elbow_z', 'elv_angle',
+                                   'shoulder_elv', 'elbow_flexion']).tolist()
 
 
 def get_voxels_limits(conn):
+    """ [min x, max x, min y, max y, min z, max z] of the centers of the voxels of the base grid (refined voxels lie
+    inside of it), from the metadata if they were cached (see cache_voxels_limits) """
+    limits = get_metadata(conn, 'voxels_limits')
+    if limits is not None:
+        return json.loads(limits)
     cursor = conn.cursor()
-    result = []
-    sql = '''SELECT MIN(x) FROM voxels'''
-    cursor.execute(sql)
-    result.append(cursor.fetchone()[0])
-    sql = '''SELECT MAX(x) FROM voxels'''
-    cursor.execute(sql)
-    result.append(cursor.fetchone()[0])
-    sql = '''SELECT MIN(y) FROM voxels'''
-    cursor.execute(sql)
-    result.append(cursor.fetchone()[0])
-    sql = '''SELECT MAX(y) FROM voxels'''
-    cursor.execute(sql)
-    result.append(cursor.fetchone()[0])
-    sql = '''SELECT MIN(z) FROM voxels'''
-    cursor.execute(sql)
-    result.append(cursor.fetchone()[0])
-    sql = '''SELECT MAX(z) FROM voxels'''
-    cursor.execute(sql)
-    result.append(cursor.fetchone()[0])
-    return result
+    cursor.execute('''SELECT MIN(x), MAX(x), MIN(y), MAX(y), MIN(z), MAX(z) FROM voxels {}'''.format(
+        'WHERE level = 0' if has_voxel_levels(conn) else ''))
+    return list(cursor.fetchone())
+
+
+def cache_voxels_limits(conn):
+    """ stores the limits of the voxels in the metadata, bulk inserts of voxels remove them """
+    invalidate_voxels_limits(conn)
+    set_metadata(conn, 'voxels_limits', json.dumps(get_voxels_limits(conn)))
 
 
 def get_poses_in_voxel(conn, voxel_id, metric):
-    cursor = conn.cursor()
-    sql = '''SELECT arm_pose_id, elbow_x, elbow_y, elbow_z, {}, muscle_activation_reserve FROM arm_poses
-             WHERE voxel_id = ?'''.format(metric)
-    cursor.execute(sql, (voxel_id,))
-    return cursor
+    """ rows (arm_pose_id, elbow_x, elbow_y, elbow_z, metric, muscle_activation_reserve) of the poses of a voxel """
+    return get_pose_columns(conn, ['arm_pose_id', 'elbow_x', 'elbow_y', 'elbow_z', metric, 'muscle_activation_reserve'],
+                            'WHERE arm_poses.voxel_id = ?', (voxel_id,))
 
 
 def count_poses(conn):
@@ -214,6 +651,12 @@ def count_poses(conn):
 
 def drop_tables(conn):
     cursor = conn.cursor()
+    sql = '''DROP TABLE IF EXISTS metadata'''
+    cursor.execute(sql)
+    sql = '''DROP TABLE IF EXISTS dirty_poses'''
+    cursor.execute(sql)
+    sql = '''DROP TABLE IF EXISTS voxel_best_pose'''
+    cursor.execute(sql)
     sql = '''DROP TABLE IF EXISTS voxels'''
     cursor.execute(sql)
     sql = '''DROP TABLE IF EXISTS arm_poses'''
@@ -0,0 +1,323 @@
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import comfort_metrics
+import pose_database
+
+metric_columns = ['muscle_activation', 'reserve', 'consumed_endurance', 'rula', 'muscle_activation_reserve',
+                  'weighted_metrics']
+
+# must be increased whenever the arrays stored in a snapshot change, so that older snapshots are not loaded
+snapshot_version = 1
+# arrays of a snapshot, metrics and best poses are stored as <name>.<metric>.npy
+snapshot_arrays = ['voxel_ids', 'bounds', 'centers', 'levels', 'refined', 'pose_ids', 'pose_voxel_ids', 'elbows',
+                   'pose_voxel_index', 'voxel_pose_start', 'voxel_pose_end']
+
+
+class PoseStore:
+    """
+    Read-only, in-memory copy of the voxels and arm_poses tables stored as contiguous numpy columns. Answers the same
+    queries as the SQL path of XRgonomics (same rows, same order) with boolean masks instead of JOIN + GROUP BY.
+    Voxels are sorted by id and poses by (voxel_id, arm_pose_id), which is the order sqlite produces for the SQL queries.
+    """
+
+    def __init__(self, conn):
+        # databases built before refinement levels only have the base grid (level 0, not refined)
+        levels = 'level, refined' if pose_database.has_voxel_levels(conn) else '0, 0'
+        voxels = np.array(pose_database.custom_query(conn, '''SELECT id, min_x, max_x, min_y, max_y, min_z, max_z,
+                                                                     x, y, z, {}
+                                                              FROM voxels ORDER BY id'''.format(levels),
+                                                     []).fetchall(),
+                          dtype=float).reshape(-1, 12)
+        poses = pose_database.get_pose_columns(conn, ['arm_pose_id', 'voxel_id', 'elbow_x', 'elbow_y', 'elbow_z'] +
+                                               list(metric_columns),
+                                               order_by='arm_poses.voxel_id, arm_poses.arm_pose_id')
+
+        self.voxel_ids = voxels[:, 0].astype(np.int64)
+        # bounds as stored in the r*-tree, columns are min_x, max_x, min_y, max_y, min_z, max_z
+        self.bounds = np.ascontiguousarray(voxels[:, 1:7])
+        self.centers = np.ascontiguousarray(voxels[:, 7:10])
+        self.levels = voxels[:, 10].astype(np.int64)
+        self.refined = voxels[:, 11].astype(bool)
+
+        self.pose_ids = poses[:, 0].astype(np.int64)
+        self.pose_voxel_ids = poses[:, 1].astype(np.int64)
+        self.elbows = np.ascontiguousarray(poses[:, 2:5])
+        # None (NULL) values are stored as nan
+        self.metrics = {name: np.ascontiguousarray(poses[:, 5 + i]) for i, name in enumerate(metric_columns)}
+
+        # voxel row of each pose and the slice of poses of each voxel
+        self.pose_voxel_index = np.searchsorted(self.voxel_ids, self.pose_voxel_ids)
+        self.voxel_pose_start = np.searchsorted(self.pose_voxel_ids, self.voxel_ids, side='left')
+        self.voxel_pose_end = np.searchsorted(self.pose_voxel_ids, self.voxel_ids, side='right')
+
+        self.best = {metric: self.compute_best_poses(metric) for metric in metric_columns if metric != 'reserve'}
+        self.normalized = None
+        self.kdtrees = {}
+
+    def save(self, directory):
+        """
+        Writes the store as a snapshot: a directory with one .npy file per array and a snapshot.json header. The
+        snapshot is written next to the directory and then renamed, readers never see a partial snapshot.
+        """
+        partial = directory + '.partial'
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        for name in snapshot_arrays:
+            np.save(os.path.join(partial, name + '.npy'), getattr(self, name))
+        for metric, values in self.metrics.items():
+            np.save(os.path.join(partial, 'metrics.' + metric + '.npy'), values)
+        for metric, (count, best) in self.best.items():
+            np.save(os.path.join(partial, 'best_count.' + metric + '.npy'), count)
+            np.save(os.path.join(partial, 'best_pose.' + metric + '.npy'), best)
+        with open(os.path.join(partial, 'snapshot.json'), 'w') as header:
+            json.dump({'version': snapshot_version, 'voxels': len(self.voxel_ids), 'poses': len(self.pose_ids),
+                       'metrics': list(self.metrics), 'best': list(self.best)}, header)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.rename(partial, directory)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+        Opens a snapshot written by save. With mmap_mode='r' the arrays are memory-mapped, nothing is copied at startup
+        and all the processes that load the same snapshot share the page cache.
+        """
+        with open(os.path.join(directory, 'snapshot.json')) as header:
+            header = json.load(header)
+        if header['version'] != snapshot_version:
+            raise ValueError('Snapshot {} has version {}, expected {}'.format(directory, header['version'],
+                                                                              snapshot_version))
+
+        def load_array(name):
+            return np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+
+        store = cls.__new__(cls)
+        for name in snapshot_arrays:
+            setattr(store, name, load_array(name))
+        store.metrics = {metric: load_array('metrics.' + metric) for metric in header['metrics']}
+        store.best = {metric: (load_array('best_count.' + metric), load_array('best_pose.' + metric))
+                      for metric in header['best']}
+        store.normalized = None
+        store.kdtrees = {}
+        return store
+
+    def memory_bytes(self):
+        """ bytes of the arrays held in memory, memory-mapped arrays live in the page cache and are not counted """
+        arrays = [getattr(self, name) for name in snapshot_arrays] + list(self.metrics.values())
+        arrays += [array for arrays_of_metric in self.best.values() for array in arrays_of_metric]
+        arrays += list(self.normalized.values()) if self.normalized is not None else []
+        return sum(array.nbytes for array in arrays if not isinstance(array, np.memmap))
+
+    def compute_best_poses(self, metric):
+        """
+        Per voxel argmin of a metric. Returns (count, best_pose_index) arrays with one entry per voxel, voxels without
+        valid poses have count 0 and best_pose_index -1. Ties are resolved by the lowest arm_pose_id, as in sqlite.
+        """
+        if metric == 'muscle_activation':
+            # same as the SQL path, best pose by muscle_activation_reserve among poses with activation and reserve
+            valid = ~np.isnan(self.metrics['muscle_activation']) & ~np.isnan(self.metrics['reserve'])
+            values = self.metrics['muscle_activation_reserve']
+        else:
+            values = self.metrics[metric]
+            valid = ~np.isnan(values)
+        return self.best_poses(values, valid)
+
+    def best_poses(self, values, valid):
+        """ Per voxel argmin of the values of the valid poses, see compute_best_poses """
+        count = np.bincount(self.pose_voxel_index[valid], minlength=len(self.voxel_ids))
+        best = np.full(len(self.voxel_ids), -1, dtype=np.int64)
+
+        candidates = np.nonzero(valid & ~np.isnan(values))[0]
+        if len(candidates) > 0:
+            # poses are sorted by voxel and pose id, so the poses of a voxel are contiguous and the first pose that
+            # reaches the minimum of its voxel is the best one
+            voxel_index = self.pose_voxel_index[candidates]
+            starts = np.r_[True, voxel_index[1:] != voxel_index[:-1]]
+            minimum = np.minimum.reduceat(values[candidates], np.nonzero(starts)[0])
+            candidates = candidates[values[candidates] == minimum[np.cumsum(starts) - 1]]
+            voxel_index = self.pose_voxel_index[candidates]
+            first = np.r_[True, voxel_index[1:] != voxel_index[:-1]]
+            best[voxel_index[first]] = candidates[first]
+        return count, best
+
+    def level_mask(self, level):
+        """ voxels of a level of detail, same semantics as pose_database.get_sql_level """
+        return (self.levels <= level) & ((self.levels == level) | ~self.refined)
+
+    def constraint_mask(self, constraints, level=0):
+        mask = self.level_mask(level)
+        for constraint in constraints:
+            axis, operator, value = constraint.values()
+            min_bound = self.bounds[:, 2 * axis]
+            max_bound = self.bounds[:, 2 * axis + 1]
+            # same semantics as arm_position.get_sql_constraint
+            if operator == '=':
+                mask &= (min_bound <= value) & (max_bound > value)
+            elif operator == '<=':
+                mask &= max_bound <= value
+            elif operator == '>=':
+                mask &= min_bound >= value
+            elif operator == '<':
+                mask &= min_bound < value
+            elif operator == '>':
+                mask &= min_bound > value
+            else:
+                raise ValueError('Unknown constraint operator {}'.format(operator))
+        return mask
+
+    def get_normalized_metrics(self):
+        """ columns combined by weighted_metrics (see comfort_metrics.normalized_metrics), computed on first use """
+        if self.normalized is None:
+            self.normalized = comfort_metrics.normalized_metrics(self.metrics['consumed_endurance'],
+                                                                 self.metrics['rula'],
+                                                                 self.metrics['muscle_activation_reserve'])
+        return self.normalized
+
+    def weighted_metrics(self, weights):
+        """ weighted_metrics of every pose with the given weights (see comfort_metrics.weight_normalized_metrics) """
+        return comfort_metrics.weight_normalized_metrics(self.get_normalized_metrics(), weights)
+
+    def get_voxels_constrained(self, metric, constraints, level=0, weights=None):
+        """
+        Rows (id, x, y, z, num_poses, pose_id, metric, reserve) of the voxels that satisfy the constraints, equivalent
+        to the SQL query in XRgonomics.get_voxels_constrained. For muscle_activation the last two columns are
+        muscle_activation and the min muscle_activation_reserve.
+        With weights, the weighted_metrics metric is computed on the fly with these weights instead of being read from
+        the stored column.
+        """
+        values = None
+        if weights is not None:
+            if metric != 'weighted_metrics':
+                raise ValueError('Weights are only supported by the weighted_metrics metric')
+            values = self.weighted_metrics(weights)
+            count, best = self.best_poses(values, ~np.isnan(values))
+        else:
+            count, best = self.best[metric]
+        voxel_index = np.nonzero(self.constraint_mask(constraints, level) & (count > 0))[0]
+        return self.voxel_rows(metric, voxel_index, count, best, values)
+
+    def voxel_rows(self, metric, voxel_index, count, best, values=None, columns=8):
+        """ Rows of get_voxels_constrained of the given voxels, with room for columns - 8 extra columns """
+        pose_index = best[voxel_index]
+        rows = np.empty((len(voxel_index), columns))
+        rows[:, 0] = self.voxel_ids[voxel_index]
+        rows[:, 1:4] = self.centers[voxel_index]
+        rows[:, 4] = count[voxel_index]
+        rows[:, 5] = self.pose_ids[pose_index]
+        if metric == 'muscle_activation':
+            rows[:, 6] = self.metrics['muscle_activation'][pose_index]
+            rows[:, 7] = self.metrics['muscle_activation_reserve'][pose_index]
+        else:
+            rows[:, 6] = (self.metrics[metric] if values is None else values)[pose_index]
+            rows[:, 7] = self.metrics['reserve'][pose_index]
+        return rows
+
+    def nearest_index(self, metric, level=0):
+        """
+        (cKDTree over the voxel centers, voxel indexes of the tree points) of the voxels of a level of detail that have
+        a best pose for the metric, built on first use
+        """
+        key = (metric, level)
+        if key not in self.kdtrees:
+            count, best = self.best[metric]
+            voxel_index = np.nonzero(self.level_mask(level) & (count > 0))[0]
+            self.kdtrees[key] = cKDTree(np.asarray(self.centers[voxel_index])), voxel_index
+        return self.kdtrees[key]
+
+    def get_voxels_nearest(self, metric, point, radius=None, k=None, level=0):
+        """
+        Rows of get_voxels_constrained, plus the distance to the point as last column, of the voxels whose center is
+        within radius of the point or, without radius, of the k voxels nearest to the point. Unsorted
+        """
+        if radius is None and k is None:
+            raise ValueError('Nearest voxel queries need a radius or k')
+        tree, voxel_index = self.nearest_index(metric, level)
+        point = np.asarray(point, dtype=float)
+        if len(voxel_index) == 0:
+            candidates = np.empty(0, dtype=np.int64)
+        elif radius is not None:
+            candidates = np.array(tree.query_ball_point(point, radius), dtype=np.int64)
+        else:
+            distances, candidates = tree.query(point, k=k)
+            # missing neighbours (k larger than the tree) have the index tree.n
+            candidates = np.atleast_1d(candidates)
+            candidates = candidates[candidates < tree.n]
+
+        count, best = self.best[metric]
+        rows = self.voxel_rows(metric, voxel_index[candidates], count, best, columns=9)
+        rows[:, 8] = np.linalg.norm(rows[:, 1:4] - point, axis=1)
+        return rows
+
+    def get_voxel_point(self, x, y, z, level=0):
+        """ Index of the voxel of the level of detail that contains the point, None if there is none """
+        point = np.array([x, y, z])
+        inside = np.all((self.bounds[:, 0::2] <= point) & (self.bounds[:, 1::2] > point), axis=1)
+        inside &= self.level_mask(level)
+        voxel_index = np.nonzero(inside)[0]
+        return voxel_index[0] if len(voxel_index) > 0 else None
+
+    def get_poses_in_voxel(self, voxel_index, metric):
+        """ Rows (arm_pose_id, elbow_x, elbow_y, elbow_z, metric, muscle_activation_reserve) of the poses of a voxel """
+        pose_slice = slice(self.voxel_pose_start[voxel_index], self.voxel_pose_end[voxel_index])
+        rows = np.empty((pose_slice.stop - pose_slice.start, 6))
+        rows[:, 0] = self.pose_ids[pose_slice]
+        rows[:, 1:4] = self.elbows[pose_slice]
+        rows[:, 4] = self.metrics[metric][pose_slice]
+        rows[:, 5] = self.metrics['muscle_activation_reserve'][pose_slice]
+        return rows
+
+    def get_voxels_limits(self):
+        """ same as pose_database.get_voxels_limits: centers of the voxels of the base grid """
+        centers = self.centers[self.levels == 0]
+        if len(centers) == 0:
+            return [None] * 6
+        mins = centers.min(axis=0).tolist()
+        maxs = centers.max(axis=0).tolist()
+        return [mins[0], maxs[0], mins[1], maxs[1], mins[2], maxs[2]]
+
+
+def snapshot_path(database):
+    """ directory of the snapshot of a database """
+    return database + '.snapshot'
+
+
+def is_snapshot(directory):
+    """ True if the directory holds a snapshot of the current snapshot_version """
+    try:
+        with open(os.path.join(directory, 'snapshot.json')) as header:
+            return json.load(header)['version'] == snapshot_version
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def remove_snapshot(database):
+    shutil.rmtree(snapshot_path(database), ignore_errors=True)
+
+
+def export_snapshot(conn, database):
+    """ writes the snapshot of a database, returns its directory """
+    directory = snapshot_path(database)
+    PoseStore(conn).save(directory)
+    return directory
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the read-only snapshot of a pose database')
+    parser.add_argument('database', nargs='+')
+    args = parser.parse_args()
+
+    for database in args.database:
+        conn = pose_database.create_connection(database, read_only=True)
+        try:
+            print('Exported {}'.format(export_snapshot(conn, database)))
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
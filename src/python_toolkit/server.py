@@ -3,58 +3,643 @@ import zmq
 # import numpy as np
 # import time
 # import cv2
-import arm_position
+import argparse
+import itertools
 import json
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+import arm_interpolation
+import arm_position
+import comfort_metrics
+from database_cache import DatabaseCache
+from response_cache import ResponseCache
+from toolkit_registry import ToolkitRegistry
+import instrumentation
+import pose_database
+import wire
 
-context = zmq.Context()
-socket = context.socket(zmq.REP)
-socket.bind('tcp://*:5555')
-
-toolkit = arm_position.XRgonomics()
-
-while True:
-    request = socket.recv_multipart()
-
-    # first part of the request encodes operation
-    # if request[0].decode('utf-8') == 'F':
-    #     frame_byte = base64.b64decode(request[1])
-    #
-    #     img_arr = np.frombuffer(frame_byte, np.uint8)
-    #     # reshape with correct dimensions
-    #     img = img_arr.reshape((480, 640, 4), order='C')
-    #     # remove alpha channel
-    #     img_rgb = img[:, :, :3]
-    #     img_bgr = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR)
-    #     img_bgr = cv2.flip(img_bgr, 0)
-    #     cv2.imshow("image", img_bgr)
-    #     cv2.waitKey(1)
-    #
-    #     print('Received request, time: {}'.format(time.time() - since))
-    #
-    #     socket.send(b'Image data')
-    if request[0].decode('utf-8') == 'C':
-        req = json.loads(request[1])
-        anchors = toolkit.get_voxels_constrained(*req.values())
-        socket.send(json.dumps(anchors).encode('utf-8'))
-    elif request[0].decode('utf-8') == 'P':
-        req = json.loads(request[1])
-        poses = toolkit.get_voxel_poses(*req.values())
-        socket.send(json.dumps(poses).encode('utf-8'))
-    elif request[0].decode('utf-8') == 'L':
-        limits = toolkit.get_interaction_space_limits()
-        socket.send(json.dumps(limits).encode('utf-8'))
-    elif request[0].decode('utf-8') == 'O':
-        req = json.loads(request[1])
-        voxels = toolkit.optimal_position_in_polygon(req['polygon'])
-        socket.send(json.dumps(voxels).encode('utf-8'))
-    elif request[0].decode('utf-8') == 'A':
+backend_address = 'inproc://workers'
+# requests parked until their build is over are pushed back to the broker on this address
+requeue_address = 'inproc://requeue'
+# topic of the build events published on the PUB socket
+build_topic = b'build'
+default_database = 'poses.db'
+# operations whose responses only depend on the request and the database
+cached_operations = ('C', 'P', 'L')
+# fields of the arm profile of 'A' requests, by their name in the Unity client (ComputeErgonomicCostRequest) and in
+# XRgonomics
+profile_fields = (('armProperLength', 'arm_proper_length'), ('forearmHandLength', 'forearm_hand_length'),
+                  ('voxelSideLength', 'spacing'))
+
+
+def request_profile(req):
+    """ [arm_proper_length, forearm_hand_length, spacing, levels] of an 'A' request, read by field name """
+    return [req[client] if client in req else req[name] for client, name in profile_fields] + [req.get('levels', 0)]
+
+
+def encode_reply(value):
+    """ JSON reply, timed as the 'encode' phase of the request """
+    since = instrumentation.start()
+    reply = json.dumps(value).encode('utf-8')
+    instrumentation.stop('encode', since)
+    return reply
+
+
+class Session:
+    """
+    State of a client session: the database it is served (the database of its arm profile) and the last interaction
+    space computed by its 'O' requests, which is read back by its 'C' requests with the last_interaction_space metric
+    (possibly on another worker).
+    """
+
+    def __init__(self, database):
+        self.lock = threading.Lock()
+        self.database = database
+        self.last_interaction_space = []
+        self.is_version = 0
+        self.is_updated = 0
+
+    def get(self):
+        with self.lock:
+            return self.database
+
+    def set(self, database):
+        with self.lock:
+            self.database = database
+            self.last_interaction_space = []
+            self.is_version = 0
+            self.is_updated = 0
+
+    def load_interaction_space(self, toolkit):
+        with self.lock:
+            toolkit.last_interaction_space = self.last_interaction_space
+            toolkit.is_version = self.is_version
+            toolkit.is_updated = self.is_updated
+
+    def store_interaction_space(self, toolkit):
+        with self.lock:
+            self.last_interaction_space = toolkit.last_interaction_space
+            self.is_version = toolkit.is_version
+            self.is_updated = toolkit.is_updated
+
+
+class Sessions:
+    """
+    Sessions of the clients, identified by the 'session' field of the requests (requests without one share the default
+    session). Sessions start with the default database, 'A' and 'D' requests only change the database of their own
+    session, so clients with different arm profiles are served concurrently. The least recently used sessions are
+    forgotten above max_sessions.
+    """
+
+    def __init__(self, default_database, max_sessions=1024):
+        self.lock = threading.Lock()
+        self.default_database = default_database
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+
+    def get(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = Session(self.default_database)
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+            return session
+
+    def databases(self):
+        """ databases served to the sessions """
+        with self.lock:
+            return {session.get() for session in self.sessions.values()}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
+
+
+class BuildEvents:
+    """
+    Sends build events to the server, which publishes them on its PUB socket (topic build_topic). Events are JSON
+    objects with the job id and an 'event' field: 'progress' (voxels done and total), 'voxels' (partial results, in the
+    'C' response format with the consumed endurance comfort of the poses solved so far), 'done' and 'failed'.
+    Used by the build process, so events are pushed to the server instead of being published directly.
+    """
+
+    def __init__(self, address, job_id, context=None):
+        self.job_id = job_id
+        self.context = context if context is not None else zmq.Context()
+        self.owns_context = context is None
+        self.socket = self.context.socket(zmq.PUSH)
+        self.socket.connect(address)
+
+    def send(self, event, **fields):
+        fields.update(job=self.job_id, event=event)
+        self.socket.send_multipart([build_topic, json.dumps(fields).encode('utf-8')])
+
+    def progress(self, done, total):
+        self.send('progress', done=done, total=total)
+
+    def partial_results(self, voxel_ids, centers, num_poses, consumed_endurance):
+        comfort = (consumed_endurance - comfort_metrics.consumed_endurance_min) / (
+                comfort_metrics.consumed_endurance_max - comfort_metrics.consumed_endurance_min)
+        # voxels without poses are not part of the interaction space
+        self.send('voxels', voxels=[{
+            'id': voxel_id,
+            'position': position,
+            'num_poses': count,
+            'pose_id': 0,
+            'comfort': value
+        } for voxel_id, position, count, value in zip(voxel_ids.tolist(), centers.tolist(), num_poses.tolist(),
+                                                      comfort.tolist()) if count > 0])
+
+    def close(self):
+        # pending events are still delivered
+        self.socket.close(linger=1000)
+        if self.owns_context:
+            self.context.term()
+
+
+def build_database(database, arm_proper_length, forearm_hand_length, spacing, levels=0, workers=1, engine='sql',
+                   events_address=None, job_id=None, compact=False):
+    events = BuildEvents(events_address, job_id) if events_address is not None else None
+    try:
+        # the 'snapshot' engine also exports the snapshot, workers only read it
+        toolkit = arm_position.XRgonomics(database, arm_proper_length, forearm_hand_length, spacing, engine=engine,
+                                          workers=workers, levels=levels, compact=compact,
+                                          progress=events.progress if events is not None else None,
+                                          partial_results=events.partial_results if events is not None else None)
+        toolkit.conn.close()
+    finally:
+        if events is not None:
+            events.close()
+
+
+class BuildJobs:
+    """
+    Database builds ('A' requests) run in a background process, one at a time, so they never block the workers.
+    Finished builds become the database of the sessions that requested them. Databases that were already built are
+    taken from the cache. Builds without session (e.g. of the lattice of an arm_interpolation.ArmLattice) only fill the
+    cache, pinned databases are never evicted from it.
+    Progress and partial results are published as BuildEvents if events_address is set. compact databases store their
+    poses in the compact layout of pose_database.create_tables. Callbacks registered with when_finished are called once
+    the job is over, so requests waiting for a build do not hold a worker.
+    """
+
+    def __init__(self, sessions, database_cache, build_workers=1, engine='sql', context=None, events_address=None,
+                 pinned=(), compact=False):
+        self.sessions = sessions
+        self.pinned = list(pinned)
+        self.database_cache = database_cache
+        self.build_workers = build_workers
+        self.engine = engine
+        self.context = context
+        self.events_address = events_address
+        self.compact = compact
+        self.executor = ProcessPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.jobs = {}
+
+    def submit(self, session, arm_proper_length, forearm_hand_length, spacing, levels=0):
+        database = self.database_cache.path(arm_proper_length, forearm_hand_length, spacing, levels, self.compact)
+        parameters = self.database_cache.parameters(arm_proper_length, forearm_hand_length, spacing, levels,
+                                                    self.compact)
+        with self.lock:
+            # the same database is already being built
+            for job_id, job in self.jobs.items():
+                if job['database'] == database and job['status'] == 'running':
+                    if session is not None:
+                        job['sessions'].append(session)
+                    return job_id
+
+            job_id = next(self.ids)
+            job = {'database': database, 'status': 'running', 'error': None, 'callbacks': [],
+                   'sessions': [session] if session is not None else []}
+            self.jobs[job_id] = job
+            if self.database_cache.is_complete(database, parameters):
+                instrumentation.increment('database_cache_hits')
+                self.database_cache.touch(database)
+                if session is not None:
+                    session.set(database)
+                job['status'] = 'done'
+                self.publish(job_id, 'done')
+                return job_id
+            instrumentation.increment('database_cache_misses')
+            future = self.executor.submit(build_database, database, arm_proper_length, forearm_hand_length, spacing,
+                                          levels, self.build_workers, self.engine, self.events_address, job_id,
+                                          self.compact)
+            future.add_done_callback(lambda f: self.finished(job_id, job, f))
+            return job_id
+
+    def publish(self, job_id, event, **fields):
+        if self.events_address is None:
+            return
+        events = BuildEvents(self.events_address, job_id, self.context)
+        events.send(event, **fields)
+        events.close()
+
+    def finished(self, job_id, job, future):
+        error = future.exception()
+        if error is None:
+            with self.lock:
+                for session in job['sessions']:
+                    session.set(job['database'])
+                building = [other['database'] for other in self.jobs.values() if other['status'] == 'running']
+            # databases served to a session are never removed
+            self.database_cache.evict(keep=[job['database']] + building + list(self.sessions.databases()) +
+                                      self.pinned)
+        with self.lock:
+            job['status'] = 'done' if error is None else 'failed'
+            job['error'] = None if error is None else str(error)
+            callbacks, job['callbacks'] = job['callbacks'], []
+        # waiting clients are only released once the database is the one of their session
+        for callback in callbacks:
+            callback()
+        self.publish(job_id, job['status'], error=job['error'])
+
+    def when_finished(self, job_id, callback):
+        """ calls callback (from another thread) once the job is over, right away if it already is """
+        with self.lock:
+            job = self.jobs[job_id]
+            if job['status'] == 'running':
+                job['callbacks'].append(callback)
+                return
+        callback()
+
+    def check(self, job_id):
+        """ raises RuntimeError if the job failed """
+        job = self.jobs[job_id]
+        if job['status'] == 'failed':
+            raise RuntimeError('Build of {} failed: {}'.format(job['database'], job['error']))
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return {'job': job_id, 'status': 'unknown'}
+            return {'job': job_id, 'status': job['status'], 'database': job['database'], 'error': job['error']}
+
+
+class ParkedRequest:
+    """ reply of a request that waits for a build job, the worker parks it (see Worker.park) instead of waiting """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+
+class Worker(threading.Thread):
+    """
+    Answers requests forwarded by the broker, with the database of the session of each request (see ToolkitRegistry).
+    Workers announce themselves with a READY message and then receive one request at a time, prefixed by the client
+    address. Requests that wait for a build are parked, the worker announces itself again and answers other requests.
+    """
+
+    def __init__(self, context, sessions, build_jobs, response_cache, toolkits, lattice=None):
+        super().__init__(daemon=True)
+        self.context = context
+        self.sessions = sessions
+        self.build_jobs = build_jobs
+        self.response_cache = response_cache
+        self.toolkits = toolkits
+        self.lattice = lattice
+
+    def run(self):
+        socket = self.context.socket(zmq.REQ)
+        socket.connect(backend_address)
+        socket.send(b'READY')
+        while True:
+            client, empty, *request = socket.recv_multipart()
+            try:
+                reply = self.handle(request)
+            except Exception as e:
+                print('Error handling request: {}'.format(e))
+                instrumentation.increment('errors')
+                reply = b'Error'
+            if isinstance(reply, ParkedRequest):
+                self.park(client, request, reply.job_id)
+                socket.send(b'READY')
+                continue
+            # replies are either bytes or a list of frames (binary format)
+            frames = reply if isinstance(reply, list) else [reply]
+            socket.send_multipart([client, b''] + frames, copy=False)
+
+    def park(self, client, request, job_id):
+        """ pushes the request back to the broker once the build job is over, with the job id (built_job) so that it
+        is answered without waiting for another build """
         req = json.loads(request[1])
-        toolkit = arm_position.XRgonomics('{:.2f}_{:.2f}_{}.db'.format(*req.values()), *req.values())
-        voxels = toolkit.get_voxels_constrained('consumed_endurance', [])
-        socket.send(json.dumps(voxels).encode('utf-8'))
-    elif request[0].decode('utf-8') == 'D':
-        toolkit = arm_position.XRgonomics()
-        voxels = toolkit.get_voxels_constrained('consumed_endurance', [])
-        socket.send(json.dumps(voxels).encode('utf-8'))
-    else:
-        socket.send(b'Error')
+        req['built_job'] = job_id
+        frames = [client, b'', request[0], json.dumps(req).encode('utf-8')]
+
+        def requeue():
+            socket = self.context.socket(zmq.PUSH)
+            socket.connect(requeue_address)
+            socket.send_multipart(frames)
+            socket.close(linger=1000)
+
+        self.build_jobs.when_finished(job_id, requeue)
+
+    def cache_key(self, operation, req, database):
+        """ Normalized request plus the database and its modification time, None if the response can not be cached """
+        if operation not in cached_operations:
+            return None
+        # depends on the last 'O' request, not only on the database
+        if req.get('metric') == 'last_interaction_space':
+            return None
+        # constraints are combined with AND, their order does not change the response
+        if 'constraints' in req:
+            req = dict(req, constraints=sorted(req['constraints'], key=json.dumps))
+        # responses are shared by all the sessions of a database, until it is changed in place (e.g. rebuilt with
+        # other parameters, or an interpolated database replaced by its exact build)
+        try:
+            modified = os.stat(database).st_mtime_ns
+        except (OSError, TypeError):
+            return None
+        return database, modified, operation, json.dumps(req, sort_keys=True)
+
+    def handle(self, request):
+        # first part of the request encodes operation
+        operation = request[0].decode('utf-8')
+        # timings recorded while answering the request (e.g. by pose_database.query_rows) are attributed to it
+        instrumentation.stats.set_operation(operation)
+        since = instrumentation.start()
+        try:
+            req = self.parse(request)
+            session = self.sessions.get(req.pop('session', None))
+            key = self.cache_key(operation, req, session.get())
+            if key is None:
+                return self.dispatch(operation, req, session)
+
+            reply = self.response_cache.get(key)
+            instrumentation.increment('cache_hits' if reply is not None else 'cache_misses')
+            if reply is None:
+                reply = self.dispatch(operation, req, session)
+                self.response_cache.put(key, reply)
+            return reply
+        finally:
+            instrumentation.stop('total', since)
+
+    @staticmethod
+    def parse(request):
+        """ JSON body of a request ({} if there is none), timed as the 'parse' phase """
+        since = instrumentation.start()
+        req = json.loads(request[1]) if len(request) > 1 else {}
+        instrumentation.stop('parse', since)
+        return req
+
+    @staticmethod
+    def voxels_reply(toolkit, metric, constraints, level=0, weights=None, binary=False):
+        if not binary:
+            return encode_reply(toolkit.get_voxels_constrained(metric, constraints, level, weights))
+        if metric == 'last_interaction_space':
+            columns = wire.voxel_columns_from_dicts(toolkit.get_voxels_constrained(metric, constraints))
+        else:
+            columns = toolkit.get_voxels_constrained_columns(metric, constraints, level, weights)
+        since = instrumentation.start()
+        frames = wire.encode_voxels(columns)
+        instrumentation.stop('encode', since)
+        return frames
+
+    def stats(self, reset=False):
+        """ reply of 'S' requests: response cache stats and, if the server is instrumented, timing histograms and
+        counters by operation """
+        operations = instrumentation.stats.snapshot()
+        for operation in operations['operations'].values():
+            counters = operation['counters']
+            for cache in ('cache', 'database_cache'):
+                requests = counters.get(cache + '_hits', 0) + counters.get(cache + '_misses', 0)
+                if requests > 0:
+                    counters[cache + '_hit_rate'] = counters.get(cache + '_hits', 0) / requests
+        if reset:
+            instrumentation.stats.reset()
+        return {'cache': self.response_cache.stats(), 'toolkits': self.toolkits.stats(), 'sessions': len(self.sessions),
+                'instrumentation': operations}
+
+    def toolkit(self, session):
+        return self.toolkits.get(session.get())
+
+    def interpolate(self, session, arm_proper_length, forearm_hand_length, spacing, levels=0):
+        """ serves the session the database of the profile interpolated from the lattice, False if the exact database
+        is already built or the lattice does not cover the profile """
+        database_cache = self.build_jobs.database_cache
+        profile = (arm_proper_length, forearm_hand_length, spacing, levels, self.build_jobs.compact)
+        if (self.lattice is None or database_cache.is_complete(database_cache.path(*profile),
+                                                               database_cache.parameters(*profile))
+                or not self.lattice.covers(arm_proper_length, forearm_hand_length, spacing, levels)):
+            return False
+        session.set(self.lattice.interpolate(arm_proper_length, forearm_hand_length))
+        return True
+
+    def database_info(self, session):
+        """ reply of 'I' requests: the database of the session, its dimensions, its pose layout and, for interpolated
+        databases, the lattice points and the spread of the interpolation (see ArmLattice.build_database) """
+        conn = self.toolkit(session).conn
+        info = {'database': session.get()}
+        for key in ('arm_proper_length', 'forearm_hand_length', 'spacing', 'levels'):
+            value = pose_database.get_metadata(conn, key)
+            info[key] = float(value) if value is not None else None
+        for key in ('interpolated', 'interpolation_spread'):
+            value = pose_database.get_metadata(conn, key)
+            info[key] = json.loads(value) if value is not None else None
+        info['compact'] = pose_database.has_compact_poses(conn)
+        return info
+
+    def dispatch(self, operation, req, session):
+        # if operation == 'F':
+        #     frame_byte = base64.b64decode(request[1])
+        #
+        #     img_arr = np.frombuffer(frame_byte, np.uint8)
+        #     # reshape with correct dimensions
+        #     img = img_arr.reshape((480, 640, 4), order='C')
+        #     # remove alpha channel
+        #     img_rgb = img[:, :, :3]
+        #     img_bgr = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR)
+        #     img_bgr = cv2.flip(img_bgr, 0)
+        #     cv2.imshow("image", img_bgr)
+        #     cv2.waitKey(1)
+        #
+        #     print('Received request, time: {}'.format(time.time() - since))
+        #
+        #     return b'Image data'
+        if operation == 'C':
+            binary = req.pop('format', 'json') == 'binary'
+            toolkit = self.toolkit(session)
+            session.load_interaction_space(toolkit)
+            reply = self.voxels_reply(toolkit, binary=binary, **req)
+            session.store_interaction_space(toolkit)
+            return reply
+        elif operation == 'P':
+            poses = self.toolkit(session).get_voxel_poses(req['x'], req['y'], req['z'], req['metric'],
+                                                          req.get('level', 0))
+            return encode_reply(poses)
+        elif operation == 'L':
+            limits = self.toolkit(session).get_interaction_space_limits()
+            return encode_reply(limits)
+        elif operation == 'O':
+            toolkit = self.toolkit(session)
+            session.load_interaction_space(toolkit)
+            voxels = toolkit.optimal_position_in_polygon(req['polygon'], req.get('level', 0), req.get('weights'))
+            session.store_interaction_space(toolkit)
+            return encode_reply(voxels)
+        elif operation == 'N':
+            # nearest reachable voxels, not cached since every hand tracking update queries a new point
+            voxels = self.toolkit(session).get_voxels_nearest(req['metric'], req['point'], req.get('radius'),
+                                                               req.get('k'), req.get('level', 0))
+            return encode_reply(voxels)
+        elif operation == 'A':
+            background = req.pop('background', False)
+            binary = req.pop('format', 'json') == 'binary'
+            # with interpolate, profiles covered by the lattice are answered right away with an interpolated database,
+            # the exact database is built in the background (unless exact is false) and replaces it once done
+            interpolate = req.pop('interpolate', False)
+            exact = req.pop('exact', True)
+            # parked request (see park), its build is over
+            built_job = req.pop('built_job', None)
+            if built_job is not None:
+                self.build_jobs.check(built_job)
+                return self.voxels_reply(self.toolkit(session), 'consumed_endurance', [], binary=binary)
+            profile = request_profile(req)
+            if interpolate and self.interpolate(session, *profile):
+                if exact:
+                    self.build_jobs.submit(session, *profile)
+                return self.voxels_reply(self.toolkit(session), 'consumed_endurance', [], binary=binary)
+            job_id = self.build_jobs.submit(session, *profile)
+            if background:
+                # the client polls the build with 'J' requests
+                return encode_reply(self.build_jobs.status(job_id))
+            if self.build_jobs.status(job_id)['status'] == 'running':
+                return ParkedRequest(job_id)
+            self.build_jobs.check(job_id)
+            return self.voxels_reply(self.toolkit(session), 'consumed_endurance', [], binary=binary)
+        elif operation == 'J':
+            return encode_reply(self.build_jobs.status(req['job']))
+        elif operation == 'D':
+            session.set(default_database)
+            return self.voxels_reply(self.toolkit(session), 'consumed_endurance', [],
+                                     binary=req.get('format') == 'binary')
+        elif operation == 'I':
+            return encode_reply(self.database_info(session))
+        elif operation == 'S':
+            # {"reset": true} clears the instrumentation after reading it
+            return encode_reply(self.stats(req.get('reset', False)))
+        else:
+            return b'Error'
+
+
+def broker(frontend, backend, requeue):
+    """
+    Load balancing between the clients (ROUTER frontend) and the workers (ROUTER backend). Requests are only handed to
+    idle workers, so a worker busy with a slow request never delays the others. Requests parked until their build is
+    over come back on the requeue socket (PULL), prefixed by their client address like the requests of the frontend.
+    """
+    idle_workers = deque()
+    workers_poller = zmq.Poller()
+    workers_poller.register(backend, zmq.POLLIN)
+    poller = zmq.Poller()
+    poller.register(backend, zmq.POLLIN)
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(requeue, zmq.POLLIN)
+
+    while True:
+        # only accept client requests when there is an idle worker
+        sockets = dict((poller if idle_workers else workers_poller).poll())
+        if backend in sockets:
+            # frames are forwarded without copies
+            worker, empty, *message = backend.recv_multipart(copy=False)
+            idle_workers.append(worker.bytes)
+            if message[0].bytes != b'READY':
+                frontend.send_multipart(message, copy=False)
+        for requests in (frontend, requeue):
+            if requests in sockets and idle_workers:
+                client, empty, *request = requests.recv_multipart()
+                backend.send_multipart([idle_workers.popleft(), b'', client, b''] + request)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='XRgonomics API')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--workers', type=int, default=4, help='number of worker threads answering requests')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='max number of cached responses, 0 disables the cache')
+    parser.add_argument('--database-dir', default='databases', help='directory of the databases built by A requests')
+    parser.add_argument('--max-databases', type=int, default=20,
+                        help='max number of built databases kept in --database-dir (least recently used are removed)')
+    parser.add_argument('--max-database-bytes', type=int, default=None,
+                        help='max total size of the databases kept in --database-dir')
+    parser.add_argument('--build-workers', type=int, default=1,
+                        help='number of processes used by each database build (0 uses all the cpus)')
+    parser.add_argument('--pub-port', type=int, default=5556,
+                        help='port of the PUB socket where build progress and partial results are published')
+    parser.add_argument('--events-port', type=int, default=5557,
+                        help='local port where the build processes push their events to the server')
+    parser.add_argument('--engine', choices=['sql', 'memory', 'snapshot'], default='sql',
+                        help='query engine of the workers, snapshot memory-maps the snapshot of the database (written '
+                             'by the builds, or exported with pose_store.py)')
+    parser.add_argument('--compact-databases', action='store_true',
+                        help='build the databases with the compact pose layout (several times smaller, the elbow '
+                             'positions and joint angles are solved when they are read). The layout is part of the '
+                             'key of the database cache, databases built with the other layout are not reused')
+    parser.add_argument('--max-loaded-databases', type=int, default=8,
+                        help='max number of databases (arm profiles) loaded at once, least recently used are unloaded')
+    parser.add_argument('--max-loaded-bytes', type=int, default=None,
+                        help='max memory held by the loaded databases of the memory engine')
+    parser.add_argument('--max-sessions', type=int, default=1024,
+                        help='max number of client sessions, least recently used are forgotten')
+    parser.add_argument('--lattice-arm-proper-lengths', type=float, nargs='+', default=None,
+                        help='arm proper lengths of the lattice of databases used to interpolate the databases of A '
+                             'requests with "interpolate": true (built at startup when missing)')
+    parser.add_argument('--lattice-forearm-hand-lengths', type=float, nargs='+', default=None,
+                        help='forearm hand lengths of the lattice')
+    parser.add_argument('--lattice-spacing', type=float, default=10, help='spacing of the lattice databases')
+    parser.add_argument('--instrument', action='store_true',
+                        help='record per operation timing histograms (parse, sql, memory, normalize, encode and total) '
+                             'and cache hit rates, returned by S requests')
+    parser.add_argument('--stats-interval', type=float, default=0,
+                        help='seconds between log lines with the request timings (implies --instrument), 0 disables')
+    args = parser.parse_args()
+
+    instrumentation.stats.enabled = args.instrument or args.stats_interval > 0
+    if args.stats_interval > 0:
+        instrumentation.log_periodically(args.stats_interval)
+
+    context = zmq.Context()
+    frontend = context.socket(zmq.ROUTER)
+    frontend.bind('tcp://*:{}'.format(args.port))
+    backend = context.socket(zmq.ROUTER)
+    backend.bind(backend_address)
+    requeue = context.socket(zmq.PULL)
+    requeue.bind(requeue_address)
+
+    # build events are pushed by the build processes and forwarded to the subscribers
+    events_address = 'tcp://127.0.0.1:{}'.format(args.events_port)
+    events = context.socket(zmq.PULL)
+    events.bind(events_address)
+    publisher = context.socket(zmq.PUB)
+    publisher.bind('tcp://*:{}'.format(args.pub_port))
+    threading.Thread(target=zmq.proxy, args=(events, publisher), daemon=True).start()
+
+    response_cache = ResponseCache(args.cache_size)
+    sessions = Sessions(default_database, args.max_sessions)
+    toolkits = ToolkitRegistry(args.engine, args.max_loaded_databases, args.max_loaded_bytes)
+    database_cache = DatabaseCache(args.database_dir, args.max_databases, args.max_database_bytes)
+    # the workers open the databases read-only, databases built before the indexes are migrated once here
+    database_cache.migrate_indexes([default_database])
+    lattice = None
+    if args.lattice_arm_proper_lengths and args.lattice_forearm_hand_lengths:
+        lattice = arm_interpolation.ArmLattice(database_cache, args.lattice_arm_proper_lengths,
+                                               args.lattice_forearm_hand_lengths, args.lattice_spacing,
+                                               args.compact_databases)
+    build_jobs = BuildJobs(sessions, database_cache, args.build_workers or None, args.engine, context, events_address,
+                           pinned=lattice.databases() if lattice is not None else (), compact=args.compact_databases)
+    if lattice is not None:
+        for profile in lattice.profiles():
+            build_jobs.submit(None, *profile)
+    for _ in range(args.workers):
+        Worker(context, sessions, build_jobs, response_cache, toolkits, lattice).start()
+
+    broker(frontend, backend, requeue)
+
+
+if __name__ == '__main__':
+    main()
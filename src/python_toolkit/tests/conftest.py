@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# the toolkit modules import each other as top level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def database(tmp_path_factory):
+    """ small custom database built through XRgonomics, shared by the tests that only read it """
+    import arm_position
+
+    database = str(tmp_path_factory.mktemp('databases') / 'custom.db')
+    arm_position.XRgonomics(database, 33, 46, 10).conn.close()
+    return database
@@ -0,0 +1,39 @@
+import json
+import shutil
+
+import numpy as np
+
+import arm_interpolation
+import arm_position
+import pose_database
+from database_cache import DatabaseCache
+
+columns = ['elbow_x', 'elbow_y', 'elbow_z', 'elv_angle', 'shoulder_elv', 'shoulder_rot', 'elbow_flexion',
+           'consumed_endurance', 'rula']
+
+
+def test_interpolated_rows_are_single_poses(database, tmp_path):
+    lattice = arm_interpolation.ArmLattice(DatabaseCache(str(tmp_path), None), [33, 38], [46, 52], 10)
+    # the fixture is the lattice database of 33, 46
+    shutil.copy(database, lattice.corner_path(33, 46))
+    arm_interpolation.build_lattice(lattice)
+
+    # at a lattice point, every voxel holds the best pose (by consumed endurance) of the lattice database, with the
+    # metrics of that same pose
+    interpolated = arm_position.XRgonomics(lattice.interpolate(33, 46), read_only=True)
+    exact = arm_position.XRgonomics(database, read_only=True)
+    best_poses = {tuple(voxel['position']): voxel['pose_id']
+                  for voxel in exact.get_voxels_constrained('consumed_endurance', [])}
+    voxels = interpolated.get_voxels_constrained('consumed_endurance', [])
+    assert {tuple(voxel['position']) for voxel in voxels} == set(best_poses)
+    for voxel in voxels[::20]:
+        pose_id = best_poses[tuple(voxel['position'])]
+        np.testing.assert_allclose(
+            pose_database.get_pose_columns(interpolated.conn, columns, 'WHERE arm_poses.arm_pose_id = ?',
+                                           [voxel['pose_id']]),
+            pose_database.get_pose_columns(exact.conn, columns, 'WHERE arm_poses.arm_pose_id = ?', [pose_id]))
+
+    spread = json.loads(pose_database.get_metadata(interpolated.conn, 'interpolation_spread'))
+    assert all(spread[metric]['max'] == 0 for metric in arm_interpolation.interpolated_metrics)
+    interpolated.conn.close()
+    exact.conn.close()
@@ -0,0 +1,101 @@
+import shutil
+
+import numpy as np
+import pytest
+
+import arm_position
+import build_pipeline
+import comfort_metrics
+import pose_database
+
+
+@pytest.fixture
+def toolkit(database):
+    toolkit = arm_position.XRgonomics(database, 33, 46, 10, read_only=True)
+    yield toolkit
+    toolkit.conn.close()
+
+
+@pytest.mark.parametrize('metric', ['consumed_endurance) FROM voxels --', 'id', 'reserve'])
+def test_unknown_metrics_are_rejected(toolkit, metric):
+    with pytest.raises(ValueError):
+        toolkit.get_voxels_constrained(metric, [])
+    with pytest.raises(ValueError):
+        toolkit.query_voxels_constrained(metric, [])
+    with pytest.raises(ValueError):
+        toolkit.get_voxel_poses(0, 0, 40, metric)
+
+
+@pytest.mark.parametrize('metric', arm_position.query_metrics)
+def test_query_metrics_are_accepted(toolkit, metric):
+    toolkit.get_voxels_constrained(metric, [])
+
+
+def test_database_built_with_other_parameters_is_rebuilt(tmp_path):
+    database = str(tmp_path / 'custom.db')
+    toolkit = arm_position.XRgonomics(database, 33, 46, 10)
+    # rebuilds drop the metadata
+    pose_database.set_metadata(toolkit.conn, 'marker', 1)
+    toolkit.conn.commit()
+    toolkit.conn.close()
+
+    # same parameters (33 and 33.0 are the same length), the database is reused
+    toolkit = arm_position.XRgonomics(database, 33.0, 46.0, 10.0)
+    assert pose_database.get_metadata(toolkit.conn, 'marker') == '1'
+    build_parameters = pose_database.get_metadata(toolkit.conn, 'build_parameters')
+    toolkit.conn.close()
+
+    toolkit = arm_position.XRgonomics(database, 40, 50, 10)
+    assert pose_database.get_metadata(toolkit.conn, 'marker') is None
+    assert pose_database.get_metadata(toolkit.conn, 'arm_proper_length') == '40'
+    assert pose_database.get_metadata(toolkit.conn, 'build_parameters') != build_parameters
+    assert pose_database.is_build_complete(toolkit.conn, arm_position.build_version,
+                                           build_pipeline.build_parameters(40, 50, 10,
+                                                                           build_version=arm_position.build_version))
+    toolkit.conn.close()
+
+
+def test_compact_database_round_trip(database, tmp_path):
+    standard = arm_position.XRgonomics(database, 33, 46, 10, read_only=True)
+    compact = arm_position.XRgonomics(str(tmp_path / 'compact.db'), 33, 46, 10, compact=True)
+    assert pose_database.has_compact_poses(compact.conn)
+    columns = ['arm_pose_id', 'voxel_id', 'consumed_endurance', 'rula'] + list(pose_database.derived_pose_columns)
+    expected = pose_database.get_pose_columns(standard.conn, columns)
+    poses = pose_database.get_pose_columns(compact.conn, columns)
+    assert poses.shape == expected.shape
+    assert (poses[:, :4] == expected[:, :4]).all()
+    # solved poses are off by at most one step of the fixed-point swivel angle: elbow positions (cm) move along a
+    # circle whose radius is below the arm proper length, joint angles are in degrees
+    step = 1 / pose_database.swivel_angle_scale
+    np.testing.assert_allclose(poses[:, 4:7], expected[:, 4:7], rtol=0, atol=33 * step)
+    np.testing.assert_allclose(poses[:, 7:], expected[:, 7:], rtol=0, atol=np.degrees(step))
+    standard.conn.close()
+    compact.conn.close()
+
+
+def voxel_poses(voxels):
+    return sorted((voxel['id'], voxel['pose_id']) for voxel in voxels)
+
+
+def test_custom_weights(database, tmp_path):
+    weighted = str(tmp_path / 'weighted.db')
+    shutil.copy(database, weighted)
+    toolkit = arm_position.XRgonomics(weighted, 33, 46, 10)
+    toolkit.compute_weigthed_metrics()
+
+    # the stored column is weighted with the default weights
+    stored = toolkit.get_voxels_constrained('weighted_metrics', [])
+    custom = toolkit.get_voxels_constrained('weighted_metrics', [], weights=comfort_metrics.default_weights)
+    assert voxel_poses(custom) == voxel_poses(stored)
+    np.testing.assert_allclose(sorted(voxel['comfort'] for voxel in custom),
+                               sorted(voxel['comfort'] for voxel in stored))
+
+    # a single weighted metric picks the best poses of that metric
+    custom = toolkit.get_voxels_constrained('weighted_metrics', [], weights={'consumed_endurance': 1})
+    assert voxel_poses(custom) == voxel_poses(toolkit.get_voxels_constrained('consumed_endurance', []))
+
+    with pytest.raises(ValueError):
+        toolkit.get_voxels_constrained('weighted_metrics', [], weights={'reserve': 1})
+    with pytest.raises(ValueError):
+        toolkit.get_voxels_constrained('rula', [], weights=comfort_metrics.default_weights)
+    toolkit.conn.close()
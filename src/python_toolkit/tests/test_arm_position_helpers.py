@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+import arm_position_helpers as armpos
+
+pose_columns = ['elbow_x', 'elbow_y', 'elbow_z', 'elv_angle', 'shoulder_elv', 'shoulder_rot', 'elbow_flexion']
+
+
+@pytest.mark.parametrize('arm_proper_length, forearm_hand_length, spacing', [(33, 46, 5), (30.5, 44.2, 10)])
+def test_batched_inverse_kinematics_matches_scalar(arm_proper_length, forearm_hand_length, spacing):
+    limits = armpos.interaction_space_limits(arm_proper_length, forearm_hand_length)
+    centers = armpos.compute_interaction_space(spacing, limits, arm_proper_length + forearm_hand_length) + spacing / 2
+
+    expected = {column: [] for column in pose_columns}
+    voxel_index = []
+    for index, center in enumerate(centers):
+        for pose in armpos.compute_anchor_arm_poses(center, arm_proper_length, forearm_hand_length):
+            for column in pose_columns:
+                expected[column].append(pose[column])
+            voxel_index.append(index)
+
+    poses = armpos.compute_anchor_arm_poses_batch(centers, arm_proper_length, forearm_hand_length)
+    assert len(voxel_index) > 0
+    np.testing.assert_array_equal(poses['voxel_index'], voxel_index)
+    for column in pose_columns:
+        np.testing.assert_allclose(poses[column], expected[column], rtol=0, atol=1e-9, err_msg=column)
+
+
+@pytest.mark.parametrize('arm_proper_length, forearm_hand_length, spacing, count', [
+    (33, 46, 10, 871), (33, 46, 5, 7955), (30, 40, 5, 5421),
+    # the generator of build_version 1 gave 723 voxels, its rows after the first one started at the unfloored limits
+    (30.5, 44.2, 10, 734)
+])
+def test_interaction_space_grid(arm_proper_length, forearm_hand_length, spacing, count):
+    limits = armpos.interaction_space_limits(arm_proper_length, forearm_hand_length)
+    voxels = armpos.compute_interaction_space(spacing, limits, arm_proper_length + forearm_hand_length)
+    assert len(voxels) == count
+    # a single grid, aligned on the floored lower limits
+    origin = np.floor([low for low, _ in limits])
+    np.testing.assert_array_equal(np.mod(voxels - origin, spacing), 0)
+    assert np.all(voxels >= origin) and np.all(voxels < [high for _, high in limits])
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+import arm_position
+import build_pipeline
+import pose_database
+
+
+def database_rows(database):
+    """ voxels and arm poses of a database, in id order """
+    conn = pose_database.create_connection(database, read_only=True)
+    try:
+        voxels = conn.execute('SELECT * FROM voxels ORDER BY id').fetchall()
+        poses = conn.execute('SELECT * FROM arm_poses ORDER BY arm_pose_id').fetchall()
+    finally:
+        conn.close()
+    assert len(voxels) > 0 and len(poses) > 0
+    return voxels, poses
+
+
+def test_parallel_build_matches_a_single_process_build(database, tmp_path):
+    parallel = str(tmp_path / 'parallel.db')
+    # the fixture is built by one process in a single chunk, small chunks give every worker several of them
+    conn = pose_database.create_connection(parallel)
+    build_pipeline.build_database(conn, 33, 46, 10, workers=4, chunk_size=100, build_version=arm_position.build_version)
+    conn.commit()
+    conn.close()
+    assert database_rows(parallel) == database_rows(database)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_interrupted_build_resumes_from_its_checkpoint(database, tmp_path):
+    resumed = str(tmp_path / 'resumed.db')
+
+    def progress(done, total):
+        if done >= 300:
+            raise Interrupted()
+
+    conn = pose_database.create_connection(resumed)
+    with pytest.raises(Interrupted):
+        build_pipeline.build_database(conn, 33, 46, 10, chunk_size=100, progress=progress,
+                                      build_version=arm_position.build_version)
+    conn.close()
+    conn = pose_database.create_connection(resumed, read_only=True)
+    assert json.loads(pose_database.get_metadata(conn, 'build_checkpoint')) == {'level': 0, 'voxels_done': 300}
+    conn.close()
+
+    # XRgonomics resumes the build with the same parameters (and another chunk size), after the voxels already done
+    chunks = []
+    toolkit = arm_position.XRgonomics(resumed, 33, 46, 10,
+                                      partial_results=lambda voxel_ids, *results: chunks.append(voxel_ids[0]))
+    assert chunks == [301]
+    assert pose_database.get_metadata(toolkit.conn, 'build_checkpoint') is None
+    toolkit.conn.close()
+    assert database_rows(resumed) == database_rows(database)
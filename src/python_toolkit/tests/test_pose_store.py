@@ -0,0 +1,75 @@
+import shutil
+
+import numpy as np
+import pytest
+
+import arm_position
+import pose_database
+import pose_store
+
+constraints = [[], [{'axis': 1, 'constraint': '>=', 'value': 0}, {'axis': 2, 'constraint': '<=', 'value': 30}],
+               [{'axis': 0, 'constraint': '=', 'value': 20}]]
+
+
+@pytest.fixture
+def toolkits(database, tmp_path):
+    """ one XRgonomics per engine, the snapshot is exported next to a copy of the database """
+    snapshot_database = str(tmp_path / 'custom.db')
+    shutil.copy(database, snapshot_database)
+    toolkits = {
+        'sql': arm_position.XRgonomics(database, 33, 46, 10, engine='sql', read_only=True),
+        'memory': arm_position.XRgonomics(database, 33, 46, 10, engine='memory', read_only=True),
+        'snapshot': arm_position.XRgonomics(snapshot_database, 33, 46, 10, engine='snapshot')
+    }
+    assert pose_store.is_snapshot(pose_store.snapshot_path(snapshot_database))
+    yield toolkits
+    for toolkit in toolkits.values():
+        toolkit.conn.close()
+
+
+@pytest.mark.parametrize('metric', ['consumed_endurance', 'rula'])
+@pytest.mark.parametrize('constraint', constraints)
+def test_engines_return_the_same_voxels(toolkits, metric, constraint):
+    expected = toolkits['sql'].get_voxels_constrained(metric, constraint)
+    assert len(expected) > 0
+    for engine in ('memory', 'snapshot'):
+        assert toolkits[engine].get_voxels_constrained(metric, constraint) == expected, engine
+
+
+def test_engines_return_the_same_poses_and_limits(toolkits):
+    expected = toolkits['sql']
+    voxels = expected.get_voxels_constrained('consumed_endurance', [])
+    for engine in ('memory', 'snapshot'):
+        toolkit = toolkits[engine]
+        assert toolkit.get_interaction_space_limits() == expected.get_interaction_space_limits(), engine
+        for voxel in voxels[::50]:
+            assert toolkit.get_voxel_poses(*voxel['position'], 'rula') == \
+                expected.get_voxel_poses(*voxel['position'], 'rula'), engine
+        polygon = [[x, y, z] for x in (0, 30) for y in (-20, 10) for z in (10, 40)]
+        assert toolkit.optimal_position_in_polygon(polygon) == expected.optimal_position_in_polygon(polygon), engine
+
+
+
+def test_limits_are_the_base_grid_of_refined_databases(tmp_path):
+    toolkit = arm_position.XRgonomics(str(tmp_path / 'refined.db'), 33, 46, 10, levels=1)
+    limits = toolkit.get_interaction_space_limits()
+    # without the limits cached by the build, from the voxels of level 0
+    pose_database.invalidate_voxels_limits(toolkit.conn)
+    assert toolkit.get_interaction_space_limits() == limits
+    assert pose_store.PoseStore(toolkit.conn).get_voxels_limits() == pose_database.get_voxels_limits(toolkit.conn)
+    toolkit.conn.close()
+
+
+def test_nearest_voxels_match_a_brute_force_search(toolkits):
+    voxels = toolkits['sql'].get_voxels_constrained('consumed_endurance', [])
+    centers = np.array([voxel['position'] for voxel in voxels])
+    ids = np.array([voxel['id'] for voxel in voxels])
+    rng = np.random.default_rng(0)
+    for point in rng.uniform(-40, 60, (20, 3)):
+        distances = np.linalg.norm(centers - point, axis=1)
+        for engine in ('sql', 'memory', 'snapshot'):
+            toolkit = toolkits[engine]
+            within = toolkit.get_voxels_nearest('consumed_endurance', point.tolist(), radius=15)
+            assert sorted(voxel['id'] for voxel in within) == sorted(ids[distances <= 15].tolist()), engine
+            nearest = toolkit.get_voxels_nearest('consumed_endurance', point.tolist(), k=5)
+            np.testing.assert_allclose(sorted(voxel['distance'] for voxel in nearest), np.sort(distances)[:5])
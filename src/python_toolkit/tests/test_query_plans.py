@@ -0,0 +1,178 @@
+import shutil
+
+import pytest
+
+import arm_position
+import pose_database
+from database_cache import DatabaseCache
+
+metric = 'consumed_endurance'
+
+
+@pytest.fixture(scope='module', params=[False, True], ids=['standard', 'compact'])
+def built_database(request, tmp_path_factory):
+    """ database built through XRgonomics, which creates the indexes itself """
+    database = str(tmp_path_factory.mktemp('plans') / 'custom.db')
+    toolkit = arm_position.XRgonomics(database, 33, 46, 10, compact=request.param)
+    # best poses of weighted_metrics, used by optimal_position_in_polygon
+    toolkit.compute_weigthed_metrics()
+    toolkit.conn.close()
+    return database, request.param
+
+
+@pytest.fixture
+def toolkit(built_database, tmp_path):
+    # the checked functions write (and the fallback tests drop voxel_best_pose), each test gets its own copy
+    built, compact = built_database
+    database = str(tmp_path / 'custom.db')
+    shutil.copy(built, database)
+    toolkit = arm_position.XRgonomics(database, 33, 46, 10, compact=compact)
+    yield toolkit
+    toolkit.conn.close()
+
+
+def query_plans(conn, function, *args):
+    """ EXPLAIN QUERY PLAN details of the statements run by function, which is rolled back """
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        function(*args)
+    finally:
+        conn.set_trace_callback(None)
+        conn.rollback()
+    details = []
+    for sql in statements:
+        # nested statements ('-- ...') and shadow table reads ("'main'.'voxels_node'") come from the r*-tree module
+        if sql.startswith('--') or "'main'." in sql or sql.split()[0].upper() in ('BEGIN', 'COMMIT', 'ROLLBACK',
+                                                                                  'PRAGMA', 'CREATE'):
+            continue
+        details += [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()]
+    assert len(details) > 0
+    # automatic indexes are built (a full scan and sort) on every execution of the query
+    assert not any('AUTOMATIC' in detail for detail in details), details
+    return details
+
+
+def assert_plans(details, *fragments):
+    for fragment in fragments:
+        assert any(fragment in detail for detail in details), (fragment, details)
+
+
+def drop_best_poses(toolkit):
+    """ the queries then take their fallback path over arm_poses """
+    toolkit.conn.execute('DELETE FROM voxel_best_pose')
+    assert not pose_database.has_voxel_best_pose(toolkit.conn, metric)
+
+
+def voxel(toolkit):
+    voxel_id, x, y, z = pose_database.get_voxel_by_id(toolkit.conn, pose_database.get_max_voxel_id(toolkit.conn))
+    return voxel_id, [x, y, z]
+
+
+def test_poses_in_voxel(toolkit):
+    voxel_id, center = voxel(toolkit)
+    details = query_plans(toolkit.conn, pose_database.get_poses_in_voxel, toolkit.conn, voxel_id, metric)
+    assert_plans(details, 'SEARCH arm_poses USING INDEX arm_poses_voxel_id (voxel_id=?)')
+    details = query_plans(toolkit.conn, toolkit.get_voxel_poses, *center, metric)
+    # r*-tree lookups are reported as SCAN, with the index of their constraints (1: id, 2: bounds)
+    assert_plans(details, 'SCAN voxels VIRTUAL TABLE INDEX 2:',
+                 'SEARCH arm_poses USING INDEX arm_poses_voxel_id (voxel_id=?)')
+
+
+def test_voxels_constrained_best_pose(toolkit):
+    details = query_plans(toolkit.conn, toolkit.query_voxels_constrained, metric,
+                          [{'axis': 1, 'constraint': '>=', 'value': 0}])
+    assert_plans(details, 'SEARCH voxel_best_pose USING PRIMARY KEY (metric=? AND voxel_id=?)')
+
+
+def test_voxels_constrained_fallback(toolkit):
+    drop_best_poses(toolkit)
+    details = query_plans(toolkit.conn, toolkit.query_voxels_constrained, metric,
+                          [{'axis': 1, 'constraint': '>=', 'value': 0}])
+    assert_plans(details, 'SEARCH arm_poses USING INDEX arm_poses_voxel_id (voxel_id=?)')
+
+
+@pytest.mark.parametrize('best_poses', [True, False], ids=['best_pose', 'fallback'])
+def test_optimal_position_in_polygon(toolkit, best_poses):
+    if not best_poses:
+        drop_best_poses(toolkit)
+    _, center = voxel(toolkit)
+    polygon = [[center[0] + x, center[1] + y, center[2] + z] for x in (-10, 10) for y in (-10, 10) for z in (-10, 10)]
+    details = query_plans(toolkit.conn, toolkit.optimal_position_in_polygon, polygon)
+    assert_plans(details, 'SEARCH voxel_best_pose USING PRIMARY KEY (metric=? AND voxel_id=?)' if best_poses else
+                 'SEARCH arm_poses USING INDEX arm_poses_voxel_id (voxel_id=?)')
+
+
+def test_voxels_joined_with_poses(toolkit):
+    voxel_id, _ = voxel(toolkit)
+    for function, args in [(pose_database.get_voxels_with_pose_cursor, ()),
+                           (pose_database.get_voxels_ca_with_pose_cursor, ()),
+                           (pose_database.get_min_consumed_endurance_per_voxel, (voxel_id,))]:
+        details = query_plans(toolkit.conn, function, toolkit.conn, *args)
+        assert_plans(details, 'SEARCH arm_poses USING INDEX arm_poses_voxel_id')
+
+
+def test_refresh_voxel_best_pose_groups_by_index(toolkit):
+    details = query_plans(toolkit.conn, pose_database.refresh_voxel_best_pose, toolkit.conn)
+    # one pass over the index, in voxel order, instead of a scan of the table and a sort
+    assert_plans(details, 'SCAN arm_poses USING INDEX arm_poses_voxel_id')
+    assert all('TEMP B-TREE' not in detail for detail in details), details
+
+
+def test_pose_columns_join_voxels_by_id(toolkit):
+    details = query_plans(toolkit.conn, pose_database.get_all_poses_voxels, toolkit.conn)
+    assert_plans(details, 'SCAN voxels VIRTUAL TABLE INDEX 1:')
+
+
+def test_lookups(toolkit):
+    voxel_id, center = voxel(toolkit)
+    assert_plans(query_plans(toolkit.conn, pose_database.get_voxel_by_id, toolkit.conn, voxel_id),
+                 'SCAN voxels VIRTUAL TABLE INDEX 1:')
+    assert_plans(query_plans(toolkit.conn, pose_database.get_voxel_point, toolkit.conn, *center, 0),
+                 'SCAN voxels VIRTUAL TABLE INDEX 2:')
+    assert_plans(query_plans(toolkit.conn, pose_database.set_poses_metric, toolkit.conn, 'rula', [1], [3]),
+                 'SEARCH arm_poses USING INTEGER PRIMARY KEY (rowid=?)')
+    # limits are cached in the metadata by the builds
+    assert_plans(query_plans(toolkit.conn, pose_database.get_voxels_limits, toolkit.conn),
+                 'SEARCH metadata USING INDEX sqlite_autoindex_metadata_1 (key=?)')
+    assert any('COVERING INDEX arm_poses_voxel_id' in detail
+               for detail in query_plans(toolkit.conn, pose_database.count_poses, toolkit.conn))
+
+
+def database_without_indexes(built_database, path):
+    shutil.copy(built_database[0], path)
+    conn = pose_database.create_connection(path)
+    conn.execute('DROP INDEX arm_poses_voxel_id')
+    conn.commit()
+    conn.close()
+    return path
+
+
+def poses_in_voxel_plans(toolkit):
+    voxel_id, _ = voxel(toolkit)
+    return query_plans(toolkit.conn, pose_database.get_poses_in_voxel, toolkit.conn, voxel_id, metric)
+
+
+def test_databases_without_indexes_are_migrated(built_database, tmp_path):
+    database = database_without_indexes(built_database, str(tmp_path / 'xrgonomics_old.db'))
+
+    # server workers only open the databases read-only, they never write and query without the indexes
+    toolkit = arm_position.XRgonomics(database, read_only=True)
+    assert not pose_database.has_indexes(toolkit.conn)
+    assert_plans(poses_in_voxel_plans(toolkit), 'SCAN arm_poses')
+    toolkit.conn.close()
+
+    # the server migrates the databases of its cache at startup
+    assert DatabaseCache(str(tmp_path)).migrate_indexes() == [database]
+    toolkit = arm_position.XRgonomics(database, read_only=True)
+    assert pose_database.has_indexes(toolkit.conn)
+    assert_plans(poses_in_voxel_plans(toolkit), 'SEARCH arm_poses USING INDEX arm_poses_voxel_id (voxel_id=?)')
+    toolkit.conn.close()
+
+
+def test_writable_instances_migrate_their_database(built_database, tmp_path):
+    database = database_without_indexes(built_database, str(tmp_path / 'old.db'))
+    toolkit = arm_position.XRgonomics(database, 33, 46, 10, compact=built_database[1])
+    assert pose_database.has_indexes(toolkit.conn)
+    assert_plans(poses_in_voxel_plans(toolkit), 'SEARCH arm_poses USING INDEX arm_poses_voxel_id (voxel_id=?)')
+    toolkit.conn.close()
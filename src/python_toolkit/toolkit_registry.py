@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+
+import arm_position
+
+
+class ToolkitRegistry:
+    """
+    Read-only XRgonomics instances of the databases served to the clients (one database per arm profile, see
+    DatabaseCache.path), shared by the server workers. sqlite connections can not be shared between threads, so every
+    worker has its own instance of a database, but their pose_store.PoseStore (the in-memory copy or the memory-mapped
+    snapshot) is loaded once and shared. The least recently used databases are unloaded when more than max_databases
+    are loaded, or when their stores hold more than max_bytes in memory.
+    """
+
+    def __init__(self, engine='sql', max_databases=8, max_bytes=None):
+        self.engine = engine
+        self.max_databases = max_databases
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # loaded databases, least recently used first, with their shared store (None until one is loaded)
+        self.stores = OrderedDict()
+        self.local = threading.local()
+
+    def get(self, database):
+        """ XRgonomics instance of the database for the calling thread """
+        toolkits = self.local.__dict__.setdefault('toolkits', {})
+        with self.lock:
+            if database in self.stores:
+                self.stores.move_to_end(database)
+            store = self.stores.get(database)
+            loaded = set(self.stores)
+
+        # instances of unloaded databases are closed by their own thread
+        for unloaded in set(toolkits) - loaded - {database}:
+            toolkits.pop(unloaded).conn.close()
+
+        toolkit = toolkits.get(database)
+        if toolkit is None:
+            toolkit = arm_position.XRgonomics(database, engine=self.engine, read_only=True, store=store)
+            toolkits[database] = toolkit
+        elif store is not None and toolkit.store is not store:
+            # store loaded by another thread (or reloaded after an eviction)
+            toolkit.store = store
+
+        with self.lock:
+            # stores are loaded at startup by the 'memory' and 'snapshot' engines, on first use by the 'sql' engine
+            if self.stores.get(database) is None:
+                self.stores[database] = toolkit.store
+            self.evict(keep=database)
+        return toolkit
+
+    def evict(self, keep):
+        """ unloads the least recently used databases above the limits, must be called with the lock held """
+        while len(self.stores) > 1:
+            too_many = self.max_databases is not None and len(self.stores) > self.max_databases
+            too_large = self.max_bytes is not None and self.memory_bytes() > self.max_bytes
+            if not too_many and not too_large:
+                break
+            database = next(iter(self.stores))
+            if database == keep:
+                self.stores.move_to_end(database)
+                continue
+            del self.stores[database]
+
+    def memory_bytes(self):
+        return sum(store.memory_bytes() for store in self.stores.values() if store is not None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'databases': list(self.stores),
+                'memory_bytes': self.memory_bytes(),
+                'max_databases': self.max_databases,
+                'max_bytes': self.max_bytes
+            }
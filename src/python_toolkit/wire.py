@@ -0,0 +1,45 @@
+import json
+
+import numpy as np
+
+# Binary response format for voxel queries, requested by adding "format": "binary" to the request.
+# The response is a multipart message: a JSON header followed by one frame per column, with the raw little endian
+# bytes of the column. The header lists the name, dtype and shape of every column, in frame order.
+binary_version = 1
+voxel_columns = [('id', '<i4'), ('position', '<f4'), ('num_poses', '<i4'), ('pose_id', '<i4'), ('comfort', '<f4')]
+
+
+def voxel_columns_from_dicts(voxels):
+    """ Columns of a list of voxel dicts (as returned by XRgonomics.get_voxels_constrained) """
+    return {
+        'id': np.array([voxel['id'] for voxel in voxels], dtype=np.int64),
+        'position': np.array([voxel['position'] for voxel in voxels], dtype=float).reshape(-1, 3),
+        'num_poses': np.array([voxel['num_poses'] for voxel in voxels], dtype=np.int64),
+        'pose_id': np.array([voxel['pose_id'] for voxel in voxels], dtype=np.int64),
+        'comfort': np.array([voxel['comfort'] for voxel in voxels], dtype=float)
+    }
+
+
+def encode_voxels(columns):
+    """
+    Encodes voxel columns (see XRgonomics.get_voxels_constrained_columns) as a list of frames. Column frames are
+    memoryviews of numpy buffers, so they can be sent without copies (socket.send_multipart(frames, copy=False)).
+    """
+    arrays = [np.ascontiguousarray(columns[name], dtype=dtype) for name, dtype in voxel_columns]
+    header = {
+        'format': 'columns',
+        'version': binary_version,
+        'count': len(arrays[0]),
+        'columns': [{'name': name, 'dtype': dtype, 'shape': list(array.shape)}
+                    for (name, dtype), array in zip(voxel_columns, arrays)]
+    }
+    return [json.dumps(header).encode('utf-8')] + [memoryview(array).cast('B') for array in arrays]
+
+
+def decode_voxels(frames):
+    """ Inverse of encode_voxels, returns the columns as read-only numpy arrays backed by the frames """
+    header = json.loads(bytes(frames[0]))
+    columns = {}
+    for column, frame in zip(header['columns'], frames[1:]):
+        columns[column['name']] = np.frombuffer(frame, dtype=column['dtype']).reshape(column['shape'])
+    return columns